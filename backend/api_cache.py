@@ -0,0 +1,159 @@
+"""Cache of the api: bounded in entries & (estimated) memory,
+least recently used entries are evicted first. Each entry expires
+on its own, a bit before its ttl (jitter), so entries cached
+together are not all reloaded from the db at the same time.
+Concurrent reloads of the same entry are coalesced into one."""
+#! /usr/bin/env python3
+
+import asyncio
+import sys
+from collections import OrderedDict
+from os import getenv
+from random import uniform
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Hashable, NamedTuple, Optional
+
+API_CACHE_TTL: float = float(getenv("API_CACHE_TTL", "300"))
+# Entries expire between (1 - jitter) * ttl & ttl after being cached
+API_CACHE_JITTER: float = float(getenv("API_CACHE_JITTER", "0.2"))
+API_CACHE_MAX_ENTRIES: int = int(getenv("API_CACHE_MAX_ENTRIES", "1024"))
+API_CACHE_MAX_BYTES: int = int(getenv("API_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+def estimate_size(value: Any) -> int:
+    """Rough memory used by a value & its content (dicts, lists,... of db documents)"""
+    size: int = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
+class CacheEntry(NamedTuple):
+    """A cached value, its estimated size & when it expires (monotonic time)"""
+
+    value: Any
+    size: int
+    expires: float
+
+
+class CacheStats:  # pylint: disable=too-few-public-methods
+    """Counters of a cache"""
+
+    def __init__(self) -> None:
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+
+    def hit_ratio(self) -> float:
+        """Part of the lookups that found a value"""
+        lookups: int = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class TTLCache:
+    """LRU cache whose entries also expire after their ttl"""
+
+    def __init__(
+        self,
+        ttl: float = API_CACHE_TTL,
+        max_entries: int = API_CACHE_MAX_ENTRIES,
+        max_bytes: int = API_CACHE_MAX_BYTES,
+        jitter: float = API_CACHE_JITTER,
+    ) -> None:
+        self.ttl: float = ttl
+        self.max_entries: int = max_entries
+        self.max_bytes: int = max_bytes
+        self.jitter: float = jitter
+        # Least recently used first
+        self.entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self.bytes: int = 0
+        self.stats: CacheStats = CacheStats()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry: Optional[CacheEntry] = self.entries.get(key)
+        return entry is not None and entry.expires > monotonic()
+
+    def _remove(self, key: Hashable) -> None:
+        self.bytes -= self.entries.pop(key).size
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Value of a key if cached & not expired (default otherwise)"""
+        entry: Optional[CacheEntry] = self.entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return default
+        if entry.expires <= monotonic():
+            self._remove(key)
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry.value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Caches a value (for ttl seconds, minus the jitter) & evicts the
+        least recently used entries while the cache is too big. A value
+        bigger than the whole cache isn't cached"""
+        if key in self.entries:
+            self._remove(key)
+        size: int = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires: float = monotonic() + ttl * uniform(1 - self.jitter, 1)
+        self.entries[key] = CacheEntry(value, size, expires)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.stats.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        """Drops a key (if cached)"""
+        if key in self.entries:
+            self._remove(key)
+
+    def clear(self) -> None:
+        """Drops all entries"""
+        self.entries.clear()
+        self.bytes = 0
+
+    def info(self) -> Dict[str, Any]:
+        """Size & counters of the cache"""
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.stats.hits,
+            "misses": self.stats.misses,
+            "hit_ratio": self.stats.hit_ratio(),
+            "evictions": self.stats.evictions,
+            "expirations": self.stats.expirations,
+        }
+
+
+class SingleFlight:  # pylint: disable=too-few-public-methods
+    """Runs one call per key at a time: callers asking for a key
+    already being loaded wait for that call & share its result"""
+
+    def __init__(self) -> None:
+        self.calls: Dict[Hashable, "asyncio.Future[Any]"] = {}
+        self.coalesced: int = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Result of func(), or of the call of the same key in flight"""
+        call: Optional["asyncio.Future[Any]"] = self.calls.get(key)
+        if call is None:
+            call = self.calls[key] = asyncio.ensure_future(func())
+            call.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        # A caller going away (client disconnected) doesn't cancel the call of the others
+        return await asyncio.shield(call)
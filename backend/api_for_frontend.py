@@ -14,31 +14,39 @@
 """
 # pylint: disable=global-statement,global-variable-not-assigned,logging-fstring-interpolation
 
+import asyncio
 import logging
-import re
 from os import getenv
-from typing import Dict, List, Any, Optional, Callable, Tuple, Union
-from collections import defaultdict
-from time import strftime, localtime, time
+from typing import Dict, List, Any, Optional, Callable, Tuple, Union, Awaitable
+from functools import partial
+from time import time, monotonic
 from secrets import compare_digest
 from yaml import safe_load as yamload, YAMLError
 
 from fastapi import Depends, FastAPI, HTTPException, status, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.logger import logger
 from pydantic import BaseModel, ValidationError
 
+from api_cache import TTLCache, SingleFlight
+from api_formatting import (
+    GraphSnapshot,
+    Topology,
+    aggregate_links,
+    format_nodes,
+    format_links,
+    format_raw_stats,
+    format_rollups,
+    merge_topology_changes,
+    utilization_overlay,
+)
+
+# Read routes use the async db layer (the others are sync & run in the threadpool)
+import db_layer_async as async_db
 from db_layer import (
-    get_stats_devices,
     get_all_nodes,
-    get_nodes_by_patterns,
-    get_all_links,
-    get_links_by_patterns,
-    get_links_device,
-    get_utilizations_device,
-    get_all_highest_utilizations,
-    get_all_speeds,
     get_node,
     add_node,
     add_link,
@@ -48,6 +56,7 @@ from db_layer import (
     delete_link,
     disable_node,
 )
+from topology_changes import record_topology_changes
 
 app: FastAPI = FastAPI()
 
@@ -73,10 +82,35 @@ API_PASS: str = getenv("API_PASS", "pass")
 
 security: HTTPBasic = HTTPBasic()  # to do: Needs better security
 
-CACHE: Dict[str, Any] = {}
-CACHED_TIME: int = 300
-TIME: int = int(time())
-CACHED_TIMEOUT: Dict[str, bool] = {}
+# Bounded (entries & memory) LRU cache whose entries expire on their own
+CACHE: TTLCache = TTLCache()
+# Db calls of the entries being (re)loaded, shared by the concurrent requests
+LOADING: SingleFlight = SingleFlight()
+
+# Snapshots of the whole graph, rebuilt in the background: the topology (nodes
+# & links) every TOPOLOGY_REFRESH_INTERVAL seconds or when it is changed through
+# the api, the utilizations of the links every UTILIZATION_REFRESH_INTERVAL
+# seconds (0 to only build them on demand)
+TOPOLOGY_REFRESH_INTERVAL: float = float(getenv("TOPOLOGY_REFRESH_INTERVAL", "600"))
+UTILIZATION_REFRESH_INTERVAL: float = float(getenv("UTILIZATION_REFRESH_INTERVAL", "15"))
+# Snapshots older than this (seconds) are rebuilt by the requests themselves:
+# without background refresh (or if it is stuck) they would never change
+GRAPH_MAX_AGE: float = float(
+    getenv("GRAPH_MAX_AGE", str(max(4 * UTILIZATION_REFRESH_INTERVAL, 60)))
+)
+# Max delay (seconds) between retries of a topology refresh that failed
+GRAPH_RETRY_MAX_DELAY: float = 60
+SNAPSHOT: Optional[GraphSnapshot] = None
+GRAPH_LOOP: Optional[asyncio.AbstractEventLoop] = None
+GRAPH_CHANGED: Optional[asyncio.Event] = None
+GRAPH_REFRESHER: Optional["asyncio.Future[None]"] = None
+
+# Time span (seconds) of the stats returned when no start is asked
+STATS_DEFAULT_SPAN: int = int(getenv("STATS_DEFAULT_SPAN", str(7 * 86400)))
+# Resolution (seconds, 0 for raw samples) used up to a time span:
+# roughly a few thousands points per iface whatever the span
+STATS_RESOLUTIONS: Tuple[Tuple[int, int], ...] = ((86400, 0), (14 * 86400, 300))
+STATS_RESOLUTION_NAMES: Dict[str, int] = {"raw": 0, "5m": 300, "1h": 3600}
 
 
 class Node(BaseModel):
@@ -140,41 +174,30 @@ def check_credentials(
     return credentials
 
 
-def get_from_db_or_cache(
-    element: str, func: Optional[Callable[..., Any]] = None, query: Union[str, List[str]] = ""
+async def get_from_db_or_cache(
+    element: str,
+    func: Optional[Callable[..., Awaitable[Any]]] = None,
+    query: Union[str, List[str]] = "",
 ) -> Any:
-    """Cache most db calls if they are not already cached.
-    Also handles a timeout to retrieve from db from time to time"""
-    global CACHE, CACHED_TIMEOUT
-
-    timeout: bool = False
-    if CACHED_TIMEOUT.get(element):
-        timeout = CACHED_TIMEOUT[element]
+    """Cache most (async) db calls if they are not already cached
+    (or their entry expired). Only one db call per element runs at a
+    time, concurrent requests missing the same element wait for it"""
+    value: Any = CACHE.get(element)
 
-    if not CACHE.get(element) or timeout:
+    if not value:
         if not func:
             return None
-        logger.error(f"Oops, {element} not in cache, calling db")
-        if query:
-            CACHE[element] = func(query)
-        else:
-            CACHE[element] = func()
-        CACHED_TIMEOUT[element] = False
+        load_func: Callable[..., Awaitable[Any]] = func
 
-    return CACHE[element]
+        async def load() -> Any:
+            logger.error(f"Oops, {element} not in cache, calling db")
+            loaded: Any = await (load_func(query) if query else load_func())
+            CACHE.set(element, loaded)
+            return loaded
 
+        value = await LOADING.do(element, load)
 
-def background_time_update() -> None:
-    """Updates timeout so we know if we
-    have to discard cached datas and retrieve from db again"""
-    global CACHED_TIMEOUT, TIME
-    now: int = int(time())
-    # logger.error(f"bgtimeupd: {now}, {TIME}, {CACHED_TIMEOUT}")
-    if now - TIME > CACHED_TIME:
-        TIME = now
-        for elem in CACHED_TIMEOUT:
-            CACHED_TIMEOUT[elem] = True
-    # logger.error(f"bgtimeupdEnd: {now}, {TIME}, {CACHED_TIMEOUT}")
+    return value
 
 
 def add_static_node_to_db(node: Node, neigh_infos: Optional[List[Neighbor]] = None) -> None:
@@ -205,64 +228,131 @@ def add_static_node_to_db(node: Node, neigh_infos: Optional[List[Neighbor]] = No
             add_fake_iface_utilization(node.name, iface)
 
 
-def try_to_deduce_grouping(groups_known: Dict[str, int], node_name: str) -> Tuple[int, int]:
-    """Tries to find to which groups the node should be affected
-    groupx is conditioned by the function of the device (if it's a core device
-    for example) and groupy is conditioned by its localisation.
-
-    Depending on your device naming, the regex should be modified"""
-
-    # Exemple for a device named sw1.iou
-    # We assume that 'sw' is the function and '1' its localisation (yeah
-    # not really a localisation but well, it's an example ;-) )
-    regex_pattern: re.Pattern[str] = re.compile(  # pylint: disable=unsubscriptable-object
-        "^([a-z]{2})([0-9]+).*", re.IGNORECASE
-    )  # pylint: disable=unsubscriptable-object
-    matched: Optional[re.Match[str]] = regex_pattern.match(
-        node_name
-    )  # pylint: disable=unsubscriptable-object
-    if not matched:
-        # It may be a "fake" node with a "fake" name:
-        regex_pattern = re.compile("^fake_device_stage([0-9]+)_([0-9]+)$", re.IGNORECASE)
-        matched = regex_pattern.match(node_name)
-        if matched:
-            # matched.group(2) could be used but it doesn't make sense right now since
-            # d3.js 'force' handle it for those test devices which are at the 'same localisation'
-            return (int(matched.group(1)), 1)
-        # Unknown device, we push it to the right end of the graph
-        return (7, 1)
-    device_function: str = matched.group(1)
-    device_localisation: str = matched.group(2)
-
-    groupx: int = 1
-    groupy: int = 1
-    if not groups_known:
-        groups_known["sw"] = 1
-        groups_known["rtr"] = 2
-        groups_known["groupy"] = 1
-
-    try:
-        groupx = groups_known[device_function]
-    except KeyError:
-        # Unknown device function
-        return (7, 1)
-
-    try:
-        groupy = groups_known[device_localisation]
-    except KeyError:
-        groupy = groups_known["groupy"]
-        groups_known[device_localisation] = groupy
-        groups_known["groupy"] += 1
-
-    return (groupx, groupy)
+async def build_graph(dpat: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """Builds the graph of the nodes matching the patterns
+    from db, its queries are run concurrently"""
+    nodes, links, utilizations, speeds = await asyncio.gather(
+        async_db.get_nodes_by_patterns(dpat),
+        async_db.get_links_by_patterns(dpat),
+        async_db.get_all_highest_utilizations(),
+        async_db.get_all_speeds(),
+    )
+    formatted_links: Dict[str, Dict[str, Any]] = format_links(links, utilizations, speeds, dpat)
+    return {"nodes": format_nodes(list(nodes)), "links": list(formatted_links.values())}
+
+
+async def refresh_utilizations(topology: Topology) -> GraphSnapshot:
+    """Computes the utilization overlay of the links of the topology & the
+    graph with these utilizations. Both are built aside & swapped in at once"""
+    global SNAPSHOT
+    utilizations, speeds = await asyncio.gather(
+        async_db.get_all_highest_utilizations(), async_db.get_all_speeds()
+    )
+    overlay: Dict[str, Dict[str, Any]] = utilization_overlay(topology.members, utilizations, speeds)
+    current: Optional[GraphSnapshot] = SNAPSHOT
+    if current is not None and topology.version < current.topology.version:
+        # A newer topology was swapped in meanwhile (with its own utilizations)
+        return current
+    graph: Dict[str, Any] = {
+        "version": topology.version,
+        "nodes": topology.nodes,
+        "links": [{**link, **overlay[link["id"]]} for link in topology.links],
+    }
+    SNAPSHOT = GraphSnapshot(
+        topology, {"version": topology.version, "links": overlay}, graph, monotonic()
+    )
+    return SNAPSHOT
+
+
+async def refresh_topology() -> GraphSnapshot:
+    """Builds a new snapshot of the topology (& its utilizations) aside &
+    swaps it in once complete (requests never see a partial graph). Its
+    version is the one of the db when the snapshot started, so the changes
+    made meanwhile are also listed by /graph/changes?since=version"""
+    version: int = await async_db.get_topology_version()
+    nodes, links = await asyncio.gather(async_db.get_all_nodes(), async_db.get_all_links())
+    formatted_links, members = aggregate_links(links)
+    topology: Topology = Topology(
+        version, format_nodes(list(nodes)), list(formatted_links.values()), members
+    )
+    return await refresh_utilizations(topology)
+
+
+async def current_snapshot() -> GraphSnapshot:
+    """Last graph snapshot, only built by the request when there is
+    none yet or when the last one is older than GRAPH_MAX_AGE"""
+    snapshot: Optional[GraphSnapshot] = SNAPSHOT
+    if snapshot is None or monotonic() - snapshot.built > GRAPH_MAX_AGE:
+        snapshot = await LOADING.do("topology", refresh_topology)
+    assert snapshot is not None  # nosec
+    return snapshot
+
+
+async def refresh_graph_forever() -> None:
+    """Refreshes the utilizations every UTILIZATION_REFRESH_INTERVAL seconds
+    & the topology every TOPOLOGY_REFRESH_INTERVAL seconds, as soon as
+    it is changed through the api or when the version of the db moved"""
+    assert GRAPH_CHANGED is not None  # nosec
+    next_topology: float = 0.0
+    failures: int = 0
+    while True:
+        try:
+            topology: Optional[Topology] = SNAPSHOT.topology if SNAPSHOT is not None else None
+            refresh: bool = GRAPH_CHANGED.is_set() or monotonic() >= next_topology
+            if topology is not None and not refresh:
+                # Topology changed by the LLDP scrapper (or another api process)
+                refresh = await async_db.get_topology_version() != topology.version
+            if refresh or topology is None:
+                GRAPH_CHANGED.clear()
+                await LOADING.do("topology", refresh_topology)
+                next_topology = monotonic() + TOPOLOGY_REFRESH_INTERVAL
+            else:
+                await LOADING.do("utilizations", partial(refresh_utilizations, topology))
+            failures = 0
+        except Exception as err:  # pylint: disable=broad-except
+            # The previous snapshots keep being served. A topology refresh
+            # that failed is retried after a delay doubled at each failure
+            failures += 1
+            next_topology = max(
+                next_topology, monotonic() + min(2 ** failures, GRAPH_RETRY_MAX_DELAY)
+            )
+            logger.error(f"Can't refresh the graph: {err}")
+        try:
+            await asyncio.wait_for(
+                GRAPH_CHANGED.wait(),
+                max(min(UTILIZATION_REFRESH_INTERVAL, next_topology - monotonic()), 0),
+            )
+        except asyncio.TimeoutError:
+            pass
+
+
+@app.on_event("startup")
+async def start_graph_refresher() -> None:
+    """Starts the background refresh of the graph"""
+    global GRAPH_LOOP, GRAPH_CHANGED, GRAPH_REFRESHER
+    if UTILIZATION_REFRESH_INTERVAL <= 0:
+        return
+    GRAPH_LOOP = asyncio.get_event_loop()
+    GRAPH_CHANGED = asyncio.Event()
+    GRAPH_REFRESHER = asyncio.ensure_future(refresh_graph_forever())
+
+
+def graph_changed() -> None:
+    """Signals a topology change made through the api (from any thread): the
+    refresher rebuilds the topology, without refresher the snapshots are dropped"""
+    global SNAPSHOT
+    if GRAPH_LOOP is not None and GRAPH_CHANGED is not None:
+        GRAPH_LOOP.call_soon_threadsafe(GRAPH_CHANGED.set)
+    else:
+        SNAPSHOT = None
 
 
 @app.get("/graph")
-# pylint: disable=too-many-locals,too-many-branches,too-many-statements
-def get_graph(dpat: Optional[List[str]] = Query(None)) -> Dict[str, List[Dict[str, Any]]]:
+async def get_graph(dpat: Optional[List[str]] = Query(None)) -> Dict[str, Any]:
     """Returns the entire graph composed of nodes & links such as:
             "links": [
                 {
+                    "id": "deviceNamedeviceName-2",
                     "highest_utilization": 0.0,
                     "source": "deviceName",
                     "source_interfaces": [
@@ -284,186 +374,132 @@ def get_graph(dpat: Optional[List[str]] = Query(None)) -> Dict[str, List[Dict[st
                         image: "default.png",
                     },
                     {}]
+            "version": 1,
             }
 
 
     Graph shouldn't be updated very much
     However, "highest_utilization" must be updated each time the API is called
      with fresh "stats" values (so the frontend can colorize links accordingly).
+    Clients refreshing only the colors of the links should rather poll
+    /graph/utilizations (& /graph/topology when its version changes)
     """
 
-    background_time_update()
-    # logger.error(f"Caching timeout : {TIMEOUT}")
-
-    # start_nodes_timer = time()
-    nodes: List[Dict[str, Any]] = []
-    if isinstance(dpat, list):
-        nodes = get_from_db_or_cache(f"nodes{dpat}")
-    else:
-        nodes = get_from_db_or_cache("nodes")
-    if not nodes:
-        if isinstance(dpat, list):
-            nodes = list(get_from_db_or_cache(f"nodes{str(dpat)}", get_nodes_by_patterns, dpat))
-        else:
-            nodes = get_from_db_or_cache("nodes", get_all_nodes)
-
-        groups: Dict[str, int] = {}
-
-        for node in nodes:
-            if (
-                not node.get("groupx")
-                or not node.get("groupy")
-                or (node["groupx"] == 11 and node["groupy"] == 11)
-            ):
-
-                node["groupx"], node["groupy"] = try_to_deduce_grouping(groups, node["device_name"])
-
-            node["id"] = node["device_name"]
-            del node["device_name"]
-            node["image"] = "router.png"
-
-    # logger.error(f"Nodes timer End: {time() - start_nodes_timer}")
-
-    # start_format_timer = time()
-
-    formatted_links: Dict[str, Any] = {}
     if isinstance(dpat, list):
-        formatted_links = get_from_db_or_cache(f"formatted_links{dpat}")
-    else:
-        formatted_links = get_from_db_or_cache("formatted_links")
-    highest_uses: Dict[str, int] = defaultdict(int)
-    if not formatted_links:
-        links: List[Dict[str, Any]] = []
-        if isinstance(dpat, list):
-            links = get_from_db_or_cache(f"links{str(dpat)}", get_links_by_patterns, dpat)
-        else:
-            links = get_from_db_or_cache("links", get_all_links)
-        sorted_links: List[Dict[str, Any]] = sorted(
-            links, key=lambda d: (d["device_name"], d["neighbor_name"])
+        # Graphs of patterns are cached like the other db calls
+        graph: Dict[str, Any] = await get_from_db_or_cache(f"graph{dpat}", build_graph, dpat)
+        return graph
+
+    # The whole graph is served from the last snapshots (with the version of its topology)
+    return (await current_snapshot()).graph
+
+
+@app.get("/graph/topology")
+async def get_topology() -> Dict[str, Any]:
+    """Returns the nodes & links of the graph (as /graph but without the
+    utilization & speed of the links) & the version of this topology.
+    Meant to be cached by clients & refreshed when the version of
+    /graph/utilizations changes"""
+    topology: Topology = (await current_snapshot()).topology
+    return {"version": topology.version, "nodes": topology.nodes, "links": topology.links}
+
+
+@app.get("/graph/utilizations")
+async def get_utilizations() -> Dict[str, Any]:
+    """Returns only the highest utilization (percent) & speed of
+    each link of the graph by link id, such as:
+        {
+            "version": 3,
+            "links": {
+                "deviceNamedeviceName-2": {"highest_utilization": 12.5, "speed": 1000000000},
+            }
+        }
+    version is the one of the topology these links belong to"""
+    return (await current_snapshot()).utilizations
+
+
+@app.get("/graph/changes")
+async def graph_changes(since: int = Query(..., ge=0)) -> Dict[str, Any]:
+    """Returns the nodes (names) & links (device_name, iface_name, neighbor_name
+    & neighbor_iface) added, updated & removed since a topology version
+    (the version of /graph/topology or of a previous call) such as:
+        {
+            "since": 3,
+            "version": 5,
+            "resync": false,
+            "nodes": {"added": ["deviceName-3"], "updated": [], "removed": []},
+            "links": {"added": [{"device_name": "deviceName", ...}], "updated": [], "removed": []},
+        }
+    resync is true when the changes since this version are not kept
+    anymore: the whole topology must be fetched again"""
+    versions: List[Dict[str, Any]]
+    oldest: Optional[int]
+    current: int
+    versions, oldest, current = await asyncio.gather(
+        async_db.get_topology_changes(since),
+        async_db.get_oldest_topology_version(),
+        async_db.get_topology_version(),
+    )
+    # Versions are allocated by the insert of their changes: a missing one
+    # (expired or lost by an older writer) can't be listed anymore
+    version: int = versions[-1]["version"] if versions else since
+    if (
+        since > current
+        or (oldest is None and since < current)
+        or (oldest or 0) > since + 1
+        or version - since != len(versions)
+    ):
+        return {"since": since, "version": current, "resync": True}
+
+    return {"since": since, "version": version, "resync": False, **merge_topology_changes(versions)}
+
+
+def pick_resolution(span: int) -> int:
+    """Resolution of the stats for a time span"""
+    for max_span, resolution in STATS_RESOLUTIONS:
+        if span <= max_span:
+            return resolution
+    return 3600
+
+
+async def get_stats_by_device(
+    devices: List[str], start: Optional[int], end: Optional[int], resolution: Optional[str]
+) -> Dict[str, Dict[str, Any]]:
+    """Stats of the devices at the asked resolution (or the one fitting
+    the time span). Devices without aggregates (polled before they were
+    computed) get their raw samples"""
+    end_timestamp: int = end if end is not None else int(time())
+    start_timestamp: int = start if start is not None else end_timestamp - STATS_DEFAULT_SPAN
+    step: int = (
+        STATS_RESOLUTION_NAMES[resolution]
+        if resolution
+        else pick_resolution(end_timestamp - start_timestamp)
+    )
+    stats_by_device: Dict[str, Dict[str, Any]] = {}
+    if step:
+        stats_by_device = format_rollups(
+            await async_db.get_rollups_devices(devices, step, start_timestamp, end)
         )
-        formatted_links = {}
-
-        utilizations: Dict[str, int] = get_from_db_or_cache(
-            "utilizations", get_all_highest_utilizations
+    missing: List[str] = [device for device in devices if device not in stats_by_device]
+    if missing:
+        stats_by_device.update(
+            format_raw_stats(await async_db.get_stats_devices(missing, start_timestamp, end))
         )
-        speeds: Dict[str, int] = get_from_db_or_cache("speeds", get_all_speeds)
-
-        # logger.error("Utilizations: " + str(utilizations))
-        # logger.error("Speeds: " + str(speeds))
-
-        logger.error(f"Nb links to format:{len(sorted_links)}")
-        for link in sorted_links:
-            device: str = link["device_name"]
-            iface: str = str(link["iface_name"])
-            neigh: str = link["neighbor_name"]
-            if isinstance(dpat, list):
-                if not any(device_pattern in neigh for device_pattern in dpat):
-                    continue
-            neigh_iface: str = str(link["neighbor_iface"])
-            if not device or not iface or not neigh or not neigh_iface:
-                # Discard possible null ifaces
-                logger.error(f"WARNING: Link discarded : {link}")
-                continue
-
-            id_link: str = device + neigh
-            id_link_neigh: str = neigh + device
-
-            try:
-                speed: int = speeds[device + iface]  # "speed" in snmp terms
-                # is actually the max speed of the iface
-                speed = speed * 1000000  # Convert speed to bits
-                highest_utilization: int = utilizations[device + iface]
-                percent_highest: float = highest_utilization / speed * 100
-                if percent_highest > 100:
-                    print(device, iface, speed, highest_utilization, percent_highest)
-                    percent_highest = 0
-            except KeyError:
-                speed = 1000000  # Can't determine speed
-                highest_utilization = 0  # Can't determine utilization
-                percent_highest = 0.0
-                logger.error(f"Cant find speed for {device+iface} in {speeds}")
-
-            if not formatted_links.get(id_link) and not formatted_links.get(id_link_neigh):
-
-                f_link: Dict[str, Any] = {
-                    "highest_utilization": percent_highest,
-                    "source": device,
-                    "source_interfaces": [iface],
-                    "speed": speed,
-                    "target": neigh,
-                    "target_interfaces": [neigh_iface],
-                    "linknum": 1,
-                }
-                formatted_links[id_link] = f_link
-                highest_uses[id_link] = highest_utilization
-            else:
-                if formatted_links.get(id_link_neigh):
-                    id_link, id_link_neigh = id_link_neigh, id_link
-                    iface, neigh_iface = neigh_iface, iface
-
-                if iface not in formatted_links[id_link]["source_interfaces"]:
-                    formatted_links[id_link]["source_interfaces"].append(iface)
-                else:
-                    continue
-                if neigh_iface not in formatted_links[id_link]["target_interfaces"]:
-                    formatted_links[id_link]["target_interfaces"].append(neigh_iface)
-                else:
-                    continue
-
-                # Since 1 (visual) link will aggregate multiple (actual) links
-                # we recalculate utilization/speed for the aggregated (visual) link
-                highest_uses[id_link] += highest_utilization
-                formatted_links[id_link]["speed"] = formatted_links[id_link]["speed"] + speed
-
-                highest_utilization = highest_uses[id_link]
-                speed = formatted_links[id_link]["speed"]
-                percent_highest = highest_utilization / speed * 100
-                if percent_highest > 100:
-                    print(device, iface, speed, highest_utilization, percent_highest)
-                    percent_highest = 0
-
-                formatted_links[id_link]["highest_utilization"] = percent_highest
-
-                # If we want to dissociate agg link into multilinks
-                # We have to handle "linknum"
-                # But for clarity on large topologies, this is commented out
-                # try:
-                #    f_link_2 = formatted_links[id_link].copy()
-                #    linknum = len(f_link_2["source_interfaces"])
-                #    id_link_2 = id_link + str(linknum)
-                # except KeyError:
-                #    f_link_2 = formatted_links[id_link_neigh].copy()
-                #    linknum = len(f_link_2["source_interfaces"])
-                #    id_link_2 = id_link_neigh + str(linknum)
-
-                # if linknum > 1:
-                #    f_link_2["linknum"] = linknum
-                #    f_link_2["highest_utilization"] = percent_highest
-                #    f_link_2["speed"] = speed
-                #    formatted_links[id_link_2] = f_link_2
-
-        # logger.error(formatted_links)
-        # logger.error(f"Format links End: {time() - start_format_timer}")
-
-        global CACHE, CACHED_TIMEOUT
-        if dpat:
-            CACHE[f"formatted_links{dpat}"] = formatted_links
-            CACHE[f"nodes{dpat}"] = nodes
-        else:
-            CACHE["formatted_links"] = formatted_links
-            CACHE["nodes"] = nodes
-        CACHED_TIMEOUT["formatted_links"] = False
-        CACHED_TIMEOUT["nodes"] = False
-
-    return {"nodes": nodes, "links": list(formatted_links.values())}
+    return stats_by_device
 
 
 @app.get("/stats/")
-def stats(  # pylint: disable=too-many-locals
+async def stats(
     devices: List[str] = Query(None),
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    resolution: Optional[str] = None,
 ) -> Dict[str, Dict[str, Dict[str, Any]]]:
     """Returns all the stats of one or more
-    devices
+    devices between start & end timestamps (default: the last
+    STATS_DEFAULT_SPAN seconds). Raw samples or 5m/1h aggregates
+    are returned depending on the span (or the asked resolution).
+    Aggregates also have InMin, InMax, OutMin & OutMax
     {
         "ifDescr": "Ethernet0/0",
         "index": 1,
@@ -476,8 +512,6 @@ def stats(  # pylint: disable=too-many-locals
         ]
     }
     """
-    background_time_update()
-
     if isinstance(devices, list):
         # Validate incoming query
         for device in devices:
@@ -487,72 +521,17 @@ def stats(  # pylint: disable=too-many-locals
             #    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
             # if "iou" not in device:
             #    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
+        if resolution is not None and resolution not in STATS_RESOLUTION_NAMES:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
 
         # Not todo anymore :P if LEN stats_by_device = 2
         # -> find ifaces between the 2 devices to return only that
         # Would be needed if we disaggregated links again
 
-        stats_by_device: Dict[str, Any] = get_from_db_or_cache(f"stats_by_device_{devices}")
-
-        if not stats_by_device:
-
-            stats_by_device = {}
-
-            sorted_stats: List[Dict[str, Any]] = sorted(
-                get_stats_devices(devices),
-                key=lambda d: (d["device_name"], d["iface_name"], d["timestamp"]),
-            )
-            prev_inbits: int = 0
-            prev_outbits: int = 0
-            prev_timestamp: int = 0
-            for stat in sorted_stats:
-                dname: str = stat["device_name"]
-                # ifname = stat["iface_name"].replace("Ethernet", "Et")
-                ifname: str = stat["iface_name"]
-                dbtime: int = stat["timestamp"]
-                inttimestamp: int = int(dbtime)
-                timestamp: str = strftime("%y-%m-%d %H:%M:%S", localtime(inttimestamp))
-                stat_formatted: Dict[str, Any] = {"InSpeed": 0, "OutSpeed": 0, "time": timestamp}
-                inbits: int = int(stat["in_bytes"]) * 8
-                outbits: int = int(stat["out_bytes"]) * 8
-                # This iface wasn't in the struct.
-                # We add default infos (and speed to 0 since
-                # we don't know at how much speed it was before)
-                if not stats_by_device.get(dname):
-                    stats_by_device[dname] = {
-                        ifname: {"ifDescr": ifname, "index": ifname, "stats": [stat_formatted]}
-                    }
-                elif not stats_by_device[dname].get(ifname):
-                    stats_by_device[dname][ifname] = {
-                        "ifDescr": ifname,
-                        "index": ifname,
-                        "stats": [stat_formatted],
-                    }
-                else:
-                    # Must calculate speed. Not just adding in_bytes or it will only increase.
-                    # prev_date = stats_by_device[dname][ifname]["stats"][-1]["time"]
-                    # prev_timestamp: int = int(
-                    #    datetime.strptime(prev_date, "%y-%m-%d %H:%M:%S").timestamp()
-                    # )
-
-                    interval: int = inttimestamp - prev_timestamp
-                    if interval > 0:
-                        in_speed: int = inbits - prev_inbits
-                        in_speed = in_speed if in_speed >= 0 else -in_speed
-                        out_speed: int = outbits - prev_outbits
-                        out_speed = out_speed if out_speed >= 0 else -out_speed
-                        stat_formatted["InSpeed"] = int(in_speed / interval)
-                        stat_formatted["OutSpeed"] = int(out_speed / interval)
-
-                    stats_by_device[dname][ifname]["stats"].append(stat_formatted)
-
-                prev_inbits = inbits
-                prev_outbits = outbits
-                prev_timestamp = inttimestamp
-
-            global CACHE, CACHED_TIMEOUT
-            CACHE[f"stats_by_device_{devices}"] = stats_by_device
-            CACHED_TIMEOUT[f"stats_by_device_{devices}"] = False
+        cache_key: str = f"stats_by_device_{devices}_{start}_{end}_{resolution}"
+        stats_by_device: Dict[str, Any] = await get_from_db_or_cache(
+            cache_key, partial(get_stats_by_device, devices, start, end, resolution)
+        )
 
         return stats_by_device
     raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
@@ -560,7 +539,7 @@ def stats(  # pylint: disable=too-many-locals
 
 @app.get("/neighborships/")
 # Leveraging query string validation built in FastApi to avoid having multiple IFs
-def neighborships(
+async def neighborships(
     device: str = Query(..., min_length=1, max_length=100)  # , regex="^[a-z]{2,3}[0-9]{1}.iou$")
 ) -> List[Dict[str, str]]:
     """Returns all neighbors of a specific node.
@@ -574,12 +553,10 @@ def neighborships(
                 "deviceName2" :[],
     }
     """
-    background_time_update()
-
     if not isinstance(device, str):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
 
-    neighs: List[Dict[str, str]] = get_from_db_or_cache(f"neighs_{device}")
+    neighs: List[Dict[str, str]] = await get_from_db_or_cache(f"neighs_{device}")
 
     if not neighs:
 
@@ -587,7 +564,7 @@ def neighborships(
         # The end goal is to return only its values, not keys
         neighs_dict: Dict[str, Dict[str, str]] = {}
 
-        for link in get_links_device(device):
+        for link in await async_db.get_links_device(device):
 
             device1: str = link["device_name"]
             device2: str = link["neighbor_name"]
@@ -611,9 +588,7 @@ def neighborships(
             }
 
         neighs = list(neighs_dict.values())
-        global CACHE, CACHED_TIMEOUT
-        CACHE[f"neighs_{device}"] = neighs
-        CACHED_TIMEOUT[f"neighs_{device}"] = False
+        CACHE.set(f"neighs_{device}", neighs)
 
     return neighs
 
@@ -634,6 +609,8 @@ def delete_node_by_fqdn(
 
     delete_node(node_name_or_ip)
 
+    graph_changed()
+
     return {"response": "Ok"}
 
 
@@ -668,11 +645,13 @@ def add_static_node(
 
     add_static_node_to_db(node, node_neighbors)
 
+    graph_changed()
+
     return {"response": "Ok"}
 
 
 @app.get("/node/{node}")
-def get_node_infos(
+async def get_node_infos(
     node: str,
     credentials: HTTPBasicCredentials = Depends(
         check_credentials
@@ -681,11 +660,17 @@ def get_node_infos(
     """Gets all infos about a specific node (useful
     for debugging)"""
 
+    details, neighs, node_stats, utilizations = await asyncio.gather(
+        async_db.get_node(node),
+        async_db.get_links_device(node),
+        async_db.get_stats_devices([node]),
+        async_db.get_utilizations_device(node),
+    )
     node_infos: Dict[str, Any] = {
-        "node_details": get_node(node),
-        "node_neighs": list(get_links_device(node)),
-        "node_stats": get_stats_devices([node]),
-        "node_links_utilizations": get_utilizations_device(node),
+        "node_details": details,
+        "node_neighs": neighs,
+        "node_stats": node_stats,
+        "node_links_utilizations": utilizations,
     }
 
     logger.error(node_infos)
@@ -722,6 +707,8 @@ def add_nodes_list_to_poll(
     for node in nodes:
         add_node(node)
 
+    graph_changed()
+
     return {"response": "Ok"}
 
 
@@ -742,6 +729,8 @@ def delete_nodes_list(
     for node in nodes:
         delete_node(node)
 
+    graph_changed()
+
     return {"response": "Ok"}
 
 
@@ -775,6 +764,9 @@ def add_links(
             link.iface_descr_node1,
             link.iface_descr_node2,
         )
+
+    graph_changed()
+
     return {"response": "Ok"}
 
 
@@ -806,9 +798,49 @@ def delete_links(
             link.iface_id_node1,
             link.iface_id_node2,
         )
+
+    graph_changed()
+
     return {"response": "Ok"}
 
 
+def add_fabric_to_db(fabric: Fabric) -> None:
+    """Adds (or updates) the nodes & links of a fabric. Their changes are
+    recorded together (one topology version instead of one per node & link)"""
+    changes: List[Dict[str, Any]] = []
+    for node in fabric.nodes:
+        changes += add_node(
+            node.name,
+            node.groupx,
+            node.groupy,
+            node.image,
+            node.system_description,
+            node.to_poll,
+            record=False,
+        )
+    for link in fabric.links:
+        changes += add_link(
+            link.name_node1,
+            link.name_node2,
+            link.iface_id_node1,
+            link.iface_id_node2,
+            link.iface_descr_node1,
+            link.iface_descr_node2,
+            record=False,
+        )
+    if changes:
+        record_topology_changes(changes)
+
+
+def delete_fabric_from_db(fabric: Fabric) -> None:
+    """Deletes the nodes of a fabric, their changes recorded together"""
+    changes: List[Dict[str, Any]] = []
+    for node in fabric.nodes:
+        changes += delete_node(node.name, record=False)
+    if changes:
+        record_topology_changes(changes)
+
+
 @app.post(
     "/fabric",
     openapi_extra={
@@ -839,19 +871,10 @@ async def add_fabric(
     except ValidationError as validationerr:
         raise HTTPException(status_code=422, detail=validationerr.errors()) from validationerr
 
-    for node in fabric.nodes:
-        add_node(
-            node.name, node.groupx, node.groupy, node.image, node.system_description, node.to_poll
-        )
-    for link in fabric.links:
-        add_link(
-            link.name_node1,
-            link.name_node2,
-            link.iface_id_node1,
-            link.iface_id_node2,
-            link.iface_descr_node1,
-            link.iface_descr_node2,
-        )
+    # Sync db layer: run in the threadpool so other requests are served meanwhile
+    await run_in_threadpool(add_fabric_to_db, fabric)
+    graph_changed()
+
     return {"response": "Ok"}
 
 
@@ -885,8 +908,9 @@ async def delete_fabric(
     except ValidationError as validationerr:
         raise HTTPException(status_code=422, detail=validationerr.errors()) from validationerr
 
-    for node in fabric.nodes:
-        delete_node(node.name)
+    await run_in_threadpool(delete_fabric_from_db, fabric)
+    graph_changed()
+
     return {"response": "Ok"}
 
 
@@ -919,6 +943,12 @@ def healthz() -> Dict[str, str]:
     return {"response": "Ok"}
 
 
+@app.get("/cache_stats")
+def cache_stats() -> Dict[str, Any]:
+    """Size & hit/miss counters of the api cache"""
+    return {**CACHE.info(), "coalesced": LOADING.coalesced}
+
+
 gunicorn_logger = logging.getLogger("gunicorn.info")
 logger.handlers = gunicorn_logger.handlers
 logger.setLevel(gunicorn_logger.level)
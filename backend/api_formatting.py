@@ -0,0 +1,325 @@
+"""Formatting of the db documents into what the frontend expects:
+nodes (with their groups), links aggregated per couple of nodes
+& their utilization overlay, topology changes & stats of the ifaces."""
+#! /usr/bin/env python3
+# pylint: disable=logging-fstring-interpolation
+
+import re
+from functools import lru_cache
+from time import strftime, localtime
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from fastapi.logger import logger
+
+from topology_changes import LINK_KEYS
+
+# Rates stored with each raw sample by the stats scrapper & their names in /stats/
+STATS_RATES_NAMES: Tuple[Tuple[str, str], ...] = (
+    ("in_pps", "InPps"),
+    ("out_pps", "OutPps"),
+    ("in_errors_ps", "InErrors"),
+    ("out_errors_ps", "OutErrors"),
+    ("in_discards_ps", "InDiscards"),
+    ("out_discards_ps", "OutDiscards"),
+)
+
+
+def try_to_deduce_grouping(groups_known: Dict[str, int], node_name: str) -> Tuple[int, int]:
+    """Tries to find to which groups the node should be affected
+    groupx is conditioned by the function of the device (if it's a core device
+    for example) and groupy is conditioned by its localisation.
+
+    Depending on your device naming, the regex should be modified"""
+
+    # Exemple for a device named sw1.iou
+    # We assume that 'sw' is the function and '1' its localisation (yeah
+    # not really a localisation but well, it's an example ;-) )
+    regex_pattern: re.Pattern[str] = re.compile(  # pylint: disable=unsubscriptable-object
+        "^([a-z]{2})([0-9]+).*", re.IGNORECASE
+    )  # pylint: disable=unsubscriptable-object
+    matched: Optional[re.Match[str]] = regex_pattern.match(
+        node_name
+    )  # pylint: disable=unsubscriptable-object
+    if not matched:
+        # It may be a "fake" node with a "fake" name:
+        regex_pattern = re.compile("^fake_device_stage([0-9]+)_([0-9]+)$", re.IGNORECASE)
+        matched = regex_pattern.match(node_name)
+        if matched:
+            # matched.group(2) could be used but it doesn't make sense right now since
+            # d3.js 'force' handle it for those test devices which are at the 'same localisation'
+            return (int(matched.group(1)), 1)
+        # Unknown device, we push it to the right end of the graph
+        return (7, 1)
+    device_function: str = matched.group(1)
+    device_localisation: str = matched.group(2)
+
+    groupx: int = 1
+    groupy: int = 1
+    if not groups_known:
+        groups_known["sw"] = 1
+        groups_known["rtr"] = 2
+        groups_known["groupy"] = 1
+
+    try:
+        groupx = groups_known[device_function]
+    except KeyError:
+        # Unknown device function
+        return (7, 1)
+
+    try:
+        groupy = groups_known[device_localisation]
+    except KeyError:
+        groupy = groups_known["groupy"]
+        groups_known[device_localisation] = groupy
+        groups_known["groupy"] += 1
+
+    return (groupx, groupy)
+
+
+def format_nodes(nodes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Nodes of the db as the frontend expects them (id, image & groups)"""
+    groups: Dict[str, int] = {}
+
+    for node in nodes:
+        if (
+            not node.get("groupx")
+            or not node.get("groupy")
+            or (node["groupx"] == 11 and node["groupy"] == 11)
+        ):
+
+            node["groupx"], node["groupy"] = try_to_deduce_grouping(groups, node["device_name"])
+
+        node["id"] = node["device_name"]
+        del node["device_name"]
+        node["image"] = "router.png"
+
+    return nodes
+
+
+class Topology(NamedTuple):
+    """Snapshot of the nodes & (visual) links of the graph & its version
+    in db. Members are the ifaces (device_name + iface_name) aggregated
+    into each link"""
+
+    version: int
+    nodes: List[Dict[str, Any]]
+    links: List[Dict[str, Any]]
+    members: Dict[str, List[str]]
+
+
+class GraphSnapshot(NamedTuple):
+    """A topology, the utilization overlay of its links (link id -> percent
+    & speed) & the whole graph with these utilizations, built together.
+    built is when it was swapped in (monotonic time)"""
+
+    topology: Topology
+    utilizations: Dict[str, Any]
+    graph: Dict[str, Any]
+    built: float
+
+
+def aggregate_links(
+    links: List[Dict[str, Any]], dpat: Optional[List[str]] = None
+) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, List[str]]]:
+    """Links of the db aggregated per couple of nodes (visual links)
+    & the ifaces aggregated into each of them"""
+    sorted_links: List[Dict[str, Any]] = sorted(
+        links, key=lambda d: (d["device_name"], d["neighbor_name"])
+    )
+    formatted_links: Dict[str, Dict[str, Any]] = {}
+    members: Dict[str, List[str]] = {}
+
+    logger.error(f"Nb links to format:{len(sorted_links)}")
+    for link in sorted_links:
+        device: str = link["device_name"]
+        iface: str = str(link["iface_name"])
+        neigh: str = link["neighbor_name"]
+        if isinstance(dpat, list):
+            if not any(device_pattern in neigh for device_pattern in dpat):
+                continue
+        neigh_iface: str = str(link["neighbor_iface"])
+        if not device or not iface or not neigh or not neigh_iface:
+            # Discard possible null ifaces
+            logger.error(f"WARNING: Link discarded : {link}")
+            continue
+
+        id_link: str = device + neigh
+        id_link_neigh: str = neigh + device
+        member: str = device + iface
+
+        if not formatted_links.get(id_link) and not formatted_links.get(id_link_neigh):
+
+            formatted_links[id_link] = {
+                "id": id_link,
+                "source": device,
+                "source_interfaces": [iface],
+                "target": neigh,
+                "target_interfaces": [neigh_iface],
+                "linknum": 1,
+            }
+            members[id_link] = [member]
+        else:
+            if formatted_links.get(id_link_neigh):
+                id_link, id_link_neigh = id_link_neigh, id_link
+                iface, neigh_iface = neigh_iface, iface
+
+            if iface not in formatted_links[id_link]["source_interfaces"]:
+                formatted_links[id_link]["source_interfaces"].append(iface)
+            else:
+                continue
+            if neigh_iface not in formatted_links[id_link]["target_interfaces"]:
+                formatted_links[id_link]["target_interfaces"].append(neigh_iface)
+            else:
+                continue
+
+            # Since 1 (visual) link will aggregate multiple (actual) links
+            # utilization/speed of the aggregated (visual) link are the ones of all its ifaces
+            members[id_link].append(member)
+
+    return formatted_links, members
+
+
+def link_utilization(
+    members: List[str], utilizations: Dict[str, int], speeds: Dict[str, int]
+) -> Tuple[float, int]:
+    """Highest utilization (percent) & speed (bits/s) of a link from the ones of its ifaces"""
+    highest_utilization: int = 0
+    speed: int = 0
+    for member in members:
+        try:
+            # "speed" in snmp terms is actually the max speed of the iface
+            speed += speeds[member] * 1000000  # Convert speed to bits
+            # Unknown (or expired) utilization
+            highest_utilization += utilizations.get(member, 0)
+        except KeyError:
+            speed += 1000000  # Can't determine speed (nor utilization)
+            logger.error(f"Cant find speed for {member}")
+
+    percent_highest: float = highest_utilization / speed * 100
+    if percent_highest > 100:
+        print(members, speed, highest_utilization, percent_highest)
+        percent_highest = 0
+    return percent_highest, speed
+
+
+def utilization_overlay(
+    members: Dict[str, List[str]], utilizations: Dict[str, int], speeds: Dict[str, int]
+) -> Dict[str, Dict[str, Any]]:
+    """Highest utilization (percent) & speed of each link by id"""
+    overlay: Dict[str, Dict[str, Any]] = {}
+    for id_link, link_members in members.items():
+        percent_highest, speed = link_utilization(link_members, utilizations, speeds)
+        overlay[id_link] = {"highest_utilization": percent_highest, "speed": speed}
+    return overlay
+
+
+def format_links(
+    links: List[Dict[str, Any]],
+    utilizations: Dict[str, int],
+    speeds: Dict[str, int],
+    dpat: Optional[List[str]] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """Links of the db aggregated per couple of nodes (visual links) with
+    their speed & highest utilization (percent)"""
+    formatted_links, members = aggregate_links(links, dpat)
+    overlay: Dict[str, Dict[str, Any]] = utilization_overlay(members, utilizations, speeds)
+    return {id_link: {**link, **overlay[id_link]} for id_link, link in formatted_links.items()}
+
+
+def merge_topology_changes(versions: List[Dict[str, Any]]) -> Dict[str, Dict[str, List[Any]]]:
+    """Net changes of a list of topology versions (oldest first): nodes & links
+    added, updated (or replaced) & removed. Something added then removed isn't listed"""
+    # Per node/link: whether it existed before the first change & after the last one
+    states: Dict[Tuple[Any, ...], List[bool]] = {}
+    updated: Set[Tuple[Any, ...]] = set()
+    for version in versions:
+        for change in version["changes"]:
+            key: Tuple[Any, ...] = (change["kind"],) + (
+                (change["device_name"],)
+                if change["kind"] == "node"
+                else tuple(change[field] for field in LINK_KEYS)
+            )
+            if change["op"] == "update" or (change["op"] == "add" and key in states):
+                # Updated or removed then added again
+                updated.add(key)
+            state: List[bool] = states.setdefault(key, [change["op"] != "add", True])
+            state[1] = change["op"] != "remove"
+
+    merged: Dict[str, Dict[str, List[Any]]] = {
+        kind: {"added": [], "updated": [], "removed": []} for kind in ("nodes", "links")
+    }
+    for key, (existed, exists) in states.items():
+        if existed == exists and not (exists and key in updated):
+            continue
+        operation: str = "updated" if existed == exists else "added" if exists else "removed"
+        if key[0] == "node":
+            merged["nodes"][operation].append(key[1])
+        else:
+            merged["links"][operation].append(dict(zip(LINK_KEYS, key[1:])))
+    return merged
+
+
+@lru_cache(maxsize=4096)
+def format_timestamp(timestamp: int) -> str:
+    """Local time of a sample (all ifaces of a poll share their timestamp)"""
+    return strftime("%y-%m-%d %H:%M:%S", localtime(timestamp))
+
+
+def format_raw_stats(raw_stats: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Rates of the raw samples of each iface (ordered by device, iface
+    & time). They are computed by the stats scrapper, samples stored
+    before that get the bits/s since the previous sample of their iface"""
+    stats_by_device: Dict[str, Dict[str, Any]] = {}
+    previous: Dict[str, Any] = {}
+    for stat in raw_stats:
+        ifname: str = stat["iface_name"]
+        iface: Dict[str, Any] = stats_by_device.setdefault(stat["device_name"], {}).setdefault(
+            ifname, {"ifDescr": ifname, "index": ifname, "stats": []}
+        )
+        stat_formatted: Dict[str, Any] = {
+            "InSpeed": 0,
+            "OutSpeed": 0,
+            "time": format_timestamp(int(stat["timestamp"])),
+        }
+        if "in_bps" in stat:
+            stat_formatted["InSpeed"] = stat["in_bps"]
+            stat_formatted["OutSpeed"] = stat["out_bps"]
+            stat_formatted.update(
+                {name: stat[field] for field, name in STATS_RATES_NAMES if field in stat}
+            )
+        elif iface["stats"]:
+            # The previous sample is the one of this iface. The first
+            # one of an iface stays at 0 (its previous rate is unknown)
+            interval: int = int(stat["timestamp"]) - int(previous["timestamp"])
+            if interval > 0:
+                stat_formatted["InSpeed"] = int(
+                    abs(int(stat["in_bytes"]) - int(previous["in_bytes"])) * 8 / interval
+                )
+                stat_formatted["OutSpeed"] = int(
+                    abs(int(stat["out_bytes"]) - int(previous["out_bytes"])) * 8 / interval
+                )
+        iface["stats"].append(stat_formatted)
+        previous = stat
+    return stats_by_device
+
+
+def format_rollups(rollups: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Average rates (bits/s) of each period of each iface, with their min & max"""
+    stats_by_device: Dict[str, Dict[str, Any]] = {}
+    for rollup in rollups:
+        ifname: str = rollup["iface_name"]
+        iface: Dict[str, Any] = stats_by_device.setdefault(rollup["device_name"], {}).setdefault(
+            ifname, {"ifDescr": ifname, "index": ifname, "stats": []}
+        )
+        iface["stats"].append(
+            {
+                "InSpeed": int(rollup["in_avg"]),
+                "OutSpeed": int(rollup["out_avg"]),
+                "InMin": rollup["in_min"],
+                "InMax": rollup["in_max"],
+                "OutMin": rollup["out_min"],
+                "OutMax": rollup["out_max"],
+                "time": format_timestamp(rollup["start"]),
+            }
+        )
+    return stats_by_device
@@ -0,0 +1,17 @@
+""" Connection to the db shared by db_layer & the
+modules split from it (topology changes) """
+
+#! /usr/bin/env python3
+
+from os import getenv
+from typing import Optional
+
+from pymongo import MongoClient  # type: ignore
+
+DB_STRING: Optional[str] = getenv("DB_STRING")
+if not DB_STRING:
+    # DB_STRING = "mongodb://mongodb:27017/"
+    DB_STRING = "mongodb://127.0.0.1:27017/"
+
+DB_CLIENT: MongoClient = MongoClient(DB_STRING)
+DB = DB_CLIENT.automapping
@@ -4,48 +4,97 @@ that can be (and should be) abstracted """
 #! /usr/bin/env python3
 
 from os import getenv
+from heapq import merge
 
-from typing import List, Dict, Any, Optional, Tuple
-from time import time
+from typing import List, Dict, Any, Optional, Tuple, Set
+from time import time, strftime, gmtime
 from re import compile as rcompile, IGNORECASE as rIGNORECASE
 
 # from itertools import chain
 
-from pymongo import MongoClient, UpdateMany  # type: ignore
-from pymongo.errors import DuplicateKeyError as MDDPK  # type: ignore
-
-DB_STRING: Optional[str] = getenv("DB_STRING")
-if not DB_STRING:
-    # DB_STRING = "mongodb://mongodb:27017/"
-    DB_STRING = "mongodb://127.0.0.1:27017/"
-
-DB_CLIENT: MongoClient = MongoClient(DB_STRING)
-DB = DB_CLIENT.automapping
+from pymongo import UpdateMany, UpdateOne  # type: ignore
+from pymongo.collection import Collection  # type: ignore
+from pymongo.errors import DuplicateKeyError as MDDPK, BulkWriteError  # type: ignore
+
+from db_client import DB
+from topology_changes import (
+    TOPOLOGY_CHANGES_TTL,
+    TOPOLOGY_CHANGES_COLLECTION,
+    node_change,
+    link_change,
+    record_topology_changes,
+)
+
+# How stats are stored: "documents" (one document per iface per poll)
+# or "buckets" (one document per iface per STATS_BUCKET_SPAN seconds)
+STATS_STORAGE: str = getenv("STATS_STORAGE", "documents")
+STATS_BUCKET_SPAN: int = int(getenv("STATS_BUCKET_SPAN", "3600"))
+# Stats written in one collection per day (stats_YYYYMMDD or stats_buckets_YYYYMMDD)
+# dropped once older than STATS_RETENTION_DAYS (0 keeps them forever)
+STATS_PARTITIONED: bool = bool(getenv("STATS_PARTITIONED"))
+STATS_RETENTION_DAYS: int = int(getenv("STATS_RETENTION_DAYS", "0"))
+
+# Fields of a stats document that change at each poll (stored as
+# parallel arrays in buckets) & the ones that hardly change (kept once)
+STATS_COUNTERS: Tuple[str, ...] = (
+    "in_discards",
+    "in_errors",
+    "out_discards",
+    "out_errors",
+    "in_bytes",
+    "in_ucast_pkts",
+    "in_mcast_pkts",
+    "in_bcast_pkts",
+    "out_bytes",
+    "out_ucast_pkts",
+    "out_mcast_pkts",
+    "out_bcast_pkts",
+)
+# Rates (per second, since the previous poll) stored with each stats sample
+STATS_RATES: Tuple[str, ...] = (
+    "in_bps",
+    "out_bps",
+    "in_pps",
+    "out_pps",
+    "in_errors_ps",
+    "out_errors_ps",
+    "in_discards_ps",
+    "out_discards_ps",
+)
+# Ifaces infos kept in the ifaces collection (older stats samples also have them)
+STATS_METADATAS: Tuple[str, ...] = ("ifalias", "mtu", "mac", "speed")
+# Seconds a link utilization rate is shown after its poll. It's 'unknown' (0) after
+# that: it's just to colorize links so there's no use to show a link red if its
+# utilization possibly went down already
+UTILIZATION_TTL: int = int(getenv("UTILIZATION_TTL", "1300"))
 
 # Collections that avoid data duplication (target)
 # All nodes infos of the graph
 NODES_COLLECTION = DB.nodes
 # All ifaces Stats by devices
 STATS_COLLECTION = DB.stats
+# Same stats, bucketed by iface & time span (STATS_STORAGE=buckets)
+STATS_BUCKETS_COLLECTION = DB.stats_buckets
+# Min/avg/max rates of each iface per 5 minutes & per hour
+STATS_ROLLUPS_COLLECTION = DB.stats_rollups
+# Day partitions whose index was already created by this process
+PARTITIONS_READY: Set[str] = set()
 # All ifaces current highest utilization (to colorize links accordingly)
 UTILIZATION_COLLECTION = DB.utilization
 # All links infos of the graph (neighborships)
 LINKS_COLLECTION = DB.links
+# Heartbeats of the stats pollers sharing the devices
+POLLERS_COLLECTION = DB.pollers
+# ifIndexes of each device (short iface name, ignored, part of a link)
+IFINDEXES_COLLECTION = DB.ifindexes
+# Speed, mtu, mac, alias & last time seen of each iface
+IFACES_COLLECTION = DB.ifaces
 
 
 def prep_db_if_not_exist() -> None:
-    """If db is empty, we create proper indexes."""
-
-    if (
-        get_entire_collection(NODES_COLLECTION)
-        and get_entire_collection(LINKS_COLLECTION)
-        and get_entire_collection(STATS_COLLECTION)
-        and get_entire_collection(UTILIZATION_COLLECTION)
-    ):
-        # Looks like everything is ready
-        return
-
-    print("Preping db since at least one collection is empty")
+    """Creates proper indexes. Done at each start since creating an index
+    that already exists does nothing: a db created by a previous version
+    gets the indexes added since."""
 
     # We ensure that entries will be unique
     # (this is a mongodb feature)
@@ -54,10 +103,136 @@ def prep_db_if_not_exist() -> None:
         [("device_name", 1), ("iface_name", 1), ("neighbor_name", 1), ("neighbor_iface", 1)],
         unique=True,
     )
-    STATS_COLLECTION.create_index(
-        [("device_name", 1), ("iface_name", 1), ("timestamp", 1)], unique=True
+    create_stats_index(STATS_COLLECTION)
+    create_stats_index(STATS_BUCKETS_COLLECTION)
+    IFACES_COLLECTION.create_index([("device_name", 1), ("iface_name", 1)], unique=True)
+    STATS_ROLLUPS_COLLECTION.create_index(
+        [("device_name", 1), ("resolution", 1), ("start", 1), ("iface_name", 1)], unique=True
     )
     UTILIZATION_COLLECTION.create_index([("device_name", 1), ("iface_name", 1)], unique=True)
+    # Covers the query of the rates not expired yet
+    UTILIZATION_COLLECTION.create_index(
+        [("expires", 1), ("device_name", 1), ("iface_name", 1), ("rate_bps", 1)]
+    )
+    IFINDEXES_COLLECTION.create_index([("device_name", 1)], unique=True)
+    TOPOLOGY_CHANGES_COLLECTION.create_index([("version", 1)], unique=True)
+    TOPOLOGY_CHANGES_COLLECTION.create_index(
+        [("created", 1)], expireAfterSeconds=TOPOLOGY_CHANGES_TTL
+    )
+
+
+def create_stats_index(mongodb_collection: Collection) -> None:
+    """Unique index of a stats collection (or of one of its day partitions)"""
+    time_field: str = (
+        "start"
+        if mongodb_collection.name.startswith(STATS_BUCKETS_COLLECTION.name)
+        else "timestamp"
+    )
+    mongodb_collection.create_index(
+        [("device_name", 1), ("iface_name", 1), (time_field, 1)], unique=True
+    )
+
+
+def stats_base_collection() -> Collection:
+    """Collection of the stats storage mode (documents or buckets)"""
+    return STATS_BUCKETS_COLLECTION if STATS_STORAGE == "buckets" else STATS_COLLECTION
+
+
+def partition_day(timestamp: int) -> str:
+    """Day (UTC) of the partition of a timestamp"""
+    return strftime("%Y%m%d", gmtime(timestamp))
+
+
+def stats_partition(timestamp: int, base: Optional[Collection] = None) -> Collection:
+    """Collection where the stats of this timestamp are written. Buckets
+    go to the partition of their start so a bucket is never split"""
+    base = base if base is not None else stats_base_collection()
+    if not STATS_PARTITIONED:
+        return base
+    if base.name == STATS_BUCKETS_COLLECTION.name:
+        timestamp -= timestamp % STATS_BUCKET_SPAN
+    name: str = f"{base.name}_{partition_day(timestamp)}"
+    if name not in PARTITIONS_READY:
+        create_stats_index(DB[name])
+        PARTITIONS_READY.add(name)
+    return DB[name]
+
+
+def filter_partition_names(names: List[str], base_name: str) -> List[str]:
+    """Names of the day partitions of a stats collection among collections
+    names, oldest first"""
+    prefix: str = f"{base_name}_"
+    return sorted(
+        name for name in names if name.startswith(prefix) and name[len(prefix) :].isdigit()
+    )
+
+
+def partition_names(base_name: str) -> List[str]:
+    """Names of the day partitions of a stats collection, oldest first"""
+    return filter_partition_names(DB.list_collection_names(), base_name)
+
+
+def partitions_in_range(
+    names: List[str], base_name: str, start: Optional[int] = None, end: Optional[int] = None
+) -> List[str]:
+    """Names of the collections holding the stats between start & end
+    timestamps, oldest first. The collection written before partitioning
+    is always read too"""
+    if start is not None and base_name == STATS_BUCKETS_COLLECTION.name:
+        start -= start % STATS_BUCKET_SPAN
+    first: str = partition_day(start) if start is not None else ""
+    last: Optional[str] = partition_day(end) if end is not None else None
+    return [base_name] + [
+        name
+        for name in filter_partition_names(names, base_name)
+        if name[-8:] >= first and (last is None or name[-8:] <= last)
+    ]
+
+
+def stats_partitions(
+    start: Optional[int] = None, end: Optional[int] = None, base: Optional[Collection] = None
+) -> List[Collection]:
+    """Collections holding the stats between start & end timestamps, oldest first"""
+    base = base if base is not None else stats_base_collection()
+    if not STATS_PARTITIONED:
+        return [base]
+    return [
+        DB[name] for name in partitions_in_range(DB.list_collection_names(), base.name, start, end)
+    ]
+
+
+def all_stats_collections() -> List[Any]:
+    """All collections holding raw stats (documents, buckets & their partitions)"""
+    return [
+        DB[name]
+        for base in (STATS_COLLECTION, STATS_BUCKETS_COLLECTION)
+        for name in [base.name] + partition_names(base.name)
+    ]
+
+
+def drop_expired_stats_partitions(retention_days: int = STATS_RETENTION_DAYS) -> List[str]:
+    """Drops the day partitions older than retention_days (whole
+    collections, instead of deleting their stats one by one)"""
+    if not STATS_PARTITIONED or retention_days <= 0:
+        return []
+    oldest_kept: str = partition_day(int(time()) - retention_days * 86400)
+    dropped: List[str] = []
+    for base in (STATS_COLLECTION, STATS_BUCKETS_COLLECTION):
+        for name in partition_names(base.name):
+            if name[-8:] < oldest_kept:
+                DB.drop_collection(name)
+                PARTITIONS_READY.discard(name)
+                dropped.append(name)
+    return dropped
+
+
+def group_by_partition(stats: List[Dict[str, Any]]) -> List[Tuple[Any, List[int]]]:
+    """Partitions where the stats are written & the indexes of their stats"""
+    partitions: Dict[str, Tuple[Any, List[int]]] = {}
+    for index, stat in enumerate(stats):
+        partition = stats_partition(int(stat["timestamp"]))
+        partitions.setdefault(partition.name, (partition, []))[1].append(index)
+    return list(partitions.values())
 
 
 def get_entire_collection(mongodb_collection) -> List[Dict[str, Any]]:  # type: ignore
@@ -120,56 +295,40 @@ def get_links_by_patterns(patterns: List[str]) -> List[Dict[str, Any]]:
     )
 
 
-def get_all_highest_utilizations() -> Dict[str, int]:
-    """Calculates and returns all highest links utilizations
-    as a dict. Keys are constructed as 'device_name+iface_name'"""
+def utilization_rate(
+    prev_utilization: int, last_utilization: int, prev_timestamp: float, timestamp: float
+) -> int:
+    """Rate (bits/s) between 2 utilizations of an iface. 0 without a previous one"""
+    if not prev_timestamp or not prev_utilization:
+        return 0
+    interval: int = max(int(timestamp - prev_timestamp), 1)
+    return int(max(last_utilization - prev_utilization, 0) / interval)
 
-    utilizations: Dict[str, int] = {}
-    current_timestamp: int = int(time())
 
-    for utilization in get_entire_collection(UTILIZATION_COLLECTION):
-        id_utilz: str = utilization["device_name"] + utilization["iface_name"]
-        if utilizations.get(id_utilz):
-            continue
-        try:
-            if current_timestamp - utilization["timestamp"] > 1300:
-                # utilization is expired... We just return 0 as 'unknown'
-                # (remember, it's just to colorize links so there's no use to show
-                # a link red if its utilization possibly went down already)
-                highest_utilization: int = 0
-            else:
-                if not utilization["prev_timestamp"]:
-                    highest_utilization = 0
-                elif not utilization["prev_utilization"]:
-                    highest_utilization = 0
-                else:
-                    interval: int = utilization["timestamp"] - utilization["prev_timestamp"]
-                    interval = max(interval, 1)
-                    highest_utilization = max(
-                        utilization["last_utilization"] - utilization["prev_utilization"], 0
-                    )
-
-                    highest_utilization = int(highest_utilization / interval)
-        except KeyError:
-            highest_utilization = 0
-
-        utilizations[id_utilz] = highest_utilization
-
-    return utilizations
+def get_all_highest_utilizations() -> Dict[str, int]:
+    """Returns all highest links utilizations (bits/s) as a dict.
+    Keys are constructed as 'device_name+iface_name'. Rates are computed
+    when written, expired ones are left out (so unknown)"""
+
+    return {
+        utilization["device_name"] + utilization["iface_name"]: utilization["rate_bps"]
+        for utilization in UTILIZATION_COLLECTION.find(
+            {"expires": {"$gt": int(time())}},
+            {"_id": False, "device_name": True, "iface_name": True, "rate_bps": True},
+        )
+    }
 
 
 def get_all_speeds() -> Dict[str, int]:
     """Returns all links speeds as a dict.
-    Keys are constructed as 'device_name+iface_name'"""
-
-    speeds: Dict[str, int] = {}
-    for stat in get_entire_collection(STATS_COLLECTION):
-        id_speed = stat["device_name"] + stat["iface_name"]
-        if speeds.get(id_speed):
-            continue
-        speeds[id_speed] = stat["speed"]
+    Key is the concatenation of device_name & iface_name"""
 
-    return speeds
+    return {
+        iface["device_name"] + iface["iface_name"]: iface["speed"]
+        for iface in IFACES_COLLECTION.find(
+            {}, {"_id": False, "device_name": True, "iface_name": True, "speed": True}
+        )
+    }
 
 
 def get_links_device(device: str) -> Any:
@@ -180,29 +339,154 @@ def get_links_device(device: str) -> Any:
     return LINKS_COLLECTION.find({"$or": query}, {"_id": False})
 
 
+def get_linked_ifaces(device: str) -> Set[str]:
+    """Returns the names of the ifaces of a device that are part of a link"""
+    linked: Set[str] = set()
+    for link in get_links_device(device):
+        if link["device_name"] == device:
+            linked.add(link["iface_name"])
+        if link.get("neighbor_name") == device:
+            linked.add(link["neighbor_iface"])
+    return linked
+
+
+def get_ifindexes(device_name: str) -> Optional[Dict[str, Any]]:
+    """Returns the ifIndexes registry of a device (None if never polled)"""
+    return IFINDEXES_COLLECTION.find_one(  # type: ignore
+        {"device_name": device_name}, {"_id": False}
+    )
+
+
+def save_ifindexes(device_name: str, registry: Dict[str, Any]) -> None:
+    """Stores (replaces) the ifIndexes registry of a device"""
+    IFINDEXES_COLLECTION.replace_one(
+        {"device_name": device_name}, dict(registry, device_name=device_name), upsert=True
+    )
+
+
 def get_utilizations_device(device: str) -> List[Dict[str, Any]]:
     """Returns all links utilizations of one specific device"""
 
     return list(UTILIZATION_COLLECTION.find({"device_name": device}, {"_id": False}))
 
 
-def get_stats_devices(devices: List[str]) -> List[Dict[str, Any]]:
-    """Returns all stats of all devices passed in parameter"""
+def unbucket_stats(bucket: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Stats documents (one per poll) stored in a bucket"""
+    # Only buckets written before the ifaces collection have metadatas
+    metadatas: Dict[str, Any] = {
+        field: bucket[field] for field in STATS_METADATAS if field in bucket
+    }
+    counters: List[List[Any]] = [bucket[counter] for counter in STATS_COUNTERS]
+    # Rates are null for the first poll of an iface. A bucket started before
+    # rates were stored only has the rates of its latest stats
+    nb_stats: int = len(bucket["timestamps"])
+    rates: List[List[Any]] = [
+        [None] * (nb_stats - len(bucket.get(rate, []))) + bucket.get(rate, [])
+        for rate in STATS_RATES
+    ]
+    return [
+        dict(
+            metadatas,
+            device_name=bucket["device_name"],
+            iface_name=bucket["iface_name"],
+            timestamp=timestamp,
+            **dict(zip(STATS_COUNTERS, values)),
+            **{rate: value for rate, value in zip(STATS_RATES, stat_rates) if value is not None},
+        )
+        for timestamp, values, stat_rates in zip(bucket["timestamps"], zip(*counters), zip(*rates))
+    ]
+
+
+def stat_order(stat: Dict[str, Any]) -> Tuple[str, str, int]:
+    """Stats are returned ordered by device, iface & time"""
+    return stat["device_name"], stat["iface_name"], stat["timestamp"]
+
 
-    query: List[Dict[str, str]] = [{"device_name": device} for device in devices]
-    return list(STATS_COLLECTION.find({"$or": query}, {"_id": False}))
+# Order of the (device_name, iface_name, timestamp) index
+STATS_SORT: List[Tuple[str, int]] = [("device_name", 1), ("iface_name", 1), ("timestamp", 1)]
+
+
+def stats_devices_query(
+    devices: List[str], start: Optional[int] = None, end: Optional[int] = None
+) -> Dict[str, Any]:
+    """Query of the stats (or of their buckets) of devices between start & end"""
+    query: Dict[str, Any] = {"device_name": {"$in": devices}}
+    time_range: Dict[str, int] = {}
+    if STATS_STORAGE == "buckets":
+        # Buckets starting before start can hold stats after it
+        if start is not None:
+            time_range["$gt"] = start - STATS_BUCKET_SPAN
+        if end is not None:
+            time_range["$lte"] = end
+        if time_range:
+            query["start"] = time_range
+        return query
+    if start is not None:
+        time_range["$gte"] = start
+    if end is not None:
+        time_range["$lte"] = end
+    if time_range:
+        query["timestamp"] = time_range
+    return query
+
+
+def bucket_stats_in_range(
+    bucket: Dict[str, Any], start: Optional[int] = None, end: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Stats of a bucket between start & end"""
+    return [
+        stat
+        for stat in unbucket_stats(bucket)
+        if (start is None or stat["timestamp"] >= start)
+        and (end is None or stat["timestamp"] <= end)
+    ]
+
+
+def get_stats_devices(
+    devices: List[str], start: Optional[int] = None, end: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Returns all stats of all devices passed in parameter
+    (only the ones between start & end timestamps if given)
+    ordered by device, iface & time"""
+
+    query: Dict[str, Any] = stats_devices_query(devices, start, end)
+    if STATS_STORAGE == "buckets":
+        stats: List[Dict[str, Any]] = [
+            stat
+            for collection in stats_partitions(start, end)
+            for bucket in collection.find(query, {"_id": False})
+            for stat in bucket_stats_in_range(bucket, start, end)
+        ]
+        # Stats of a bucket are in insertion order
+        stats.sort(key=stat_order)
+        return stats
+    # Range scans of the (device_name, iface_name, timestamp) index,
+    # already ordered in each partition
+    return list(
+        merge(
+            *(
+                collection.find(query, {"_id": False}).sort(STATS_SORT)
+                for collection in stats_partitions(start, end)
+            ),
+            key=stat_order,
+        )
+    )
 
 
 def get_speed_iface(device_name: str, iface_name: str) -> int:
     """Returns speed (max bandwidth, not utilization) of a specific interface"""
-    speed: int = 1
-    try:
-        *_, laststat = STATS_COLLECTION.find({"device_name": device_name, "iface_name": iface_name})
-        speed = laststat["speed"]
-    except (KeyError, IndexError) as err:
-        print("oops? " + str(err))
-        speed = 10
-    return speed
+    iface: Optional[Dict[str, Any]] = IFACES_COLLECTION.find_one(
+        {"device_name": device_name, "iface_name": iface_name}, {"_id": False, "speed": True}
+    )
+    if iface is None:
+        print(f"oops? no speed for {device_name} {iface_name}")
+        return 10
+    return int(iface["speed"])
+
+
+def get_ifaces_device(device_name: str) -> List[Dict[str, Any]]:
+    """Returns the infos (speed, mtu, mac, alias, last seen) of the ifaces of a device"""
+    return list(IFACES_COLLECTION.find({"device_name": device_name}, {"_id": False}))
 
 
 def get_latest_utilization(device_name: str, iface_name: str) -> Tuple[int, int]:
@@ -217,10 +501,116 @@ def get_latest_utilization(device_name: str, iface_name: str) -> Tuple[int, int]
         return 0, 0
 
 
+def get_latest_utilizations(device_name: str) -> Dict[str, Tuple[int, int]]:
+    """Returns last links utilizations of all interfaces of a device
+    (in one query) as a dict. Keys are the interfaces names"""
+
+    utilizations: Dict[str, Tuple[int, int]] = {}
+    for utilization_line in UTILIZATION_COLLECTION.find(
+        {"device_name": device_name},
+        {"_id": False, "iface_name": True, "last_utilization": True, "timestamp": True},
+    ):
+        try:
+            utilizations[utilization_line["iface_name"]] = (
+                utilization_line["last_utilization"],
+                utilization_line["timestamp"],
+            )
+        except KeyError:
+            continue
+    return utilizations
+
+
+def bucket_update(stat: Dict[str, Any], span: int = STATS_BUCKET_SPAN) -> UpdateOne:
+    """Upsert appending a stats document to the bucket of its iface & time.
+    A stat already in the bucket (same timestamp) is a duplicate key error"""
+    timestamp: int = int(stat["timestamp"])
+    return UpdateOne(
+        {
+            "device_name": stat["device_name"],
+            "iface_name": stat["iface_name"],
+            "start": timestamp - timestamp % span,
+            "timestamps": {"$ne": timestamp},
+        },
+        {
+            "$push": {
+                "timestamps": timestamp,
+                **{counter: stat.get(counter, 0) for counter in STATS_COUNTERS},
+                **{rate: stat.get(rate) for rate in STATS_RATES},
+            },
+            "$inc": {"count": 1},
+        },
+        upsert=True,
+    )
+
+
 def add_iface_stats(stats: List[Dict[str, Any]]) -> None:
     """Tries to insert all stats from parameter directly to db"""
 
-    STATS_COLLECTION.insert_many(stats)
+    for collection, indexes in group_by_partition(stats):
+        if STATS_STORAGE == "buckets":
+            collection.bulk_write([bucket_update(stats[index]) for index in indexes])
+        else:
+            collection.insert_many([stats[index] for index in indexes])
+
+
+def update_ifaces_unordered(ifaces: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Upserts the infos of ifaces (unordered). Returns the write
+    errors (index of the iface document & errmsg)"""
+    return bulk_update_unordered(
+        IFACES_COLLECTION,
+        [
+            ({"device_name": iface["device_name"], "iface_name": iface["iface_name"]}, iface)
+            for iface in ifaces
+        ],
+    )
+
+
+def write_iface_stats_unordered(stats: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Unordered version of add_iface_stats. Returns the write
+    errors (index of the stats document & errmsg)"""
+
+    errors: List[Dict[str, Any]] = []
+    for collection, indexes in group_by_partition(stats):
+        if STATS_STORAGE == "buckets":
+            try:
+                collection.bulk_write(
+                    [bucket_update(stats[index]) for index in indexes], ordered=False
+                )
+            except BulkWriteError as err:
+                partition_errors: List[Dict[str, Any]] = err.details.get("writeErrors", [])
+            else:
+                partition_errors = []
+        else:
+            partition_errors = insert_many_unordered(
+                collection, [stats[index] for index in indexes]
+            )
+        # Indexes of the partition's stats back to the indexes of all stats
+        errors.extend(dict(error, index=indexes[error["index"]]) for error in partition_errors)
+    return errors
+
+
+def heartbeat_poller(worker_id: str) -> None:
+    """Records that a poller is alive (and polling its share of devices)"""
+    POLLERS_COLLECTION.update_one(
+        {"worker_id": worker_id}, {"$set": {"last_seen": time()}}, upsert=True
+    )
+
+
+def get_live_pollers(ttl: float) -> List[str]:
+    """Returns the ids of the pollers that sent a heartbeat
+    during the last ttl seconds"""
+    return [
+        poller["worker_id"]
+        for poller in POLLERS_COLLECTION.find(
+            {"last_seen": {"$gte": time() - ttl}}, {"_id": False, "worker_id": True}
+        )
+    ]
+
+
+def remove_poller(worker_id: str) -> None:
+    """Removes a poller that stops so its devices are taken over
+    without waiting for its heartbeat to expire"""
+    POLLERS_COLLECTION.delete_one({"worker_id": worker_id})
 
 
 def add_node(  # pylint: disable=too-many-arguments
@@ -230,9 +620,12 @@ def add_node(  # pylint: disable=too-many-arguments
     image: Optional[str] = "router.png",
     node_description: Optional[str] = "",
     to_poll: Optional[bool] = True,
-) -> None:
-    """Inserts (or updates) a node into db"""
+    record: bool = True,
+) -> List[Dict[str, Any]]:
+    """Inserts (or updates) a node into db. Returns the topology change, recorded
+    as a new version unless record is False (recorded with others by the caller)"""
 
+    operation: str = "add"
     try:
         NODES_COLLECTION.insert_one(
             {
@@ -245,7 +638,7 @@ def add_node(  # pylint: disable=too-many-arguments
             }
         )
     except MDDPK:
-        NODES_COLLECTION.update_many(
+        if not NODES_COLLECTION.update_many(
             {"device_name": node_name},
             {
                 "$set": {
@@ -257,7 +650,13 @@ def add_node(  # pylint: disable=too-many-arguments
                     "to_poll": to_poll,
                 }
             },
-        )
+        ).modified_count:
+            return []
+        operation = "update"
+    changes: List[Dict[str, Any]] = [node_change(operation, node_name)]
+    if record:
+        record_topology_changes(changes)
+    return changes
 
 
 def add_link(  # pylint: disable=too-many-arguments
@@ -267,9 +666,12 @@ def add_link(  # pylint: disable=too-many-arguments
     neigh_iface: str,
     local_iface_descr: Optional[str] = "",
     neigh_iface_descr: Optional[str] = "",
-) -> None:
-    """Tries to insert a link directly into db"""
+    record: bool = True,
+) -> List[Dict[str, Any]]:
+    """Tries to insert a link directly into db. Returns the topology change,
+    recorded as a new version unless record is False (as add_node)"""
 
+    operation: str = "add"
     try:
         LINKS_COLLECTION.insert_one(
             {
@@ -282,7 +684,7 @@ def add_link(  # pylint: disable=too-many-arguments
             }
         )
     except MDDPK:
-        LINKS_COLLECTION.update_many(
+        if not LINKS_COLLECTION.update_many(
             {
                 "device_name": node_name,
                 "neighbor_name": neigh_name,
@@ -299,7 +701,23 @@ def add_link(  # pylint: disable=too-many-arguments
                     "neighbor_iface_descr": neigh_iface_descr,
                 }
             },
+        ).modified_count:
+            return []
+        operation = "update"
+    changes: List[Dict[str, Any]] = [
+        link_change(
+            operation,
+            {
+                "device_name": node_name,
+                "iface_name": local_iface,
+                "neighbor_name": neigh_name,
+                "neighbor_iface": neigh_iface,
+            },
         )
+    ]
+    if record:
+        record_topology_changes(changes)
+    return changes
 
 
 def add_fake_iface_utilization(  # pylint: disable=too-many-arguments
@@ -322,6 +740,10 @@ def add_fake_iface_utilization(  # pylint: disable=too-many-arguments
                 "last_utilization": last_utilization,
                 "prev_timestamp": prev_timestamp,
                 "timestamp": timestamp,
+                "rate_bps": utilization_rate(
+                    prev_utilization, last_utilization, prev_timestamp, timestamp
+                ),
+                "expires": int(timestamp) + UTILIZATION_TTL,
             }
         },
         True,
@@ -337,53 +759,110 @@ def add_fake_iface_stats(
 ) -> None:
     """Inserts fake stats for a specific interface into db"""
 
-    STATS_COLLECTION.insert_one(
-        {
-            "device_name": f"{device_name}",
-            "iface_name": f"{iface_name}",
-            "timestamp": int(timestamp),
-            "mtu": 1500,
-            "mac": "",
-            "speed": 10,
-            "in_discards": 0,
-            "in_errors": 0,
-            "out_discards": 0,
-            "out_errors": 0,
-            "in_bytes": in_bytes,
-            "in_ucast_pkts": 0,
-            "in_mcast_pkts": 0,
-            "in_bcast_pkts": 0,
-            "out_bytes": out_bytes,
-            "out_ucast_pkts": 0,
-            "out_mcast_pkts": 0,
-            "out_bcast_pkts": 0,
-        }
+    add_iface_stats(
+        [
+            {
+                "device_name": f"{device_name}",
+                "iface_name": f"{iface_name}",
+                "timestamp": int(timestamp),
+                "in_discards": 0,
+                "in_errors": 0,
+                "out_discards": 0,
+                "out_errors": 0,
+                "in_bytes": in_bytes,
+                "in_ucast_pkts": 0,
+                "in_mcast_pkts": 0,
+                "in_bcast_pkts": 0,
+                "out_bytes": out_bytes,
+                "out_ucast_pkts": 0,
+                "out_mcast_pkts": 0,
+                "out_bcast_pkts": 0,
+            }
+        ]
+    )
+    update_ifaces_unordered(
+        [
+            {
+                "device_name": f"{device_name}",
+                "iface_name": f"{iface_name}",
+                "ifalias": "",
+                "mtu": 1500,
+                "mac": "",
+                "speed": 10,
+                "last_seen": int(timestamp),
+            }
+        ]
     )
 
 
-def bulk_update_collection(mongodb_collection, list_tuple_key_query) -> None:  # type: ignore
+def bulk_update_collection(mongodb_collection, list_tuple_key_query) -> Any:  # type: ignore
     """Update massively a collection. It uses the special 'UpdateMany'
     pymongo object :
     # (https://pymongo.readthedocs.io/en/stable/api/pymongo/collection.html\
     # ?highlight=update#pymongo.collection.Collection.update_many)
+    Returns the result of the bulk write (upserted ids,...)
     """
 
     request: List[UpdateMany] = []
     for query, data in list_tuple_key_query:
         request.append(UpdateMany(query, {"$set": data}, True))
 
-    mongodb_collection.bulk_write(request)
+    return mongodb_collection.bulk_write(request)
 
 
-def delete_node(node_name: str) -> None:
-    """Deletes everything related to a specific node from db.
-    (everything means node, links, stats & utilizations entries)"""
+def insert_many_unordered(mongodb_collection, documents) -> List[Dict[str, Any]]:  # type: ignore
+    """Inserts all documents, a failing one (duplicate,...) doesn't stop
+    the others. Returns the write errors (index of the document & errmsg)"""
+
+    if not documents:
+        return []
+    try:
+        mongodb_collection.insert_many(documents, ordered=False)
+    except BulkWriteError as err:
+        return list(err.details.get("writeErrors", []))
+    return []
+
+
+def bulk_update_unordered(  # type: ignore
+    mongodb_collection, list_tuple_key_query
+) -> List[Dict[str, Any]]:
+    """Unordered version of bulk_update_collection. Returns the write
+    errors (index of the (query, data) tuple & errmsg)"""
+
+    if not list_tuple_key_query:
+        return []
+    request: List[UpdateMany] = [
+        UpdateMany(query, {"$set": data}, True) for query, data in list_tuple_key_query
+    ]
+    try:
+        mongodb_collection.bulk_write(request, ordered=False)
+    except BulkWriteError as err:
+        return list(err.details.get("writeErrors", []))
+    return []
+
 
-    NODES_COLLECTION.delete_one({"device_name": node_name})
-    LINKS_COLLECTION.delete_many({"device_name": node_name})
-    LINKS_COLLECTION.delete_many({"neighbor_name": node_name})
-    STATS_COLLECTION.delete_many({"device_name": node_name})
+def delete_node(node_name: str, record: bool = True) -> List[Dict[str, Any]]:
+    """Deletes everything related to a specific node from db.
+    (everything means node, links, stats & utilizations entries)
+    Returns the topology changes, recorded unless record is False (as add_node)"""
+
+    links_query: Dict[str, Any] = {
+        "$or": [{"device_name": node_name}, {"neighbor_name": node_name}]
+    }
+    changes: List[Dict[str, Any]] = [
+        link_change("remove", link) for link in LINKS_COLLECTION.find(links_query, {"_id": False})
+    ]
+    if NODES_COLLECTION.delete_one({"device_name": node_name}).deleted_count:
+        changes.append(node_change("remove", node_name))
+    LINKS_COLLECTION.delete_many(links_query)
+    if changes and record:
+        record_topology_changes(changes)
+    for stats_collection in all_stats_collections() + [STATS_ROLLUPS_COLLECTION]:
+        stats_collection.delete_many({"device_name": node_name})
     UTILIZATION_COLLECTION.delete_many({"neighbor_name": node_name})
+    IFINDEXES_COLLECTION.delete_many({"device_name": node_name})
+    IFACES_COLLECTION.delete_many({"device_name": node_name})
+    return changes
 
 
 def delete_link(
@@ -395,26 +874,27 @@ def delete_link(
     """Deletes everything related to a specific node from db.
     (everything means node, links, stats & utilizations entries)"""
 
-    LINKS_COLLECTION.delete_one(
-        {
-            "device_name": node_name,
-            "neighbor_name": neigh_name,
-            "iface_name": local_iface,
-            "neighbor_iface": neigh_iface,
-        }
-    )
-    STATS_COLLECTION.delete_many(
-        {
-            "device_name": node_name,
-            "iface_name": local_iface,
-        }
-    )
-    STATS_COLLECTION.delete_many(
-        {
-            "device_name": neigh_name,
-            "iface_name": neigh_iface,
-        }
-    )
+    link: Dict[str, str] = {
+        "device_name": node_name,
+        "neighbor_name": neigh_name,
+        "iface_name": local_iface,
+        "neighbor_iface": neigh_iface,
+    }
+    if LINKS_COLLECTION.delete_one(link).deleted_count:
+        record_topology_changes([link_change("remove", link)])
+    for stats_collection in all_stats_collections() + [STATS_ROLLUPS_COLLECTION]:
+        stats_collection.delete_many(
+            {
+                "device_name": node_name,
+                "iface_name": local_iface,
+            }
+        )
+        stats_collection.delete_many(
+            {
+                "device_name": neigh_name,
+                "iface_name": neigh_iface,
+            }
+        )
     UTILIZATION_COLLECTION.delete_many(
         {
             "device_name": node_name,
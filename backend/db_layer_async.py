@@ -0,0 +1,225 @@
+""" Async (motor) variant of the db_layer reads used by the api
+routes so they don't hold a thread while waiting for the db.
+Queries are the same as the ones of db_layer."""
+
+#! /usr/bin/env python3
+
+import asyncio
+from heapq import merge
+from os import getenv
+from re import compile as rcompile, IGNORECASE as rIGNORECASE
+from time import time
+from typing import Any, Dict, List, Optional
+from weakref import WeakKeyDictionary
+
+from motor.motor_asyncio import AsyncIOMotorClient  # type: ignore
+from pymongo.collection import Collection  # type: ignore
+
+# Storage settings are read from db_layer at each call (same behavior as its reads)
+import db_layer
+from db_client import DB, DB_STRING
+from db_layer import (
+    NODES_COLLECTION,
+    LINKS_COLLECTION,
+    UTILIZATION_COLLECTION,
+    IFACES_COLLECTION,
+    STATS_ROLLUPS_COLLECTION,
+    STATS_SORT,
+    bucket_stats_in_range,
+    partitions_in_range,
+    stat_order,
+    stats_base_collection,
+    stats_devices_query,
+)
+from stats_rollups import ROLLUPS_PROJECTION, average_rollups, rollups_devices_query
+from topology_changes import COUNTERS_COLLECTION, TOPOLOGY_CHANGES_COLLECTION, current_version
+
+# Connections to the db of the api process, shared by all the requests in flight.
+# Requests wait up to DB_WAIT_QUEUE_TIMEOUT_MS for a connection when they are all used.
+DB_MAX_POOL_SIZE: int = int(getenv("DB_MAX_POOL_SIZE", "100"))
+DB_MIN_POOL_SIZE: int = int(getenv("DB_MIN_POOL_SIZE", "10"))
+DB_WAIT_QUEUE_TIMEOUT_MS: int = int(getenv("DB_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+
+# A motor client is bound to the event loop it was created in
+DB_CLIENTS: "WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncIOMotorClient]" = WeakKeyDictionary()
+
+
+def get_db() -> Any:
+    """Db of the client of the running event loop"""
+    loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+    client: Optional[AsyncIOMotorClient] = DB_CLIENTS.get(loop)
+    if client is None:
+        client = DB_CLIENTS[loop] = AsyncIOMotorClient(
+            DB_STRING,
+            maxPoolSize=DB_MAX_POOL_SIZE,
+            minPoolSize=DB_MIN_POOL_SIZE,
+            waitQueueTimeoutMS=DB_WAIT_QUEUE_TIMEOUT_MS,
+        )
+    return client[DB.name]
+
+
+def get_collection(collection: Collection) -> Any:
+    """Motor collection of the running event loop named as a db_layer collection"""
+    return get_db()[collection.name]
+
+
+async def to_list(cursor: Any) -> List[Dict[str, Any]]:
+    """All the documents of a motor cursor"""
+    documents: List[Dict[str, Any]] = await cursor.to_list(None)
+    return documents
+
+
+async def get_all_nodes() -> List[Dict[str, Any]]:
+    """Returns all nodes"""
+    return await to_list(get_collection(NODES_COLLECTION).find({}, {"_id": False}))
+
+
+async def get_nodes_by_patterns(patterns: List[str]) -> List[Dict[str, Any]]:
+    """Returns all nodes matched"""
+    return await to_list(
+        get_collection(NODES_COLLECTION).find(
+            {"$or": [{"device_name": rcompile(pattern, rIGNORECASE)} for pattern in patterns]},
+            {"_id": False},
+        )
+    )
+
+
+async def get_all_links() -> List[Dict[str, Any]]:
+    """Returns all links"""
+    return await to_list(get_collection(LINKS_COLLECTION).find({}, {"_id": False}))
+
+
+async def get_links_by_patterns(patterns: List[str]) -> List[Dict[str, Any]]:
+    """Returns all links matched"""
+    return await to_list(
+        get_collection(LINKS_COLLECTION).find(
+            {"$or": [{"device_name": rcompile(pattern, rIGNORECASE)} for pattern in patterns]}
+        )
+    )
+
+
+async def get_links_device(device: str) -> List[Dict[str, Any]]:
+    """Returns all links of one specific device (also looks
+    at links on which this device is appearing as a neighbor)"""
+    query: List[Dict[str, str]] = [{"device_name": device}, {"neighbor_name": device}]
+    return await to_list(get_collection(LINKS_COLLECTION).find({"$or": query}, {"_id": False}))
+
+
+async def get_utilizations_device(device: str) -> List[Dict[str, Any]]:
+    """Returns all links utilizations of one specific device"""
+    return await to_list(
+        get_collection(UTILIZATION_COLLECTION).find({"device_name": device}, {"_id": False})
+    )
+
+
+async def get_all_highest_utilizations() -> Dict[str, int]:
+    """Returns the rates (bits/s) not expired yet of all ifaces as a dict.
+    Keys are constructed as 'device_name+iface_name'"""
+    return {
+        utilization["device_name"] + utilization["iface_name"]: utilization["rate_bps"]
+        async for utilization in get_collection(UTILIZATION_COLLECTION).find(
+            {"expires": {"$gt": int(time())}},
+            {"_id": False, "device_name": True, "iface_name": True, "rate_bps": True},
+        )
+    }
+
+
+async def get_all_speeds() -> Dict[str, int]:
+    """Returns all links speeds as a dict.
+    Key is the concatenation of device_name & iface_name"""
+    return {
+        iface["device_name"] + iface["iface_name"]: iface["speed"]
+        async for iface in get_collection(IFACES_COLLECTION).find(
+            {}, {"_id": False, "device_name": True, "iface_name": True, "speed": True}
+        )
+    }
+
+
+async def get_node(node_name: str) -> Dict[str, Any]:
+    """Returns a single exact node from the db"""
+    node: Dict[str, Any] = await get_collection(NODES_COLLECTION).find_one(
+        {"device_name": node_name}, {"_id": False}
+    )
+    return node
+
+
+async def stats_partitions(start: Optional[int] = None, end: Optional[int] = None) -> List[Any]:
+    """Collections holding the stats between start & end timestamps, oldest first"""
+    db = get_db()
+    base_name: str = stats_base_collection().name
+    if not db_layer.STATS_PARTITIONED:
+        return [db[base_name]]
+    names: List[str] = await db.list_collection_names()
+    return [db[name] for name in partitions_in_range(names, base_name, start, end)]
+
+
+async def get_stats_devices(
+    devices: List[str], start: Optional[int] = None, end: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Returns all stats of all devices passed in parameter
+    (only the ones between start & end timestamps if given)
+    ordered by device, iface & time. Partitions are read concurrently"""
+    query: Dict[str, Any] = stats_devices_query(devices, start, end)
+    collections: List[Any] = await stats_partitions(start, end)
+    if db_layer.STATS_STORAGE == "buckets":
+        buckets_lists: List[List[Dict[str, Any]]] = await asyncio.gather(
+            *(to_list(collection.find(query, {"_id": False})) for collection in collections)
+        )
+        stats: List[Dict[str, Any]] = [
+            stat
+            for buckets in buckets_lists
+            for bucket in buckets
+            for stat in bucket_stats_in_range(bucket, start, end)
+        ]
+        stats.sort(key=stat_order)
+        return stats
+    stats_lists: List[List[Dict[str, Any]]] = await asyncio.gather(
+        *(
+            to_list(collection.find(query, {"_id": False}).sort(STATS_SORT))
+            for collection in collections
+        )
+    )
+    return list(merge(*stats_lists, key=stat_order))
+
+
+async def get_rollups_devices(
+    devices: List[str], resolution: int, start: int, end: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Returns the rates aggregates of the ifaces of the devices at
+    a resolution (seconds) between start & end timestamps, ordered
+    by device, iface & time"""
+    return average_rollups(
+        await to_list(
+            get_collection(STATS_ROLLUPS_COLLECTION).find(
+                rollups_devices_query(devices, resolution, start, end), ROLLUPS_PROJECTION
+            )
+        )
+    )
+
+
+async def get_topology_version() -> int:
+    """Current version of the topology (0 if it never changed)"""
+    counter, newest = await asyncio.gather(
+        get_collection(COUNTERS_COLLECTION).find_one({"_id": "topology_version"}),
+        get_collection(TOPOLOGY_CHANGES_COLLECTION).find_one(
+            {}, {"_id": False, "version": True}, sort=[("version", -1)]
+        ),
+    )
+    return current_version(counter, newest)
+
+
+async def get_oldest_topology_version() -> Optional[int]:
+    """Oldest version still in the topology changes log (None if empty)"""
+    oldest: Optional[Dict[str, Any]] = await get_collection(TOPOLOGY_CHANGES_COLLECTION).find_one(
+        {}, {"_id": False, "version": True}, sort=[("version", 1)]
+    )
+    return int(oldest["version"]) if oldest else None
+
+
+async def get_topology_changes(since: int) -> List[Dict[str, Any]]:
+    """Versions of the topology (& their changes) after since, oldest first"""
+    return await to_list(
+        get_collection(TOPOLOGY_CHANGES_COLLECTION)
+        .find({"version": {"$gt": since}}, {"_id": False, "created": False})
+        .sort("version", 1)
+    )
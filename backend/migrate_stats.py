@@ -0,0 +1,172 @@
+"""Migrates the stats documents (one per iface per poll) into
+buckets (STATS_STORAGE=buckets) & their ifaces infos into the
+ifaces collection. Can be run while the scrapper already writes
+buckets & run again: stats already in a bucket are skipped"""
+#! /usr/bin/env python3
+
+from argparse import ArgumentParser
+from itertools import groupby
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+from pymongo import UpdateOne  # type: ignore
+
+from db_layer import (
+    prep_db_if_not_exist,
+    STATS_COLLECTION,
+    STATS_BUCKETS_COLLECTION,
+    IFACES_COLLECTION,
+    STATS_BUCKET_SPAN,
+    STATS_COUNTERS,
+    STATS_RATES,
+    STATS_METADATAS,
+    stats_partition,
+    stats_partitions,
+)
+
+
+def get_ifaces() -> Iterator[Tuple[str, str]]:
+    """(device, iface) couples having stats documents (in any partition)"""
+    ifaces: Set[Tuple[str, str]] = set()
+    for collection in stats_partitions(base=STATS_COLLECTION):
+        for iface in collection.aggregate(
+            [{"$group": {"_id": {"device_name": "$device_name", "iface_name": "$iface_name"}}}],
+            allowDiskUse=True,
+        ):
+            ifaces.add((iface["_id"]["device_name"], iface["_id"]["iface_name"]))
+    yield from sorted(ifaces)
+
+
+def get_bucketed_timestamps(device_name: str, iface_name: str) -> Set[int]:
+    """Timestamps of the stats of an iface already in buckets"""
+    timestamps: Set[int] = set()
+    for collection in stats_partitions(base=STATS_BUCKETS_COLLECTION):
+        for bucket in collection.find(
+            {"device_name": device_name, "iface_name": iface_name},
+            {"_id": False, "timestamps": True},
+        ):
+            timestamps.update(bucket["timestamps"])
+    return timestamps
+
+
+def bucket_updates(
+    device_name: str, iface_name: str, stats: List[Dict[str, Any]], span: int
+) -> List[UpdateOne]:
+    """One upsert per bucket appending all its stats at once"""
+    updates: List[UpdateOne] = []
+    for start, bucket_stats in groupby(
+        stats, key=lambda stat: int(stat["timestamp"]) - int(stat["timestamp"]) % span
+    ):
+        stats_list: List[Dict[str, Any]] = list(bucket_stats)
+        updates.append(
+            UpdateOne(
+                {"device_name": device_name, "iface_name": iface_name, "start": start},
+                {
+                    "$push": {
+                        "timestamps": {"$each": [int(stat["timestamp"]) for stat in stats_list]},
+                        **{
+                            counter: {"$each": [stat.get(counter, 0) for stat in stats_list]}
+                            for counter in STATS_COUNTERS
+                        },
+                        # Keeps the rates arrays aligned (stats documents may have none)
+                        **{
+                            rate: {"$each": [stat.get(rate) for stat in stats_list]}
+                            for rate in STATS_RATES
+                        },
+                    },
+                    "$inc": {"count": len(stats_list)},
+                },
+                upsert=True,
+            )
+        )
+    return updates
+
+
+def write_buckets(device_name: str, iface_name: str, stats: List[Dict[str, Any]], span: int) -> int:
+    """Writes the buckets of the stats in their partitions. Returns the number of stats written"""
+    for collection, partition_stats in groupby(
+        stats, key=lambda stat: stats_partition(int(stat["timestamp"]), STATS_BUCKETS_COLLECTION)
+    ):
+        collection.bulk_write(bucket_updates(device_name, iface_name, list(partition_stats), span))
+    return len(stats)
+
+
+def migrate_iface(
+    device_name: str, iface_name: str, span: int, batch_size: int, delete: bool
+) -> int:
+    """Migrates the stats of an iface (oldest first). Returns the number of stats moved"""
+    bucketed: Set[int] = get_bucketed_timestamps(device_name, iface_name)
+    query: Dict[str, str] = {"device_name": device_name, "iface_name": iface_name}
+    moved: int = 0
+    stats: List[Dict[str, Any]] = []
+    latest: Dict[str, Any] = {}
+    # Partitions (if any) are read oldest first, so are the stats
+    for collection in stats_partitions(base=STATS_COLLECTION):
+        cursor = collection.find(query, {"_id": False}, batch_size=batch_size).sort("timestamp", 1)
+        for stat in cursor:
+            if int(stat["timestamp"]) not in bucketed:
+                stats.append(stat)
+            latest = stat
+            if len(stats) >= batch_size:
+                moved += write_buckets(device_name, iface_name, stats, span)
+                stats = []
+        # Stats of the collection are all in buckets before being deleted
+        if stats:
+            moved += write_buckets(device_name, iface_name, stats, span)
+            stats = []
+        if delete:
+            collection.delete_many(query)
+    if "speed" in latest:
+        # Infos of the iface from its latest stats (unless the scrapper already stored them)
+        IFACES_COLLECTION.update_one(
+            query,
+            {
+                "$setOnInsert": {
+                    **{field: latest.get(field) for field in STATS_METADATAS},
+                    "last_seen": int(latest["timestamp"]),
+                }
+            },
+            upsert=True,
+        )
+    return moved
+
+
+def main() -> None:
+    """Handles user interface (arguments) & migrates the stats of all ifaces"""
+    parser = ArgumentParser(
+        prog="migrate_stats",
+        description="Moves the stats documents into buckets (STATS_STORAGE=buckets)",
+    )
+    parser.add_argument(
+        "-s",
+        "--span",
+        type=int,
+        help="Seconds covered by a bucket (must be the STATS_BUCKET_SPAN of the scrapper)",
+        default=STATS_BUCKET_SPAN,
+    )
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        type=int,
+        help="Stats documents read & written at once",
+        default="10000",
+    )
+    parser.add_argument(
+        "-d",
+        "--delete",
+        action="store_true",
+        help="Deletes the stats documents of each iface once migrated",
+    )
+    args = parser.parse_args()
+
+    prep_db_if_not_exist()
+
+    total: int = 0
+    for device_name, iface_name in get_ifaces():
+        moved: int = migrate_iface(device_name, iface_name, args.span, args.batch_size, args.delete)
+        print(f"{device_name} {iface_name}: {moved} stats migrated")
+        total += moved
+    print(f"{total} stats migrated into buckets")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Deadline driven scheduler shared by the scrappers.
+Each device is polled on its own cadence instead of polling
+chunks of devices & sleeping between them."""
+#! /usr/bin/env python3
+
+import asyncio
+import heapq
+from math import ceil
+from os import getenv
+from random import uniform
+from time import monotonic
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from poller_metrics import (
+    QUEUE_DEPTH,
+    IN_FLIGHT,
+    OVERRUNS,
+    MISSED_DEADLINES,
+    POLL_SECONDS,
+    DEVICE_POLL_SECONDS,
+)
+
+# How often the devices list is refreshed (new devices discovered, devices not to poll anymore)
+REFRESH_INTERVAL: int = int(getenv("SCHEDULER_REFRESH_INTERVAL", "60"))
+
+
+class PollTarget(NamedTuple):
+    """A device to poll & its own polling interval (seconds)"""
+
+    name: str
+    ip: str
+    port: int
+    interval: float
+
+
+class DeviceSchedule:  # pylint: disable=too-few-public-methods
+    """Scheduling state of one device"""
+
+    def __init__(self, target: PollTarget, deadline: float) -> None:
+        self.target: PollTarget = target
+        self.deadline: float = deadline
+        self.last_duration: float = 0.0
+        self.polls: int = 0
+        # Polls that took longer than the interval & deadlines missed because of them
+        self.overruns: int = 0
+        self.missed: int = 0
+        self.removed: bool = False
+
+    def reschedule(self, now: float) -> None:
+        """Moves the deadline to the next slot of the device cadence.
+        Slots already passed (overrun) are skipped, not queued"""
+        self.deadline += self.target.interval
+        if self.deadline < now:
+            late: int = ceil((now - self.deadline) / self.target.interval)
+            self.missed += late
+            self.deadline += late * self.target.interval
+
+
+PollFunc = Callable[[str, str, int], Awaitable[None]]
+
+
+# The queue, its devices & the state of the run loop are kept together
+class PollScheduler:  # pylint: disable=too-many-instance-attributes
+    """Priority queue of devices ordered by their next deadline.
+    A device is put back in the queue only once its poll is done so
+    it is never polled twice at the same time"""
+
+    def __init__(
+        self,
+        poll: PollFunc,
+        get_targets: Callable[[], List[PollTarget]],
+        refresh_interval: float = REFRESH_INTERVAL,
+    ) -> None:
+        self.poll: PollFunc = poll
+        self.get_targets: Callable[[], List[PollTarget]] = get_targets
+        self.refresh_interval: float = refresh_interval
+        self.schedules: Dict[Tuple[str, str, int], DeviceSchedule] = {}
+        self.queue: List[Tuple[float, int, DeviceSchedule]] = []
+        self.in_flight: int = 0
+        # References to the running polls so they can't be garbage collected
+        self._polls: Set["asyncio.Task[None]"] = set()
+        self._sequence: int = 0
+        self._next_refresh: float = 0.0
+        # Set when a device is put back in the queue, it may be due
+        # before the deadline the scheduler is sleeping till
+        self._wake_up: Optional[asyncio.Event] = None
+
+    def _push(self, schedule: DeviceSchedule) -> None:
+        # The sequence number avoids comparing schedules with the same deadline
+        self._sequence += 1
+        heapq.heappush(self.queue, (schedule.deadline, self._sequence, schedule))
+        QUEUE_DEPTH.set(len(self.queue))
+        if self._wake_up is not None:
+            self._wake_up.set()
+
+    def sync_targets(self, targets: List[PollTarget], now: Optional[float] = None) -> None:
+        """Adds new devices with a jittered first deadline (so they are
+        spread over their interval) & drops the ones not returned anymore"""
+        now = monotonic() if now is None else now
+        wanted: Dict[Tuple[str, str, int], PollTarget] = {
+            (target.name, target.ip, target.port): target for target in targets
+        }
+        for key, schedule in list(self.schedules.items()):
+            if key not in wanted:
+                # Lazily removed from the queue when popped
+                schedule.removed = True
+                del self.schedules[key]
+                DEVICE_POLL_SECONDS.remove(device=schedule.target.name)
+        for key, target in wanted.items():
+            known: Optional[DeviceSchedule] = self.schedules.get(key)
+            if known is not None:
+                # Interval change is taken into account from the next deadline
+                known.target = target
+                continue
+            schedule = DeviceSchedule(target, now + uniform(0, target.interval))
+            self.schedules[key] = schedule
+            self._push(schedule)
+
+    def refresh(self, now: float) -> None:
+        """Syncs the devices list if it is time to"""
+        if now < self._next_refresh:
+            return
+        self._next_refresh = now + self.refresh_interval
+        try:
+            targets: List[PollTarget] = self.get_targets()
+        except Exception as err:  # pylint: disable=broad-except
+            # Keep polling the known devices till the list can be refreshed
+            print(f"Can't refresh the devices to poll: {err}")
+            return
+        if not targets:
+            print("No devices retrieved from db... Waiting till there are any.")
+        self.sync_targets(targets, now)
+
+    async def _poll_device(self, schedule: DeviceSchedule) -> None:
+        target: PollTarget = schedule.target
+        start: float = monotonic()
+        self.in_flight += 1
+        IN_FLIGHT.set(self.in_flight)
+        try:
+            await self.poll(target.name, target.ip, target.port)
+        except Exception as err:  # pylint: disable=broad-except
+            # A failing device must not stop the scheduling of the others
+            print(f"Polling of {target.name} failed: {err}")
+        finally:
+            self.in_flight -= 1
+            IN_FLIGHT.set(self.in_flight)
+        now: float = monotonic()
+        schedule.polls += 1
+        schedule.last_duration = now - start
+        POLL_SECONDS.observe(schedule.last_duration)
+        DEVICE_POLL_SECONDS.set(schedule.last_duration, device=target.name)
+        if schedule.last_duration > target.interval:
+            schedule.overruns += 1
+            OVERRUNS.inc()
+            print(
+                f"Polling of {target.name} took {schedule.last_duration:.1f}s"
+                f" (interval {target.interval}s, {schedule.overruns} overruns)"
+            )
+        if schedule.removed:
+            return
+        missed: int = schedule.missed
+        schedule.reschedule(now)
+        MISSED_DEADLINES.inc(schedule.missed - missed)
+        self._push(schedule)
+
+    async def run(self) -> None:
+        """Polls devices as their deadlines come, forever"""
+        self._wake_up = asyncio.Event()
+        while True:
+            now: float = monotonic()
+            self.refresh(now)
+            if not self.queue or self.queue[0][0] > now:
+                wake_up: float = self._next_refresh
+                if self.queue:
+                    wake_up = min(wake_up, self.queue[0][0])
+                self._wake_up.clear()
+                try:
+                    await asyncio.wait_for(self._wake_up.wait(), max(wake_up - now, 0))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, schedule = heapq.heappop(self.queue)
+            QUEUE_DEPTH.set(len(self.queue))
+            if schedule.removed:
+                continue
+            task: "asyncio.Task[None]" = asyncio.ensure_future(self._poll_device(schedule))
+            self._polls.add(task)
+            task.add_done_callback(self._polls.discard)
@@ -0,0 +1,239 @@
+"""Metrics of the scrappers (timings, snmp requests, scheduling,
+db writes) exposed in the Prometheus text format on a local
+http endpoint."""
+#! /usr/bin/env python3
+
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+from os import getenv
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+METRICS_HOST: str = getenv("POLLER_METRICS_HOST", "0.0.0.0")  # nosec
+METRICS_PORT: int = int(getenv("POLLER_METRICS_PORT", "9108"))  # 0 to disable
+
+# Seconds, from a fast snmp answer to a very slow device poll
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+LabelValues = Tuple[str, ...]
+
+
+def escape(label_value: str) -> str:
+    """Escapes a label value for the text format"""
+    return label_value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    """A metric family & its samples by labels values"""
+
+    kind: str = "untyped"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()) -> None:
+        self.name: str = name
+        self.description: str = description
+        self.labels: Tuple[str, ...] = tuple(labels)
+        REGISTRY.append(self)
+
+    def label_values(self, labels: Dict[str, str]) -> LabelValues:
+        """Labels values in the order of the metric labels"""
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def format_labels(self, values: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+        """Prometheus labels of a sample"""
+        pairs: List[Tuple[str, str]] = list(zip(self.labels, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{label}="{escape(value)}"' for label, value in pairs) + "}"
+
+    def samples(self) -> Iterator[str]:
+        """Lines of the samples"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """The metric family in the Prometheus text format"""
+        lines: List[str] = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Value that only goes up"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, description, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increments the counter of these labels"""
+        key: LabelValues = self.label_values(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.values.items():
+            yield f"{self.name}{self.format_labels(key)} {value}"
+
+
+class Gauge(Counter):
+    """Value that can go up & down"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        """Sets the gauge of these labels"""
+        self.values[self.label_values(labels)] = value
+
+    def remove(self, **labels: str) -> None:
+        """Drops the sample of these labels (device not polled anymore,...)"""
+        self.values.pop(self.label_values(labels), None)
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, description, labels)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        # Per labels: count of each bucket (not cumulative, +Inf last), sum
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Adds a value to the distribution of these labels"""
+        key: LabelValues = self.label_values(labels)
+        counts: Optional[List[int]] = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes the duration of the with block"""
+        start: float = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        for key, counts in self.counts.items():
+            cumulative: int = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le: str = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket{self.format_labels(key, ('le', le))} {cumulative}"
+            yield f"{self.name}_sum{self.format_labels(key)} {self.sums[key]}"
+            yield f"{self.name}_count{self.format_labels(key)} {cumulative}"
+
+
+REGISTRY: List[Metric] = []
+
+POLL_SECONDS = Histogram("naasgul_poll_seconds", "Duration of the poll of a device")
+DEVICE_POLL_SECONDS = Gauge(
+    "naasgul_device_poll_seconds", "Duration of the last poll of each device", ["device"]
+)
+PHASE_SECONDS = Histogram(
+    "naasgul_poll_phase_seconds",
+    "Duration of each phase of a poll (snmp wait, decode, format, db)",
+    ["phase"],
+)
+SNMP_REQUESTS = Counter("naasgul_snmp_requests_total", "SNMP requests (PDUs) sent", ["command"])
+SNMP_VARBINDS = Counter("naasgul_snmp_varbinds_total", "Var_binds received", ["command"])
+SNMP_ERRORS = Counter(
+    "naasgul_snmp_errors_total", "SNMP requests without answer (timeouts,...)", ["error"]
+)
+DEVICES_SKIPPED = Counter(
+    "naasgul_devices_skipped_total", "Polls skipped because the device looks down"
+)
+QUEUE_DEPTH = Gauge("naasgul_scheduler_queue_depth", "Devices waiting for their deadline")
+IN_FLIGHT = Gauge("naasgul_scheduler_in_flight", "Devices being polled")
+OVERRUNS = Counter("naasgul_poll_overruns_total", "Polls longer than the device interval")
+MISSED_DEADLINES = Counter(
+    "naasgul_missed_deadlines_total", "Polling slots skipped because of overruns"
+)
+DB_WRITE_SECONDS = Histogram(
+    "naasgul_db_write_seconds", "Duration of the db writes of a poll", ["collection"]
+)
+WRITE_QUEUE_DEPTH = Gauge("naasgul_write_queue_depth", "Polls results waiting to be written")
+DB_WRITTEN = Counter("naasgul_db_written_total", "Documents written", ["collection"])
+DB_WRITE_ERRORS = Counter(
+    "naasgul_db_write_errors_total", "Documents that couldn't be written", ["collection"]
+)
+SPOOLED = Counter(
+    "naasgul_spooled_total", "Polls results spooled to disk (queue full, db error)", ["reason"]
+)
+REPLAYED = Counter("naasgul_replayed_total", "Polls results replayed from the spool")
+SPOOL_BYTES = Gauge("naasgul_spool_bytes", "Size of the spool on disk")
+
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text format"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+async def handle_metrics_request(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """Minimal http handler: GET /metrics"""
+    try:
+        request_line: bytes = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # Headers are not needed
+        parts: List[str] = request_line.decode(errors="replace").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body: bytes = render_metrics().encode()
+            status: str = "200 OK"
+        else:
+            body = b"Not found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(
+    port: int = METRICS_PORT, host: str = METRICS_HOST
+) -> Optional[asyncio.AbstractServer]:
+    """Starts the metrics endpoint in the running loop (if port isn't 0)"""
+    if not port:
+        return None
+    server: asyncio.AbstractServer = await asyncio.start_server(handle_metrics_request, host, port)
+    print(f"Metrics available on http://{host}:{port}/metrics")
+    return server
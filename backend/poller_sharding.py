@@ -0,0 +1,72 @@
+"""Shares the devices between several stats pollers (processes
+or replicas). Each poller heartbeats into db & keeps the devices
+it owns by rendezvous hashing over the live pollers, so devices
+rebalance by themselves when a poller joins or dies."""
+#! /usr/bin/env python3
+
+from hashlib import blake2b
+from os import getenv, getpid
+from socket import gethostname
+from typing import List, Optional
+
+from db_layer import heartbeat_poller, get_live_pollers, remove_poller
+from poll_scheduler import PollTarget, REFRESH_INTERVAL
+
+# Unique id of this poller (the pod name on k8s)
+WORKER_ID: str = getenv("POLLER_ID") or f"{gethostname()}-{getpid()}"
+# A poller that didn't heartbeat for this long is considered dead.
+# Heartbeats are sent each time the scheduler refreshes its devices.
+POLLER_TTL: float = float(getenv("POLLER_TTL", str(3 * REFRESH_INTERVAL)))
+
+
+def hash_weight(worker_id: str, device_name: str) -> int:
+    """Weight of a (poller, device) couple. Has to be the same
+    in all pollers (python's hash() is randomized per process)"""
+    return int.from_bytes(
+        blake2b(f"{worker_id}|{device_name}".encode(), digest_size=8).digest(), "big"
+    )
+
+
+def owner_of(device_name: str, workers: List[str]) -> str:
+    """Rendezvous hashing: the device belongs to the poller with the
+    highest weight. When a poller leaves, only its devices move"""
+    return max(workers, key=lambda worker_id: hash_weight(worker_id, device_name))
+
+
+class ShardMembership:
+    """Membership of this poller among all pollers"""
+
+    def __init__(self, worker_id: str = WORKER_ID, ttl: float = POLLER_TTL) -> None:
+        self.worker_id: str = worker_id
+        self.ttl: float = ttl
+        self.workers: List[str] = [worker_id]
+
+    def refresh(self) -> None:
+        """Heartbeats & retrieves the live pollers"""
+        heartbeat_poller(self.worker_id)
+        workers: List[str] = get_live_pollers(self.ttl)
+        if self.worker_id not in workers:
+            workers.append(self.worker_id)
+        workers.sort()
+        if workers != self.workers:
+            print(f"Pollers changed, devices are rebalanced between: {workers}")
+        self.workers = workers
+
+    def owned(self, targets: List[PollTarget]) -> List[PollTarget]:
+        """Keeps the devices this poller is in charge of"""
+        self.refresh()
+        return [
+            target for target in targets if owner_of(target.name, self.workers) == self.worker_id
+        ]
+
+    def leave(self) -> None:
+        """Hands the devices over to the other pollers"""
+        remove_poller(self.worker_id)
+
+
+def worker_ids(nb_processes: int, worker_id: Optional[str] = None) -> List[str]:
+    """Ids of the local poller processes"""
+    base: str = worker_id or WORKER_ID
+    if nb_processes <= 1:
+        return [base]
+    return [f"{base}-{index}" for index in range(nb_processes)]
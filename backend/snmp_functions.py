@@ -3,13 +3,61 @@
 #! /usr/bin/env python3
 # pylint: disable=too-many-arguments
 
-from typing import List, Dict, Any, Union, Optional, Iterator, Tuple
+import asyncio
+import socket
+from os import getenv
+from time import time, monotonic
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+from typing import (
+    List,
+    Dict,
+    Any,
+    Union,
+    Optional,
+    Iterator,
+    Tuple,
+    Callable,
+    NamedTuple,
+    Sequence,
+    Awaitable,
+)
 from pysnmp import hlapi  # type: ignore
+from pysnmp.hlapi import asyncio as ahlapi  # type: ignore
 from pysnmp.entity.rfc3413.oneliner import cmdgen  # type: ignore
-
-# from pysnmp.error import PySnmpError # type: ignore
-
-IFACES_TABLE_TO_COUNT: str = "1.3.6.1.2.1.2.1.0"
+from pysnmp.proto.rfc1902 import ObjectName  # type: ignore
+from pysnmp.proto.rfc1905 import endOfMibView  # type: ignore
+from pysnmp.error import PySnmpError  # type: ignore
+from pyasn1.type.univ import Null, Integer, OctetString  # type: ignore
+from pyasn1.codec.ber.encoder import encode as ber_encode  # type: ignore
+from poller_metrics import SNMP_REQUESTS, SNMP_VARBINDS, SNMP_ERRORS, PHASE_SECONDS
+from snmp_tuning import (
+    SNMP_MAX_SESSIONS,
+    BulkSettings,
+    DeviceHealth,
+    get_bulk_settings,
+    get_device_health,
+)
+
+# Max number of snmp operations that can be awaited at the same time
+# by the asyncio functions (whatever the number of devices scrapped)
+SNMP_MAX_CONCURRENCY: int = int(getenv("SNMP_MAX_CONCURRENCY", "200"))
+# Both are tied to the loop they were created in
+_CONCURRENCY_LIMITS: "WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    WeakKeyDictionary()
+)
+_ASYNC_ENGINES: "WeakKeyDictionary[asyncio.AbstractEventLoop, hlapi.SnmpEngine]" = (
+    WeakKeyDictionary()
+)
+# Devices sessions eviction policy (see SnmpSession)
+SNMP_SESSION_TTL: int = int(getenv("SNMP_SESSION_TTL", "3600"))  # Max age of a session
+SNMP_SESSION_IDLE: int = int(getenv("SNMP_SESSION_IDLE", "900"))  # Max time without poll
+SNMP_TOO_BIG: int = 1  # error-status of a tooBig response
+# Max var_binds in a GET of get_rows_async (halved on tooBig)
+SNMP_GET_MAX_VARBINDS: int = int(getenv("SNMP_GET_MAX_VARBINDS", "64"))
+
+IFACES_TABLE_TO_COUNT: str = "1.3.6.1.2.1.2.1.0"  # ifNumber
+IFACES_TABLE_LAST_CHANGE: str = "1.3.6.1.2.1.31.1.5.0"  # ifTableLastChanged
 NEEDED_MIBS_FOR_STATS: Dict[str, str] = {
     "iface_name": "1.3.6.1.2.1.2.2.1.2",  # ifDescr
     "iface_alias": "1.3.6.1.2.1.31.1.1.1.18",  # ifAlias
@@ -40,6 +88,119 @@ NEEDED_MIBS_FOR_LLDP: Dict[str, str] = {
 }
 
 
+class IfaceStatsRecord(NamedTuple):
+    """Compact record of one interface decoded from a
+    NEEDED_MIBS_FOR_STATS bulk row (None when the device didn't return the column)"""
+
+    if_index: int
+    iface_name: Optional[str]
+    iface_alias: Optional[str]
+    mtu: Optional[int]
+    speed: Optional[int]
+    mac: Optional[str]
+    in_disc: Optional[int]
+    in_err: Optional[int]
+    out_disc: Optional[int]
+    out_err: Optional[int]
+    in_octets: Optional[int]
+    in_ucast_pkts: Optional[int]
+    in_mcast_pkts: Optional[int]
+    in_bcast_pkts: Optional[int]
+    out_octets: Optional[int]
+    out_ucast_pkts: Optional[int]
+    out_mcast_pkts: Optional[int]
+    out_bcast_pkts: Optional[int]
+
+
+class TableDecoder:
+    """Decodes raw rows (not resolved against MIBs) of a table walked column by
+    column. Columns oids are compiled once to field slots so a row is decoded by
+    comparing each var_bind with the prefix of its slot & taking its index
+    (instead of searching keys of a dict).
+    Values are converted depending on their pysnmp class (instead of trying
+    int/float/str like cast does) and the converter of each class is
+    only looked for once."""
+
+    def __init__(self, columns: Dict[str, str]) -> None:
+        self.fields: Tuple[str, ...] = tuple(columns)
+        # Oids to request (in this order) so var_binds of a row match the slots
+        self.oids: List[str] = list(columns.values())
+        self.prefixes: Tuple[Tuple[int, ...], ...] = tuple(
+            ObjectName(oid).asTuple() for oid in columns.values()
+        )
+        self.converters: Dict[type, Callable[[Any], Any]] = {}
+
+    @staticmethod
+    def find_converter(value_class: type) -> Callable[[Any], Any]:
+        """Returns how to convert a value of this pysnmp class"""
+        if issubclass(value_class, Integer):  # Counters, Gauges, TimeTicks,...
+            return int
+        if issubclass(value_class, Null):  # endOfMibView, noSuchInstance,...
+            return lambda _: None
+        if issubclass(value_class, OctetString):
+            return str
+        return cast
+
+    def decode_row(self, row: List[Any]) -> Optional[Tuple[int, List[Any]]]:
+        """Returns the index of the row and its values (one per column) or None
+        if no column of the row was in the table anymore"""
+        index: Optional[int] = None
+        values: List[Any] = [None] * len(self.prefixes)
+        for slot, (name, value) in enumerate(row[: len(self.prefixes)]):
+            oid: Tuple[int, ...] = name.asTuple()
+            prefix: Tuple[int, ...] = self.prefixes[slot]
+            if len(oid) <= len(prefix) or oid[: len(prefix)] != prefix:
+                # This column already left the table
+                continue
+            if index is None:
+                index = oid[len(prefix)]
+            elif oid[len(prefix)] != index:
+                # The device doesn't have this column for this index
+                continue
+            converter: Optional[Callable[[Any], Any]] = self.converters.get(value.__class__)
+            if converter is None:
+                converter = self.find_converter(value.__class__)
+                self.converters[value.__class__] = converter
+            values[slot] = converter(value)
+        if index is None:
+            return None
+        return index, values
+
+
+STATS_DECODER: TableDecoder = TableDecoder(
+    {field: NEEDED_MIBS_FOR_STATS[field] for field in IfaceStatsRecord._fields[1:]}
+)
+
+
+# Counters polled at a high rate on linked ifaces (the other columns change rarely).
+# Errors & discards are polled too: their rates are computed at each poll
+FAST_STATS_FIELDS: Tuple[str, ...] = (
+    "in_disc",
+    "in_err",
+    "out_disc",
+    "out_err",
+    "in_octets",
+    "in_ucast_pkts",
+    "in_mcast_pkts",
+    "in_bcast_pkts",
+    "out_octets",
+    "out_ucast_pkts",
+    "out_mcast_pkts",
+    "out_bcast_pkts",
+)
+FAST_STATS_DECODER: TableDecoder = TableDecoder(
+    {field: NEEDED_MIBS_FOR_STATS[field] for field in FAST_STATS_FIELDS}
+)
+
+
+def decode_stats_row(row: List[Any]) -> Optional[IfaceStatsRecord]:
+    """Decodes a raw NEEDED_MIBS_FOR_STATS bulk row into an IfaceStatsRecord"""
+    decoded: Optional[Tuple[int, List[Any]]] = STATS_DECODER.decode_row(row)
+    if decoded is None:
+        return None
+    return IfaceStatsRecord(decoded[0], *decoded[1])
+
+
 def get_snmp_creds(
     snmp_user: Optional[str] = "public",
     snmp_auth_pwd: Optional[str] = None,
@@ -203,8 +364,636 @@ def get_bulk_auto(
     return get_bulk(target, oids, credentials, count, start_from, port, engine, context)
 
 
-# Not an actual snmp func but it's used in the context of snmp scrapping
-def split_list(list_to_split: List[Any], size: int) -> Iterator[List[Any]]:
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(list_to_split), size):
-        yield list_to_split[i : i + size]
+def set_max_concurrency(limit: int) -> None:
+    """Changes the max number of snmp operations that the asyncio
+    functions can have in flight at the same time"""
+    global SNMP_MAX_CONCURRENCY  # pylint: disable=global-statement
+    SNMP_MAX_CONCURRENCY = max(limit, 1)
+    _CONCURRENCY_LIMITS.clear()
+
+
+def get_concurrency_limit() -> asyncio.Semaphore:
+    """Returns the semaphore bounding the asyncio snmp operations
+    of the current event loop (a semaphore is tied to its loop)"""
+    loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+    semaphore: Optional[asyncio.Semaphore] = _CONCURRENCY_LIMITS.get(loop)
+    if not semaphore:
+        semaphore = asyncio.Semaphore(SNMP_MAX_CONCURRENCY)
+        _CONCURRENCY_LIMITS[loop] = semaphore
+    return semaphore
+
+
+def get_async_engine() -> hlapi.SnmpEngine:
+    """Returns the SnmpEngine used by the asyncio functions of the current
+    event loop. It can't be shared with the sync functions (nor with another loop)
+    since its transport dispatcher is bound to the loop"""
+    loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+    engine: Optional[hlapi.SnmpEngine] = _ASYNC_ENGINES.get(loop)
+    if not engine:
+        engine = hlapi.SnmpEngine()
+        _ASYNC_ENGINES[loop] = engine
+    return engine
+
+
+async def get_async_transport(target: str, port: int = 161) -> ahlapi.UdpTransportTarget:
+    """Resolves the target without blocking the loop (pysnmp would call
+    a blocking getaddrinfo otherwise) and returns an asyncio transport"""
+    loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+    try:
+        addr_infos = await loop.getaddrinfo(
+            target, port, family=socket.AF_INET, type=socket.SOCK_DGRAM
+        )
+    except socket.gaierror as err:
+        raise PySnmpError(f"Bad IPv4/UDP transport address {target}@{port}: {err}") from err
+    return ahlapi.UdpTransportTarget((addr_infos[0][4][0], port))
+
+
+class SnmpSession:
+    """Everything about a device that can be kept from one poll to the next:
+    the engine, the transport (and thus the resolved address) and, for snmpv3,
+    what was learned during the engine discovery (peer engine ids & timeline).
+
+    pysnmp forgets discovered engines after 5 minutes which means a new discovery
+    (& sometimes a notInTimeWindow round trip) on each poll. The session puts them
+    back in the engine before each request. Keys localized for the peer engine id
+    are kept by the engine itself (in its USM table) as long as it lives.
+
+    Sessions are evicted when they are older than SNMP_SESSION_TTL (so the address
+    is resolved & the engine discovered again from time to time), unused for
+    SNMP_SESSION_IDLE, over SNMP_MAX_SESSIONS (least recently used first) or
+    when a request fails."""
+
+    def __init__(self, engine: hlapi.SnmpEngine, transport: ahlapi.UdpTransportTarget) -> None:
+        self.engine: hlapi.SnmpEngine = engine
+        self.transport: ahlapi.UdpTransportTarget = transport
+        self.created: float = time()
+        self.last_used: float = self.created
+        self.peer_engine: Optional[Dict[str, Any]] = None
+        self.peer_timeline: Optional[Tuple[Any, Any, Any, int]] = None
+        # What we put back into pysnmp caches (so we only remove our own entries):
+        # the engine ids cache entry & the timeline entry
+        self._restored: Tuple[Optional[Dict[str, Any]], Optional[Tuple[Any, Any, Any, int]]] = (
+            None,
+            None,
+        )
+
+    @property
+    def peer_engine_id(self) -> Any:
+        """Engine id of the device (if discovered)"""
+        return self.peer_engine["securityEngineId"] if self.peer_engine else None
+
+    def is_expired(self, now: float) -> bool:
+        """Tells if the session must be rebuilt"""
+        return now - self.created > SNMP_SESSION_TTL or now - self.last_used > SNMP_SESSION_IDLE
+
+    def _get_engine_caches(self) -> Tuple[Optional[Dict[Any, Any]], Optional[Dict[Any, Any]]]:
+        """Returns pysnmp (private) engine id cache & usm timeline. Those may
+        not exist anymore (or be something else) with another pysnmp version,
+        the session then only keeps the transport"""
+        # pylint: disable=protected-access
+        engine_ids: Any = getattr(
+            self.engine.messageProcessingSubsystems.get(3),
+            "_SnmpV3MessageProcessingModel__engineIdCache",
+            None,
+        )
+        timeline: Any = getattr(
+            self.engine.securityModels.get(3), "_SnmpUSMSecurityModel__timeline", None
+        )
+        if not isinstance(engine_ids, dict) or not isinstance(timeline, dict):
+            return None, None
+        return engine_ids, timeline
+
+    def save_peer_engine(self) -> None:
+        """Keeps what pysnmp discovered about the device engine
+        (only if its caches hold what this version of pysnmp does)"""
+        engine_ids, timeline = self._get_engine_caches()
+        if engine_ids is None or timeline is None:
+            return
+        key: Tuple[Any, Any] = (self.transport.transportDomain, self.transport.transportAddr)
+        peer_engine: Any = engine_ids.get(key)
+        if not isinstance(peer_engine, dict) or "securityEngineId" not in peer_engine:
+            return
+        self.peer_engine = dict(peer_engine)
+        peer_timeline: Any = timeline.get(self.peer_engine_id)
+        if is_timeline_entry(peer_timeline):
+            self.peer_timeline = peer_timeline
+
+    def restore_peer_engine(self) -> None:
+        """Puts back what was discovered about the device engine
+        if pysnmp already expired it"""
+        engine_ids, timeline = self._get_engine_caches()
+        if engine_ids is None or timeline is None or not self.peer_engine:
+            return
+        key: Tuple[Any, Any] = (self.transport.transportDomain, self.transport.transportAddr)
+        restored_engine: Optional[Dict[str, Any]] = None
+        restored_timeline: Optional[Tuple[Any, Any, Any, int]] = None
+        if key not in engine_ids:
+            restored_engine = engine_ids[key] = dict(self.peer_engine)
+        if self.peer_timeline and self.peer_engine_id not in timeline:
+            boots, engine_time, latest_received, last_update = self.peer_timeline
+            # Engine time keeps going on the device while we're not polling
+            elapsed: int = int(time()) - last_update
+            restored_timeline = timeline[self.peer_engine_id] = (
+                boots,
+                add_engine_time(engine_time, elapsed),
+                add_engine_time(latest_received, elapsed),
+                last_update + elapsed,
+            )
+        self._restored = (restored_engine, restored_timeline)
+
+    def forget_peer_engine(self) -> None:
+        """Removes what the session put back into pysnmp caches so the
+        next poll of the device goes through a real discovery.
+        (entries added by pysnmp itself are left to its own expiration)"""
+        engine_ids, timeline = self._get_engine_caches()
+        if engine_ids is None or timeline is None:
+            return
+        key: Tuple[Any, Any] = (self.transport.transportDomain, self.transport.transportAddr)
+        restored_engine, restored_timeline = self._restored
+        if restored_engine is not None and engine_ids.get(key) is restored_engine:
+            del engine_ids[key]
+        if restored_timeline is not None and timeline.get(self.peer_engine_id) is restored_timeline:
+            del timeline[self.peer_engine_id]
+        self.peer_engine = self.peer_timeline = None
+        self._restored = (None, None)
+
+
+def is_engine_time(value: Any) -> bool:
+    """An engine time of the usm timeline: a pyasn1 Integer (or an int)"""
+    return isinstance(value, (int, Integer))
+
+
+def is_timeline_entry(entry: Any) -> bool:
+    """An entry of the usm timeline: (boots, engine time, latest received
+    engine time, last update timestamp), as pysnmp 4 keeps them"""
+    return (
+        isinstance(entry, tuple)
+        and len(entry) == 4
+        and is_engine_time(entry[1])
+        and is_engine_time(entry[2])
+        and isinstance(entry[3], int)
+    )
+
+
+def add_engine_time(value: Any, elapsed: int) -> Any:
+    """Engine time elapsed seconds later (of the same class)"""
+    if isinstance(value, int):
+        return value + elapsed
+    return value.clone(value + elapsed)
+
+
+# Sessions by (target, port), from the least recently used to the most recent one
+SnmpSessions = OrderedDict[Tuple[str, int], SnmpSession]
+_SESSIONS: "WeakKeyDictionary[asyncio.AbstractEventLoop, SnmpSessions]" = WeakKeyDictionary()
+
+
+def get_sessions() -> SnmpSessions:
+    """Returns the sessions of the current event loop (they use its engine)"""
+    loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+    sessions: Optional[SnmpSessions] = _SESSIONS.get(loop)
+    if sessions is None:
+        sessions = OrderedDict()
+        _SESSIONS[loop] = sessions
+    return sessions
+
+
+async def get_session(target: str, port: int = 161) -> SnmpSession:
+    """Returns the session of a device, creating it if it doesn't exist
+    yet (or has expired). Also applies the eviction policy"""
+    sessions: SnmpSessions = get_sessions()
+    now: float = time()
+    session: Optional[SnmpSession] = sessions.get((target, port))
+    if session and session.is_expired(now):
+        evict_session(target, port)
+        session = None
+    if not session:
+        transport: ahlapi.UdpTransportTarget = await get_async_transport(target, port)
+        # Might have been created by another coroutine while we were resolving
+        session = sessions.get((target, port)) or SnmpSession(get_async_engine(), transport)
+        sessions[(target, port)] = session
+    sessions.move_to_end((target, port))
+    session.last_used = now
+
+    # Sessions are ordered from the least recently used so
+    # we only have to look at the first ones
+    while sessions:
+        oldest: SnmpSession = next(iter(sessions.values()))
+        if len(sessions) <= SNMP_MAX_SESSIONS and not oldest.is_expired(now):
+            break
+        sessions.popitem(last=False)[1].forget_peer_engine()
+
+    session.restore_peer_engine()
+    return session
+
+
+def evict_session(target: str, port: int = 161) -> None:
+    """Forgets everything about a device (called when a request failed
+    since the device may have changed its address, engine id,...)"""
+    session: Optional[SnmpSession] = get_sessions().pop((target, port), None)
+    if session:
+        session.forget_peer_engine()
+
+
+def var_binds_to_dict(var_binds: List[Any]) -> Dict[str, Any]:
+    """Converts a row of var_binds to a dict (oid -> casted value)
+    like fetch does"""
+    return {str(var_bind[0]): cast(var_bind[1]) for var_bind in var_binds}
+
+
+def check_session_errors(target: str, port: int, error_indication: Any, error_status: Any) -> None:
+    """Raises the same error as fetch when an asyncio snmp
+    call returned an error (and evicts the device session)"""
+    if error_indication or error_status:
+        evict_session(target, port)
+        raise RuntimeError(f"Got SNMP error: {error_indication or error_status.prettyPrint()}")
+
+
+class SnmpResponse(NamedTuple):
+    """What an asyncio hlapi command returns"""
+
+    error_indication: Any
+    error_status: Any
+    error_index: Any
+    var_binds: Any
+
+    def too_big(self) -> bool:
+        """The agent answered tooBig (the request has to be made smaller)"""
+        return not self.error_indication and self.error_status == SNMP_TOO_BIG
+
+
+async def send_request(
+    target: str, port: int, command: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any
+) -> SnmpResponse:
+    """Sends an asyncio hlapi command with the timeout & retries fitting the
+    device (args must contain its session transport) & records its health"""
+    health: DeviceHealth = get_device_health(target, port)
+    transport: ahlapi.UdpTransportTarget = next(
+        arg for arg in args if isinstance(arg, ahlapi.UdpTransportTarget)
+    )
+    transport.timeout = health.timeout()
+    transport.retries = health.retries()
+    start: float = monotonic()
+    response: SnmpResponse = SnmpResponse(*await command(*args, **kwargs))
+    PHASE_SECONDS.observe(monotonic() - start, phase="snmp")
+    SNMP_REQUESTS.inc(command=command.__name__)
+    SNMP_VARBINDS.inc(
+        sum(len(row) if isinstance(row, list) else 1 for row in response.var_binds or ()),
+        command=command.__name__,
+    )
+    if response.error_indication:  # No (valid) answer
+        SNMP_ERRORS.inc(error=response.error_indication.__class__.__name__)
+        delay: Optional[float] = health.record_failure(monotonic())
+        if delay is not None:
+            print(
+                f"{target}:{port} looks down ({response.error_indication}),"
+                f" next try in {delay:.0f}s"
+            )
+    else:
+        health.record_success(monotonic() - start)
+    return response
+
+
+async def get_async(
+    target: str,
+    oids: List[str],
+    credentials: Union[hlapi.CommunityData, hlapi.UsmUserData],
+    port: int = 161,
+    engine: Optional[hlapi.SnmpEngine] = None,
+    context: hlapi.ContextData = hlapi.ContextData(),
+) -> Dict[str, Any]:
+    """asyncio version of get"""
+    async with get_concurrency_limit():
+        session: SnmpSession = await get_session(target, port)
+        error_indication, error_status, _, var_binds = await send_request(
+            target,
+            port,
+            ahlapi.getCmd,
+            engine or session.engine,
+            credentials,
+            session.transport,
+            context,
+            *construct_object_types(oids),
+        )
+    check_session_errors(target, port, error_indication, error_status)
+    session.save_peer_engine()
+    return var_binds_to_dict(var_binds)
+
+
+def encoded_size(row: List[Any]) -> int:
+    """Approximate size (BER) of a row of var_binds in a response"""
+    size: int = 0
+    for name, value in row:
+        oid: ObjectName = name if isinstance(name, ObjectName) else name.getOid()
+        # 4 bytes of var_bind sequence & oid headers
+        size += 4 + len(oid.asTuple()) + len(ber_encode(value))
+    return size
+
+
+class BulkTooBig(RuntimeError):
+    """The agent can't answer even a single row of the columns asked"""
+
+
+def handle_bulk_response(
+    target: str,
+    port: int,
+    response: SnmpResponse,
+    rows: List[List[Any]],
+    count: int,
+    asked: int,
+    settings: BulkSettings,
+) -> List[Any]:
+    """Adds the rows of a GETBULK response to rows & learns the sizing of the device
+    from it. Returns the var_binds to ask next (none when the walk is over)"""
+    check_session_errors(target, port, response.error_indication, response.error_status)
+    var_bind_table: List[List[Any]] = response.var_binds
+    if not var_bind_table:
+        return []
+    rows.extend(var_bind_table[: count - len(rows)])
+    if ahlapi.isEndOfMib(var_bind_table[-1]):
+        return []
+    if len(var_bind_table) < asked:
+        # The agent truncated the response to what it can send
+        settings.agent_limit = max(len(var_bind_table), 1)
+    settings.learn_row_size(encoded_size(var_bind_table[0]))
+    return [
+        (name if isinstance(name, ObjectName) else name.getOid(), Null(""))
+        for name, _ in var_bind_table[-1]
+    ]
+
+
+async def walk_bulk_columns(
+    engine: hlapi.SnmpEngine,
+    session: SnmpSession,
+    target: str,
+    port: int,
+    credentials: Union[hlapi.CommunityData, hlapi.UsmUserData],
+    context: hlapi.ContextData,
+    oids: List[str],
+    count: int,
+    start_from: int,
+    settings: BulkSettings,
+    lookup_mib: bool,
+) -> List[List[Any]]:
+    """Gets count rows of some columns, sizing each GETBULK from the
+    responses already received & backing off when the agent answers tooBig"""
+    rows: List[List[Any]] = []
+    var_binds: List[Any] = construct_object_types(oids)
+    while var_binds and len(rows) < count:
+        asked: int = min(settings.max_repetitions, count - len(rows))
+        response: SnmpResponse = await send_request(
+            target,
+            port,
+            ahlapi.bulkCmd,
+            engine,
+            credentials,
+            session.transport,
+            context,
+            start_from,
+            asked,
+            *var_binds,
+            lookupMib=lookup_mib,
+        )
+        if response.too_big():
+            if settings.max_repetitions <= 1:
+                raise BulkTooBig(f"Got SNMP error: tooBig for {len(oids)} columns")
+            settings.back_off()
+            continue
+        var_binds = handle_bulk_response(target, port, response, rows, count, asked, settings)
+    return rows
+
+
+async def get_bulk_async(
+    target: str,
+    oids: List[str],
+    credentials: Union[hlapi.CommunityData, hlapi.UsmUserData],
+    count: int,
+    start_from: int = 0,
+    port: int = 161,
+    engine: Optional[hlapi.SnmpEngine] = None,
+    context: hlapi.ContextData = hlapi.ContextData(),
+    row_decoder: Optional[Callable[[List[Any]], Any]] = None,
+) -> List[Any]:
+    """asyncio version of get_bulk. The asyncio bulkCmd only sends 1 PDU
+    so we keep asking from the last row received till we get 'count' rows.
+    Requests are sized (max-repetitions & columns per request) from the
+    responses of the device, these settings are remembered for the next polls.
+
+    Rows are returned as dicts (like get_bulk) unless a row_decoder is passed.
+    In this case, the raw rows (not resolved against MIBs, which is costly) are
+    passed to the decoder and rows it decodes to None are discarded"""
+    settings: BulkSettings = get_bulk_settings(target, port, len(oids))
+    if start_from:
+        # Non repeaters are only meaningful when all columns are asked at once
+        settings.group_size = len(oids)
+    rows: List[List[Any]] = []
+    async with get_concurrency_limit():
+        session: SnmpSession = await get_session(target, port)
+        while True:
+            try:
+                for first in range(0, len(oids), settings.group_size):
+                    group_rows: List[List[Any]] = await walk_bulk_columns(
+                        engine or session.engine,
+                        session,
+                        target,
+                        port,
+                        credentials,
+                        context,
+                        oids[first : first + settings.group_size],
+                        count,
+                        start_from,
+                        settings,
+                        row_decoder is None,
+                    )
+                    # Groups rows are put back together by position
+                    # (the decoder discards rows whose indexes differ)
+                    if first:
+                        rows = [row + group_row for row, group_row in zip(rows, group_rows)]
+                    else:
+                        rows = group_rows
+                break
+            except BulkTooBig:
+                rows = []
+                if not settings.back_off():
+                    evict_session(target, port)
+                    raise
+    session.save_peer_engine()
+
+    with PHASE_SECONDS.time(phase="decode"):
+        return decode_rows(rows, row_decoder)
+
+
+def decode_rows(
+    rows: List[List[Any]], row_decoder: Optional[Callable[[List[Any]], Any]] = None
+) -> List[Any]:
+    """Rows as dicts (without decoder) or as decoded by row_decoder
+    (rows it decodes to None are discarded)"""
+    if row_decoder is None:
+        return [var_binds_to_dict(row) for row in rows]
+    result: List[Any] = []
+    for row in rows:
+        decoded: Any = row_decoder(row)
+        if decoded is not None:
+            result.append(decoded)
+    return result
+
+
+async def get_bulk_auto_async(
+    target: str,
+    oids: List[str],
+    credentials: Union[hlapi.CommunityData, hlapi.UsmUserData],
+    count_oid: str,
+    start_from: int = 0,
+    port: int = 161,
+    engine: Optional[hlapi.SnmpEngine] = None,
+    context: hlapi.ContextData = hlapi.ContextData(),
+    row_decoder: Optional[Callable[[List[Any]], Any]] = None,
+) -> List[Any]:
+    """asyncio version of get_bulk_auto"""
+
+    count: int = (await get_async(target, [count_oid], credentials, port, engine, context))[
+        count_oid
+    ]
+
+    return await get_bulk_async(
+        target, oids, credentials, count, start_from, port, engine, context, row_decoder
+    )
+
+
+def rows_var_binds(
+    decoder: TableDecoder, indexes: List[int], scalar_oids: Sequence[str]
+) -> List[Tuple[ObjectName, Null]]:
+    """Var_binds to GET some scalars & the columns of the decoder for some indexes"""
+    return [(ObjectName(oid), Null("")) for oid in scalar_oids] + [
+        (ObjectName(prefix + (index,)), Null(""))
+        for index in indexes
+        for prefix in decoder.prefixes
+    ]
+
+
+def decode_rows_response(
+    decoder: TableDecoder,
+    var_binds: List[Any],
+    scalar_oids: Sequence[str],
+    rows: Dict[int, List[Any]],
+    scalars: Dict[str, Any],
+) -> None:
+    """Stores the scalars & the decoded rows of a response to rows_var_binds"""
+    for oid, (_, value) in zip(scalar_oids, var_binds):
+        scalars[oid] = cast(value)
+    nb_columns: int = len(decoder.prefixes)
+    for first in range(len(scalar_oids), len(var_binds), nb_columns):
+        decoded: Optional[Tuple[int, List[Any]]] = decoder.decode_row(
+            var_binds[first : first + nb_columns]
+        )
+        if decoded is not None:
+            rows[decoded[0]] = decoded[1]
+
+
+async def get_rows_async(
+    target: str,
+    decoder: TableDecoder,
+    indexes: List[int],
+    credentials: Union[hlapi.CommunityData, hlapi.UsmUserData],
+    port: int = 161,
+    engine: Optional[hlapi.SnmpEngine] = None,
+    context: hlapi.ContextData = hlapi.ContextData(),
+    scalar_oids: Sequence[str] = (),
+) -> Tuple[Dict[int, List[Any]], Dict[str, Any]]:
+    """Sparse version of get_bulk_async: GETs the columns of the decoder for
+    some indexes only (instead of walking the whole table).
+    Returns the decoded values by index (None for instances the device doesn't have)
+    and the (casted) values of the scalar_oids, asked in the first request"""
+    rows: Dict[int, List[Any]] = {}
+    scalars: Dict[str, Any] = {}
+    rows_per_request: int = max(1, SNMP_GET_MAX_VARBINDS // len(decoder.prefixes))
+    position: int = 0
+    async with get_concurrency_limit():
+        session: SnmpSession = await get_session(target, port)
+        while position < len(indexes) or len(scalars) < len(scalar_oids):
+            scalars_asked: Sequence[str] = scalar_oids if not scalars else ()
+            response: SnmpResponse = await send_request(
+                target,
+                port,
+                ahlapi.getCmd,
+                engine or session.engine,
+                credentials,
+                session.transport,
+                context,
+                *rows_var_binds(
+                    decoder, indexes[position : position + rows_per_request], scalars_asked
+                ),
+                lookupMib=False,
+            )
+            if response.too_big() and rows_per_request > 1:
+                rows_per_request //= 2
+                continue
+            check_session_errors(target, port, response.error_indication, response.error_status)
+            decode_rows_response(decoder, response.var_binds, scalars_asked, rows, scalars)
+            position += rows_per_request
+    session.save_peer_engine()
+    return rows, scalars
+
+
+def walk_response_row(
+    target: str,
+    port: int,
+    response: SnmpResponse,
+    initial_names: List[ObjectName],
+    names: List[ObjectName],
+) -> Optional[List[Tuple[Any, Any]]]:
+    """Row of a getnext response of walk_async (columns out of their initial
+    oid are marked endOfMibView). None when all of them left it"""
+    check_session_errors(target, port, response.error_indication, response.error_status)
+    if not response.var_binds:
+        return None
+    row: List[Tuple[Any, Any]] = []
+    for col, (name, value) in enumerate(response.var_binds[0]):
+        oid: ObjectName = name.getOid()
+        if isinstance(value, Null) or not initial_names[col].isPrefixOf(oid):
+            # Out of the column, we keep asking for the last oid of this column
+            # so the other ones can go on
+            row.append((names[col], endOfMibView))
+        else:
+            row.append((oid, value))
+    if all(value is endOfMibView for _, value in row):
+        return None
+    return row
+
+
+async def walk_async(
+    target: str,
+    oids: List[str],
+    credentials: Union[hlapi.CommunityData, hlapi.UsmUserData],
+    port: int = 161,
+    engine: Optional[hlapi.SnmpEngine] = None,
+    context: hlapi.ContextData = hlapi.ContextData(),
+    max_rows: int = 1000,
+) -> List[Dict[str, Any]]:
+    """asyncio version of get_table. Walks the columns with getnext
+    and stops when all of them left their initial oid
+    (same as the sync nextCmd with lexicographicMode=False)"""
+    result: List[Dict[str, Any]] = []
+    names: List[ObjectName] = [ObjectName(oid) for oid in oids]
+    initial_names: List[ObjectName] = list(names)
+    async with get_concurrency_limit():
+        session: SnmpSession = await get_session(target, port)
+        while len(result) < max_rows:
+            response: SnmpResponse = await send_request(
+                target,
+                port,
+                ahlapi.nextCmd,
+                engine or session.engine,
+                credentials,
+                session.transport,
+                context,
+                *[(name, Null("")) for name in names],
+            )
+            row: Optional[List[Tuple[Any, Any]]] = walk_response_row(
+                target, port, response, initial_names, names
+            )
+            if row is None:
+                break
+            result.append(var_binds_to_dict(row))
+            names = [oid for oid, _ in row]
+    session.save_peer_engine()
+    return result
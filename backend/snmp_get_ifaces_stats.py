@@ -3,106 +3,460 @@ to get interfaces stats for a lot of devices.
 Datas retrieved are then stored into db."""
 #! /usr/bin/env python3
 
-from os import getenv
+from os import getenv, replace
 import asyncio
+import json
+from multiprocessing import get_context
+from multiprocessing.process import BaseProcess
+from signal import signal, SIGTERM
+from sys import exit as sys_exit
+from functools import partial
 from itertools import groupby
 from binascii import hexlify
-from time import time, sleep
-from typing import List, Dict, Tuple, Optional, Any, Union
-from pymongo.errors import InvalidOperation  # type: ignore
+from time import time, perf_counter
+from typing import List, Dict, Tuple, Optional, Any, Union, Set, Callable, NamedTuple
+from pymongo.errors import PyMongoError  # type: ignore
 from pysnmp.error import PySnmpError  # type: ignore
 from pysnmp import hlapi  # type: ignore
-from dpath.util import search  # type: ignore
 from db_layer import (
     prep_db_if_not_exist,
-    bulk_update_collection,
-    add_iface_stats,
     get_all_nodes,
     get_nodes_by_patterns,
-    get_latest_utilization,
-    UTILIZATION_COLLECTION,
+    get_latest_utilizations,
+    get_linked_ifaces,
+    get_ifindexes,
+    save_ifindexes,
+    drop_expired_stats_partitions,
+    utilization_rate,
+    UTILIZATION_TTL,
+    STATS_COUNTERS,
+    STATS_RATES,
 )
 from snmp_functions import (
-    get_bulk_auto,
+    get_async,
+    get_bulk_async,
+    get_rows_async,
     get_snmp_creds,
-    NEEDED_MIBS_FOR_STATS as NEEDED_MIBS,
+    decode_stats_row,
+    IfaceStatsRecord,
+    STATS_DECODER,
+    FAST_STATS_DECODER,
+    FAST_STATS_FIELDS,
     IFACES_TABLE_TO_COUNT,
-    split_list,
+    IFACES_TABLE_LAST_CHANGE,
 )
+from snmp_tuning import is_device_available
+from poll_scheduler import PollScheduler, PollTarget
+from poller_metrics import (
+    serve_metrics,
+    DEVICES_SKIPPED,
+    PHASE_SECONDS,
+    METRICS_PORT,
+)
+from poller_sharding import ShardMembership, WORKER_ID, worker_ids
+from stats_writer import StatsWriter, StatsBatch, write_batches
+from stats_spool import StatsSpool, SPOOL_DIR
 
 SNMP_USR: Optional[str] = getenv("SNMP_USR")
 SNMP_AUTH_PWD: Optional[str] = getenv("SNMP_AUTH_PWD")
 SNMP_PRIV_PWD: Optional[str] = getenv("SNMP_PRIV_PWD")
 TEST_CASE: Optional[str] = getenv("AUTOMAP_TEST_CASE")
-NB_THREADS: str = getenv("AUTOMAP_NB_THREADS", "10")
+# Default interval (seconds) between 2 polls of a device, can be
+# overridden per device by the "poll_interval" field of its node
+POLL_INTERVAL: float = float(getenv("STATS_POLL_INTERVAL", "60"))
 NODES_PATTERNS: Optional[str] = getenv("NODES_PATTERNS")
+# Where the last utilizations are snapshotted so a restart doesn't have to query them
+STATE_FILE: str = getenv("STATS_STATE_FILE", "stats_state.json")
+# Share the devices with the other pollers (replicas) that heartbeat into db
+SHARDING: bool = bool(getenv("STATS_SHARDING"))
+# Number of local poller processes sharing the devices (to use all cores)
+NB_PROCESSES: int = int(getenv("STATS_POLLER_PROCESSES", "1"))
+STATE_SNAPSHOT_INTERVAL: int = int(getenv("STATS_STATE_SNAPSHOT_INTERVAL", "60"))
+# How often stats partitions older than STATS_RETENTION_DAYS are dropped
+RETENTION_INTERVAL: int = int(getenv("STATS_RETENTION_INTERVAL", "3600"))
 
+# Last utilization & timestamp of each (device, iface) dumped by this scrapper.
+# Avoids reading the utilization collection before each update.
+UTILIZATION_STATE: Dict[Tuple[str, str], Tuple[int, int]] = {}
+# Devices for which UTILIZATION_STATE was already filled
+STATE_DEVICES: Set[str] = set()
+# Timestamp & counters (STATS_COUNTERS order) of the last poll of each
+# (device, iface) to compute the rates stored with the stats & added to the rollups
+COUNTERS_STATE: Dict[Tuple[str, str], Tuple[int, Tuple[int, ...]]] = {}
+# Counter32 of the ifTable, the others are 64 bits counters of the ifXTable
+COUNTERS_32_BITS: Set[str] = {"in_discards", "in_errors", "out_discards", "out_errors"}
+# Infos (alias, mtu, mac, speed) of each (device, iface) last sent to the ifaces
+# collection & when. An iface is only upserted when its infos change or
+# every IFACES_REFRESH_INTERVAL seconds (so its last_seen stays meaningful)
+IFACES_STATE: Dict[Tuple[str, str], Tuple[Tuple[Any, ...], int]] = {}
+IFACES_REFRESH_INTERVAL: int = int(getenv("STATS_IFACES_REFRESH_INTERVAL", "3600"))
+# Whole ifaces table (metadata & all ifaces) is walked every FULL_POLL_INTERVAL seconds.
+# In between, only the counters of linked ifaces are polled. 0 always walks the whole table.
+FULL_POLL_INTERVAL: float = float(getenv("STATS_FULL_POLL_INTERVAL", "900"))
+DEVICE_TABLES: Dict[str, "DeviceTable"] = {}
+IFACE_REGISTRIES: Dict[str, "IfaceRegistry"] = {}
+# Write-behind stage of the running poller (results are dumped right away without it)
+STATS_WRITER: Optional[StatsWriter] = None
 
-def dump_results_to_db(  # pylint: disable=too-many-locals
-    device_name: str, ifaces_infos: List[Dict[str, str]]
-) -> None:
-    """Format retrieved snmp datas & dumps them into db"""
-    utilization_list: List[Tuple[Dict[str, str], Dict[str, str]]] = []
-    stats_list: List[Dict[str, str]] = []
+
+def load_utilization_state(state_file: str = STATE_FILE) -> None:
+    """Loads the last utilizations snapshotted by a previous run"""
+    try:
+        with open(state_file, encoding="UTF-8") as state:
+            snapshot: Dict[str, Dict[str, List[int]]] = json.load(state)
+    except (OSError, ValueError) as err:
+        print(f"No utilization state loaded ({err}), it will be retrieved from db")
+        return
+    for device_name, ifaces in snapshot.items():
+        for iface_name, (utilization, timestamp) in ifaces.items():
+            UTILIZATION_STATE[(device_name, iface_name)] = (utilization, timestamp)
+        STATE_DEVICES.add(device_name)
+
+
+def save_utilization_state(state_file: str = STATE_FILE) -> None:
+    """Snapshots the last utilizations to disk (written aside first
+    so a crash can't leave a truncated state)"""
+    snapshot: Dict[str, Dict[str, Tuple[int, int]]] = {}
+    for (device_name, iface_name), utilization in UTILIZATION_STATE.items():
+        snapshot.setdefault(device_name, {})[iface_name] = utilization
+    try:
+        with open(f"{state_file}.tmp", "w", encoding="UTF-8") as state:
+            json.dump(snapshot, state)
+        replace(f"{state_file}.tmp", state_file)
+    except OSError as err:
+        print(f"Can't snapshot utilization state: {err}")
+
+
+def load_previous_utilizations(device_name: str) -> None:
+    """Reads the last utilizations of all the ifaces of a device
+    from db (in one query) when the device is not known yet"""
+    if device_name in STATE_DEVICES:
+        return
+    for db_iface_name, utilization in get_latest_utilizations(device_name).items():
+        UTILIZATION_STATE.setdefault((device_name, db_iface_name), utilization)
+    STATE_DEVICES.add(device_name)
+
+
+def get_previous_utilization(device_name: str, iface_name: str) -> Tuple[int, int]:
+    """Returns the last utilization & timestamp of an iface
+    (loaded beforehand by load_previous_utilizations)"""
+    return UTILIZATION_STATE.get((device_name, iface_name), (0, 0))
+
+
+def keep_devices_state(device_names: Set[str]) -> None:
+    """Forgets the state of the devices polled by another poller now,
+    it would be outdated if they come back to this one"""
+    for device_name in set(DEVICE_TABLES) - device_names:
+        del DEVICE_TABLES[device_name]
+    for device_name in set(IFACE_REGISTRIES) - device_names:
+        del IFACE_REGISTRIES[device_name]
+    for device_name in STATE_DEVICES - device_names:
+        STATE_DEVICES.discard(device_name)
+    for device_name, iface_name in list(UTILIZATION_STATE):
+        if device_name not in device_names:
+            del UTILIZATION_STATE[(device_name, iface_name)]
+    for device_name, iface_name in list(COUNTERS_STATE):
+        if device_name not in device_names:
+            del COUNTERS_STATE[(device_name, iface_name)]
+    for device_name, iface_name in list(IFACES_STATE):
+        if device_name not in device_names:
+            del IFACES_STATE[(device_name, iface_name)]
+
+
+def is_ignored_iface(iface_name: str) -> bool:
+    """Ifaces for which no stats are stored"""
+    ifname: str = iface_name.lower()
+    # To do: Mgmt ifaces/lo & po could actually be interesting... Need to think about this
+    return (  # pylint: disable=too-many-boolean-expressions
+        ifname.startswith("se")
+        or ifname.startswith("nu")
+        or ifname.startswith("lo")
+        or ifname.startswith("mgm")
+        or ifname.startswith("ma")
+        or ifname.startswith("po")
+        or ifname == "vlan1"
+    )
+
+
+def short_iface_name(iface_name: str) -> str:
+    """Strips "Et, Ethernet, E,... " which can be different per equipment
+    (the name used in db & links)"""
+    return "/".join(
+        "".join(x)
+        for is_number, x in groupby(iface_name.lower(), key=str.isdigit)
+        if is_number is True
+    )
+
+
+class IfaceEntry(NamedTuple):
+    """What is known about an ifIndex of a device"""
+
+    iface_name: str  # Short name (as in db & links)
+    ignored: bool  # No stats are stored for this iface
+    linked: bool  # Part of a link
+
+
+class IfaceRegistry:
+    """ifIndex -> iface of a device (kept in memory & db). It is only rebuilt
+    (from ifDescr) when ifNumber or ifTableLastChanged moves so polls don't
+    have to process ifaces names"""
+
+    def __init__(self, if_number: int, last_changed: int, ifaces: Dict[int, IfaceEntry]) -> None:
+        self.if_number: int = if_number
+        self.last_changed: int = last_changed
+        self.ifaces: Dict[int, IfaceEntry] = ifaces
+        self.linked_indexes: List[int] = self.find_linked_indexes()
+
+    @classmethod
+    def from_records(
+        cls,
+        if_number: int,
+        last_changed: int,
+        records: List[IfaceStatsRecord],
+        linked_ifaces: Set[str],
+    ) -> "IfaceRegistry":
+        """Builds the registry from a full walk of the ifaces table"""
+        ifaces: Dict[int, IfaceEntry] = {}
+        for record in records:
+            if record.iface_name is None:
+                continue
+            iface_name: str = short_iface_name(record.iface_name)
+            ifaces[record.if_index] = IfaceEntry(
+                iface_name, is_ignored_iface(record.iface_name), iface_name in linked_ifaces
+            )
+        return cls(if_number, last_changed, ifaces)
+
+    @classmethod
+    def from_db(cls, registry: Dict[str, Any]) -> "IfaceRegistry":
+        """Builds the registry from its db document"""
+        return cls(
+            registry["if_number"],
+            registry["last_changed"],
+            {
+                iface["if_index"]: IfaceEntry(
+                    iface["iface_name"], iface["ignored"], iface["linked"]
+                )
+                for iface in registry["ifaces"]
+            },
+        )
+
+    def to_db(self) -> Dict[str, Any]:
+        """Returns the db document of the registry"""
+        return {
+            "if_number": self.if_number,
+            "last_changed": self.last_changed,
+            "ifaces": [
+                dict(iface._asdict(), if_index=index) for index, iface in self.ifaces.items()
+            ],
+        }
+
+    def find_linked_indexes(self) -> List[int]:
+        """ifIndexes of the ifaces polled between full walks"""
+        return [index for index, iface in self.ifaces.items() if iface.linked and not iface.ignored]
+
+    def matches(self, if_number: int, last_changed: int) -> bool:
+        """The ifaces of the device didn't change since the registry was built"""
+        return self.if_number == if_number and self.last_changed == last_changed
+
+    def update_links(self, linked_ifaces: Set[str]) -> bool:
+        """Updates the link membership of the ifaces. Returns True if it changed"""
+        changed: bool = False
+        for index, iface in self.ifaces.items():
+            linked: bool = iface.iface_name in linked_ifaces
+            if linked != iface.linked:
+                self.ifaces[index] = iface._replace(linked=linked)
+                changed = True
+        if changed:
+            self.linked_indexes = self.find_linked_indexes()
+        return changed
+
+
+def as_int(value: Any) -> int:
+    """Scalars the device doesn't have are compared as 0"""
+    return value if isinstance(value, int) else 0
+
+
+async def get_iface_registry(device_name: str) -> Optional[IfaceRegistry]:
+    """Returns the ifIndexes registry of a device, from db the
+    first time it is polled by this scrapper"""
+    registry: Optional[IfaceRegistry] = IFACE_REGISTRIES.get(device_name)
+    if registry is None:
+        registry_doc: Optional[Dict[str, Any]] = await asyncio.get_event_loop().run_in_executor(
+            None, get_ifindexes, device_name
+        )
+        if registry_doc is not None:
+            registry = IFACE_REGISTRIES[device_name] = IfaceRegistry.from_db(registry_doc)
+    return registry
+
+
+async def refresh_iface_registry(
+    device_name: str, if_number: int, last_changed: int, records: List[IfaceStatsRecord]
+) -> IfaceRegistry:
+    """Rebuilds the registry of a device after a full walk if its ifaces
+    changed (else only the link membership is refreshed) & stores it.
+    The db is used from the executor so polls of the other devices go on"""
+    loop = asyncio.get_event_loop()
+    linked_ifaces: Set[str] = await loop.run_in_executor(None, get_linked_ifaces, device_name)
+    registry: Optional[IfaceRegistry] = await get_iface_registry(device_name)
+    if registry is None or not registry.matches(if_number, last_changed):
+        registry = IfaceRegistry.from_records(if_number, last_changed, records, linked_ifaces)
+    elif not registry.update_links(linked_ifaces):
+        return registry
+    IFACE_REGISTRIES[device_name] = registry
+    try:
+        await loop.run_in_executor(None, save_ifindexes, device_name, registry.to_db())
+    except PyMongoError as err:
+        # Still used from memory, the results of the poll are not lost
+        print(f"Can't save the ifIndexes registry of {device_name}: {err}")
+    return registry
+
+
+class DeviceTable:  # pylint: disable=too-few-public-methods
+    """Last full ifaces table of a device (the linked ifaces
+    counters are polled on top of it between 2 full walks)"""
+
+    def __init__(self, records: List[IfaceStatsRecord]) -> None:
+        self.polled: float = time()
+        self.records: Dict[int, IfaceStatsRecord] = {record.if_index: record for record in records}
+
+    def is_full_poll_due(self, now: float) -> bool:
+        """The whole table (metadata & all ifaces) has to be walked again"""
+        return now - self.polled >= FULL_POLL_INTERVAL
+
+    def update_counters(
+        self, linked_indexes: List[int], counters: Dict[int, List[Any]]
+    ) -> List[IfaceStatsRecord]:
+        """Returns the linked ifaces records with their fresh counters.
+        An ifIndex that vanished forces a full poll (ifaces may have been renumbered)"""
+        records: List[IfaceStatsRecord] = []
+        for if_index in linked_indexes:
+            values: Optional[List[Any]] = counters.get(if_index)
+            if (
+                values is None
+                or all(value is None for value in values)
+                or if_index not in self.records
+            ):
+                self.polled = 0
+                continue
+            record: IfaceStatsRecord = self.records[if_index]._replace(
+                **dict(zip(FAST_STATS_FIELDS, values))
+            )
+            self.records[if_index] = record
+            records.append(record)
+        return records
+
+
+def counter_delta(counter: str, previous: int, current: int) -> Optional[int]:
+    """Increase of a counter since the previous poll. A Counter32 that
+    went down wrapped, None when a 64 bits counter went down (they don't
+    wrap in practice: device rebooted, counters cleared,...)"""
+    if current >= previous:
+        return current - previous
+    if counter in COUNTERS_32_BITS:
+        return current + 2 ** 32 - previous
+    return None
+
+
+def compute_rate(stat: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Rates of an iface since its previous poll: bits, packets, errors &
+    discards per second. None for the first poll of an iface or when its
+    counters were reset"""
+    key: Tuple[str, str] = (stat["device_name"], stat["iface_name"])
+    counters: Tuple[int, ...] = tuple(stat.get(counter, 0) for counter in STATS_COUNTERS)
+    previous: Optional[Tuple[int, Tuple[int, ...]]] = COUNTERS_STATE.get(key)
+    COUNTERS_STATE[key] = (stat["timestamp"], counters)
+    if previous is None:
+        return None
+    prev_timestamp, prev_counters = previous
+    interval: int = stat["timestamp"] - prev_timestamp
+    if interval <= 0:
+        return None
+    deltas: Dict[str, int] = {}
+    for counter, prev_value, value in zip(STATS_COUNTERS, prev_counters, counters):
+        delta: Optional[int] = counter_delta(counter, prev_value, value)
+        if delta is None:
+            return None
+        deltas[counter] = delta
+    rate: Dict[str, Any] = {
+        "device_name": stat["device_name"],
+        "iface_name": stat["iface_name"],
+        "timestamp": stat["timestamp"],
+    }
+    for direction in ("in", "out"):
+        rate[f"{direction}_bps"] = deltas[f"{direction}_bytes"] * 8 // interval
+        rate[f"{direction}_pps"] = (
+            deltas[f"{direction}_ucast_pkts"]
+            + deltas[f"{direction}_mcast_pkts"]
+            + deltas[f"{direction}_bcast_pkts"]
+        ) // interval
+        rate[f"{direction}_errors_ps"] = deltas[f"{direction}_errors"] / interval
+        rate[f"{direction}_discards_ps"] = deltas[f"{direction}_discards"] / interval
+    return rate
+
+
+def changed_iface(
+    device_name: str, iface_name: str, infos: Dict[str, Any], timestamp: int
+) -> Optional[Dict[str, Any]]:
+    """Document of the ifaces collection when the infos of the iface
+    changed since they were last sent (or are to be refreshed)"""
+    key: Tuple[str, str] = (device_name, iface_name)
+    values: Tuple[Any, ...] = tuple(infos.values())
+    known: Optional[Tuple[Tuple[Any, ...], int]] = IFACES_STATE.get(key)
+    if known is not None and known[0] == values and timestamp - known[1] < IFACES_REFRESH_INTERVAL:
+        return None
+    IFACES_STATE[key] = (values, timestamp)
+    return {"device_name": device_name, "iface_name": iface_name, **infos, "last_seen": timestamp}
+
+
+def format_results(  # pylint: disable=too-many-locals
+    device_name: str,
+    ifaces_infos: List[IfaceStatsRecord],
+    registry: Optional[IfaceRegistry] = None,
+) -> StatsBatch:
+    """Format retrieved snmp datas into stats, utilizations & (changed) ifaces
+    documents. Ifaces names & filtering come from the registry when the ifIndex is in it"""
+    format_start: float = perf_counter()
+    utilization_list: List[Tuple[Dict[str, str], Dict[str, Any]]] = []
+    stats_list: List[Dict[str, Any]] = []
+    rates: List[Dict[str, Any]] = []
+    ifaces: List[Dict[str, Any]] = []
     for iface in ifaces_infos:
-        ifname: str = ""
-        _, ifname = next(search(iface, f"{NEEDED_MIBS['iface_name']}*", yielded=True))
-        ifname = str(ifname).lower()
-        if (  # pylint: disable=too-many-boolean-expressions
-            ifname.startswith("se")
-            or ifname.startswith("nu")
-            or ifname.startswith("lo")
-            or ifname.startswith("mgm")
-            or ifname.startswith("ma")
-            or ifname.startswith("po")
-            or ifname == "vlan1"
-        ):
-            # To do: Mgmt ifaces/lo & po could actually be interesting... Need to think about this
+        entry: Optional[IfaceEntry] = registry.ifaces.get(iface.if_index) if registry else None
+        if entry is None:
+            if iface.iface_name is None:
+                continue
+            entry = IfaceEntry(
+                short_iface_name(iface.iface_name), is_ignored_iface(iface.iface_name), False
+            )
+        if entry.ignored:
             continue
-        ifalias: str = ""
-        _, ifalias = next(search(iface, f"{NEEDED_MIBS['iface_alias']}*", yielded=True))
-        # if not ifalias:
+        # if not iface.iface_alias:
         #    # We won't get stats of ifaces with no description
         #    continue
-        _, mtu = next(search(iface, f"{NEEDED_MIBS['mtu']}*", yielded=True))
-        _, mac = next(search(iface, f"{NEEDED_MIBS['mac']}*", yielded=True))
-        _, speed = next(search(iface, f"{NEEDED_MIBS['speed']}*", yielded=True))
-        _, in_disc = next(search(iface, f"{NEEDED_MIBS['in_disc']}*", yielded=True))
-        _, in_err = next(search(iface, f"{NEEDED_MIBS['in_err']}*", yielded=True))
-        _, out_disc = next(search(iface, f"{NEEDED_MIBS['out_disc']}*", yielded=True))
-        _, out_err = next(search(iface, f"{NEEDED_MIBS['out_err']}*", yielded=True))
-        _, in_octets = next(search(iface, f"{NEEDED_MIBS['in_octets']}*", yielded=True))
-        _, in_ucast_pkts = next(search(iface, f"{NEEDED_MIBS['in_ucast_pkts']}*", yielded=True))
-        _, in_mcast_pkts = next(search(iface, f"{NEEDED_MIBS['in_mcast_pkts']}*", yielded=True))
-        _, in_bcast_pkts = next(search(iface, f"{NEEDED_MIBS['in_bcast_pkts']}*", yielded=True))
-        _, out_octets = next(search(iface, f"{NEEDED_MIBS['out_octets']}*", yielded=True))
-        _, out_ucast_pkts = next(search(iface, f"{NEEDED_MIBS['out_ucast_pkts']}*", yielded=True))
-        _, out_mcast_pkts = next(search(iface, f"{NEEDED_MIBS['out_mcast_pkts']}*", yielded=True))
-        _, out_bcast_pkts = next(search(iface, f"{NEEDED_MIBS['out_bcast_pkts']}*", yielded=True))
 
+        iface_metadatas: Dict[str, Any] = {
+            "ifalias": iface.iface_alias or "",
+            "mtu": iface.mtu or 0,
+            "mac": hexlify((iface.mac or "").encode()).decode(),
+            "speed": iface.speed or 0,
+        }
         iface_infos_dict: Dict[str, Any] = {
-            "ifalias": str(ifalias),
-            "mtu": int(mtu),
-            "mac": hexlify(mac.encode()).decode(),
-            "speed": int(speed),
-            "in_discards": int(in_disc) % (2 ** 64 - 1),  # There are some weird devices
+            "in_discards": (iface.in_disc or 0) % (2 ** 64 - 1),  # There are some weird devices
             # returning values greater than 2**64...
-            "in_errors": int(in_err) % (2 ** 64 - 1),
-            "out_discards": int(out_disc) % (2 ** 64 - 1),
-            "out_errors": int(out_err) % (2 ** 64 - 1),
-            "in_bytes": int(in_octets) % (2 ** 64 - 1),
-            "in_ucast_pkts": int(in_ucast_pkts) % (2 ** 64 - 1),
-            "in_mcast_pkts": int(in_mcast_pkts) % (2 ** 64 - 1),
-            "in_bcast_pkts": int(in_bcast_pkts) % (2 ** 64 - 1),
-            "out_bytes": int(out_octets) % (2 ** 64 - 1),
-            "out_ucast_pkts": int(out_ucast_pkts) % (2 ** 64 - 1),
-            "out_mcast_pkts": int(out_mcast_pkts) % (2 ** 64 - 1),
-            "out_bcast_pkts": int(out_bcast_pkts) % (2 ** 64 - 1),
+            "in_errors": (iface.in_err or 0) % (2 ** 64 - 1),
+            "out_discards": (iface.out_disc or 0) % (2 ** 64 - 1),
+            "out_errors": (iface.out_err or 0) % (2 ** 64 - 1),
+            "in_bytes": (iface.in_octets or 0) % (2 ** 64 - 1),
+            "in_ucast_pkts": (iface.in_ucast_pkts or 0) % (2 ** 64 - 1),
+            "in_mcast_pkts": (iface.in_mcast_pkts or 0) % (2 ** 64 - 1),
+            "in_bcast_pkts": (iface.in_bcast_pkts or 0) % (2 ** 64 - 1),
+            "out_bytes": (iface.out_octets or 0) % (2 ** 64 - 1),
+            "out_ucast_pkts": (iface.out_ucast_pkts or 0) % (2 ** 64 - 1),
+            "out_mcast_pkts": (iface.out_mcast_pkts or 0) % (2 ** 64 - 1),
+            "out_bcast_pkts": (iface.out_bcast_pkts or 0) % (2 ** 64 - 1),
         }
 
-        iface_name = "/".join(
-            "".join(x) for is_number, x in groupby(ifname, key=str.isdigit) if is_number is True
-        )
+        iface_name: str = entry.iface_name
         iface_stats_dict: Dict[str, Any] = {
             "device_name": device_name,
             "iface_name": iface_name,
@@ -110,13 +464,18 @@ def dump_results_to_db(  # pylint: disable=too-many-locals
         }
         iface_stats_dict.update(iface_infos_dict)
         stats_list.append(iface_stats_dict)
+        changed: Optional[Dict[str, Any]] = changed_iface(
+            device_name, iface_name, iface_metadatas, iface_stats_dict["timestamp"]
+        )
+        if changed is not None:
+            ifaces.append(changed)
         # Each item of the lists are composed are the "query" (so the DB knows which entry to update
         # And the actual data
         query: Dict[str, str] = {"device_name": device_name, "iface_name": iface_name}
         highest: int = int(iface_infos_dict["in_bytes"])
         lowest: int = int(iface_infos_dict["out_bytes"])
         highest = max(highest, lowest)
-        previous_utilization, previous_timestamp = get_latest_utilization(device_name, iface_name)
+        previous_utilization, previous_timestamp = get_previous_utilization(device_name, iface_name)
         utilization: Dict[str, Any] = {
             "device_name": device_name,
             "iface_name": iface_name,
@@ -124,16 +483,72 @@ def dump_results_to_db(  # pylint: disable=too-many-locals
             "prev_timestamp": previous_timestamp,
             "last_utilization": highest * 8,
             "timestamp": iface_stats_dict["timestamp"],
+            # Ready to use by the api (links colors) till it expires
+            "rate_bps": utilization_rate(
+                previous_utilization,
+                highest * 8,
+                previous_timestamp,
+                iface_stats_dict["timestamp"],
+            ),
+            "expires": iface_stats_dict["timestamp"] + UTILIZATION_TTL,
         }
         utilization_list.append((query, utilization))
+        rate: Optional[Dict[str, Any]] = compute_rate(iface_stats_dict)
+        if rate is not None:
+            # Stored with the sample so /stats/ serves them as is
+            iface_stats_dict.update({field: rate[field] for field in STATS_RATES})
+            rates.append(rate)
+    PHASE_SECONDS.observe(perf_counter() - format_start, phase="format")
+    return StatsBatch(device_name, stats_list, utilization_list, rates, ifaces)
 
-    try:
-        bulk_update_collection(UTILIZATION_COLLECTION, utilization_list)
-        add_iface_stats(stats_list)
-    except InvalidOperation:
+
+def remember_utilizations(batch: StatsBatch) -> None:
+    """Keeps the utilizations of a poll as the previous ones of the next poll"""
+    for _, utilization in batch.utilizations:
+        UTILIZATION_STATE[(batch.device_name, utilization["iface_name"])] = (
+            utilization["last_utilization"],
+            utilization["timestamp"],
+        )
+
+
+def dump_results_to_db(
+    device_name: str,
+    ifaces_infos: List[IfaceStatsRecord],
+    registry: Optional[IfaceRegistry] = None,
+) -> None:
+    """Format retrieved snmp datas & dumps them into db right away"""
+    load_previous_utilizations(device_name)
+    batch: StatsBatch = format_results(device_name, ifaces_infos, registry)
+    if not batch.stats:
         print("Nothing to dump to db (wasn't able to scrap devices?), passing..")
-    except OverflowError:
-        print("OverflowError 0_o (int longer than 64bit) : " + str(utilization_list))
+        return
+    with PHASE_SECONDS.time(phase="db"):
+        write_batches([batch])
+    remember_utilizations(batch)
+
+
+async def queue_results(
+    device_name: str,
+    ifaces_infos: List[IfaceStatsRecord],
+    registry: Optional[IfaceRegistry] = None,
+) -> None:
+    """Format retrieved snmp datas & hands them to the writer (or
+    dumps them into db right away when there's no writer running)"""
+    if device_name not in STATE_DEVICES:
+        # Cold start: the db is queried without blocking the polls of the other devices
+        await asyncio.get_event_loop().run_in_executor(
+            None, load_previous_utilizations, device_name
+        )
+    if STATS_WRITER is None:
+        dump_results_to_db(device_name, ifaces_infos, registry)
+        return
+    batch: StatsBatch = format_results(device_name, ifaces_infos, registry)
+    if not batch.stats:
+        return
+    # Written behind: the next poll must not wait for the db to know them
+    remember_utilizations(batch)
+    with PHASE_SECONDS.time(phase="queue"):
+        await STATS_WRITER.put(batch)
 
 
 # pylint: disable=too-many-arguments
@@ -145,31 +560,78 @@ async def get_stats_and_dump(
     target_ip: Optional[str] = None,
     port: int = 161,
 ) -> None:
-    """Using snmp to get iface(stats) infos & dumping them into db by calling dump_results_to_db"""
+    """Using snmp to get iface(stats) infos & dumping them into db by calling queue_results"""
 
     target: str = target_ip if target_ip else target_name
+    if not is_device_available(target, port):
+        # Considered down, it will be probed once its backoff delay is over
+        DEVICES_SKIPPED.inc()
+        return
 
     try:
-        res: List[Dict[str, str]] = get_bulk_auto(target, oids, credentials, count_oid, port=port)
-        dump_results_to_db(target_name, res)
+        table: Optional[DeviceTable] = DEVICE_TABLES.get(target_name)
+        registry: Optional[IfaceRegistry] = await get_iface_registry(target_name)
+        if table is not None and registry is not None and not table.is_full_poll_due(time()):
+            if not registry.linked_indexes:
+                return
+            # ifNumber & ifTableLastChanged are asked along with the counters
+            counters, scalars = await get_rows_async(
+                target,
+                FAST_STATS_DECODER,
+                registry.linked_indexes,
+                credentials,
+                port=port,
+                scalar_oids=(count_oid, IFACES_TABLE_LAST_CHANGE),
+            )
+            if registry.matches(
+                as_int(scalars[count_oid]), as_int(scalars[IFACES_TABLE_LAST_CHANGE])
+            ):
+                await queue_results(
+                    target_name,
+                    table.update_counters(registry.linked_indexes, counters),
+                    registry,
+                )
+                return
+            # Ifaces changed, indexes may not be the same: the table is walked right away
+
+        scalars = await get_async(
+            target, [count_oid, IFACES_TABLE_LAST_CHANGE], credentials, port=port
+        )
+        res: List[IfaceStatsRecord] = await get_bulk_async(
+            target,
+            oids,
+            credentials,
+            as_int(scalars[count_oid]),
+            port=port,
+            row_decoder=decode_stats_row,
+        )
+        registry = await refresh_iface_registry(
+            target_name,
+            as_int(scalars[count_oid]),
+            as_int(scalars[IFACES_TABLE_LAST_CHANGE]),
+            res,
+        )
+        if FULL_POLL_INTERVAL > 0:
+            DEVICE_TABLES[target_name] = DeviceTable(res)
+        await queue_results(target_name, res, registry)
     except (RuntimeError, PySnmpError) as err:
         print(err, "\n (can't access to devices?) Passing for now...")
+    except PyMongoError as err:
+        # The next poll of the device tries again
+        print(f"Db error while polling {target_name}: {err}")
 
 
-def stats_scrapping(
-    snmp_credentials: Union[hlapi.CommunityData, hlapi.UsmUserData], init_node_fqdn: str = ""
-) -> None:
-    """Main ifaces(stats) scrapping func that launch threads to scrap
-    devices"""
-    scrapped: List[Dict[str, str]] = []
+def get_devices_to_poll(init_node_fqdn: str = "") -> List[PollTarget]:
+    """Returns the devices to poll (with their polling interval)"""
+    scrapped: List[Dict[str, Any]] = []
     if NODES_PATTERNS:
         scrapped = get_nodes_by_patterns(NODES_PATTERNS.split(","))
     else:
         scrapped = get_all_nodes()
-    devices: List[Tuple[str, str, int]] = []
+    devices: List[PollTarget] = []
     if init_node_fqdn:
         # This is a pytest case
-        devices.append((init_node_fqdn, "", 1161))
+        devices.append(PollTarget(init_node_fqdn, "", 1161, POLL_INTERVAL))
     for device in scrapped:
         if "fake" in device["device_name"]:
             continue
@@ -178,47 +640,167 @@ def stats_scrapping(
                 continue
         except KeyError:
             pass
-        devices.append((device["device_name"], "", 161))
+        interval: float = float(device.get("poll_interval", POLL_INTERVAL))
+        devices.append(PollTarget(device["device_name"], "", 161, interval))
 
     if TEST_CASE:
-        devices.append(("fake_local_device", "127.0.0.1", 1161))
-
-    if devices:
-        for devices_to_scrap in split_list(devices, int(NB_THREADS)):
-            loop = asyncio.get_event_loop()
-            loop.run_until_complete(
-                asyncio.wait(  # type: ignore
-                    [
-                        get_stats_and_dump(
-                            hostname,
-                            NEEDED_MIBS.values(),  # type: ignore
-                            snmp_credentials,
-                            IFACES_TABLE_TO_COUNT,
-                            target_ip=ip,
-                            port=port,
-                        )
-                        for hostname, ip, port in devices_to_scrap
-                    ]
-                )
-            )
-            # sleep(10)
-        if not init_node_fqdn:
-            sleep(int(60 + (len(devices) / int(NB_THREADS))))
-    else:
-        print("No devices retrieved from db... Waiting till there are any.")
-        sleep(60)
+        devices.append(PollTarget("fake_local_device", "127.0.0.1", 1161, POLL_INTERVAL))
 
+    return devices
 
-def main() -> None:
-    """Get hlapi credentials, prepare the db & launch the
-    scrapping loop"""
+
+async def poll_device(
+    snmp_credentials: Union[hlapi.CommunityData, hlapi.UsmUserData],
+    hostname: str,
+    ip: str,
+    port: int,
+) -> None:
+    """Polls the stats of one device (scheduler callback)"""
+    await get_stats_and_dump(
+        hostname,
+        STATS_DECODER.oids,
+        snmp_credentials,
+        IFACES_TABLE_TO_COUNT,
+        target_ip=ip,
+        port=port,
+    )
+
+
+def stats_scrapping(
+    snmp_credentials: Union[hlapi.CommunityData, hlapi.UsmUserData], init_node_fqdn: str = ""
+) -> None:
+    """Scraps the stats of all devices once"""
+    devices: List[PollTarget] = get_devices_to_poll(init_node_fqdn)
+    if not devices:
+        print("No devices retrieved from db...")
+        return
+
+    # All devices are scrapped at once, the number of snmp requests
+    # in flight is bounded by snmp_functions (SNMP_MAX_CONCURRENCY)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        asyncio.wait(
+            [
+                poll_device(snmp_credentials, device.name, device.ip, device.port)
+                for device in devices
+            ]
+        )
+    )
+
+
+async def snapshot_utilization_state(state_file: str = STATE_FILE) -> None:
+    """Snapshots the utilization state to disk periodically"""
+    while True:
+        await asyncio.sleep(STATE_SNAPSHOT_INTERVAL)
+        save_utilization_state(state_file)
+
+
+async def expire_stats_partitions() -> None:
+    """Drops the expired stats partitions periodically"""
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            dropped: List[str] = await loop.run_in_executor(None, drop_expired_stats_partitions)
+        except Exception as err:  # pylint: disable=broad-except
+            print(f"Can't drop the expired stats partitions: {err}")
+        else:
+            if dropped:
+                print(f"Expired stats partitions dropped: {dropped}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+
+def local_path(path: str, index: Optional[int]) -> str:
+    """Path of a local file of a poller process: suffixed by the index of the
+    process when several run on the host. Unlike the worker id (which has the
+    pid), it is the same after a restart so the file is read back"""
+    return path if index is None else f"{path}.{index}"
+
+
+def run_poller(
+    worker_id: Optional[str] = None,
+    metrics_port: int = METRICS_PORT,
+    index: Optional[int] = None,
+) -> None:
+    """Launches the scrapping scheduler. With a worker_id, only
+    the share of the devices owned by this poller is scrapped.
+    index is the one of the process when several run on the host"""
+    global STATS_WRITER  # pylint: disable=global-statement
+
+    # Stopping (k8s, parent process) must let the poller leave properly
+    signal(SIGTERM, lambda *_: sys_exit(0))
 
     creds = get_snmp_creds(SNMP_USR, SNMP_AUTH_PWD, SNMP_PRIV_PWD)
 
+    state_file: str = local_path(STATE_FILE, index)
+    load_utilization_state(state_file)
+
+    get_targets: Callable[[], List[PollTarget]] = get_devices_to_poll
+    membership: Optional[ShardMembership] = None
+    if worker_id is not None:
+        membership = ShardMembership(worker_id)
+
+        def get_owned_targets() -> List[PollTarget]:
+            owned: List[PollTarget] = membership.owned(get_devices_to_poll())
+            keep_devices_state({target.name for target in owned})
+            return owned
+
+        get_targets = get_owned_targets
+
+    scheduler = PollScheduler(partial(poll_device, creds), get_targets)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(serve_metrics(metrics_port))
+    spool: Optional[StatsSpool] = None
+    if SPOOL_DIR:
+        spool = StatsSpool(local_path(SPOOL_DIR, index))
+    STATS_WRITER = StatsWriter(spool=spool)
+    try:
+        loop.run_until_complete(
+            asyncio.gather(
+                scheduler.run(),
+                STATS_WRITER.run(),
+                snapshot_utilization_state(state_file),
+                expire_stats_partitions(),
+            )
+        )
+    finally:
+        STATS_WRITER.flush_pending()
+        if membership is not None:
+            membership.leave()
+        save_utilization_state(state_file)
+
+
+def main() -> None:
+    """Prepare the db & launch the poller(s). Several pollers (local
+    processes and/or replicas) share the devices when sharding is on"""
+
     prep_db_if_not_exist()
 
-    while True:
-        stats_scrapping(creds)
+    if NB_PROCESSES <= 1:
+        run_poller(WORKER_ID if SHARDING else None)
+        return
+
+    # Spawned (not forked) so each process gets its own db client.
+    # Each process exposes its metrics on its own port (METRICS_PORT + index)
+    context = get_context("spawn")
+    processes: List[BaseProcess] = [
+        context.Process(
+            target=run_poller,
+            args=(worker_id, METRICS_PORT + index if METRICS_PORT else 0, index),
+            name=worker_id,
+        )
+        for index, worker_id in enumerate(worker_ids(NB_PROCESSES))
+    ]
+    for process in processes:
+        process.start()
+    signal(SIGTERM, lambda *_: sys_exit(0))
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
 
 
 if __name__ == "__main__":
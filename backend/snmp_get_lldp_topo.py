@@ -6,8 +6,9 @@ Datas retrieved are stored into db."""
 
 from os import getenv
 import asyncio
+from functools import partial
 from itertools import groupby
-from time import sleep, time
+from time import time
 from typing import List, Dict, Tuple, Optional, Union, Any
 from pymongo.errors import InvalidOperation  # type: ignore
 from pysnmp.error import PySnmpError  # type: ignore
@@ -21,12 +22,15 @@ from db_layer import (
     get_all_nodes,
     get_nodes_by_patterns,
 )
+from topology_changes import record_topology_changes, upserted_changes
 from snmp_functions import (
-    get_table,
+    walk_async,
     get_snmp_creds,
-    split_list,
     NEEDED_MIBS_FOR_LLDP as NEEDED_MIBS,
 )
+from snmp_tuning import is_device_available
+from poll_scheduler import PollScheduler, PollTarget
+from poller_metrics import serve_metrics, DEVICES_SKIPPED, PHASE_SECONDS, DB_WRITE_SECONDS
 
 SNMP_USR: Optional[str] = getenv("SNMP_USR")
 SNMP_AUTH_PWD: Optional[str] = getenv("SNMP_AUTH_PWD")
@@ -36,7 +40,9 @@ INIT_NODE_IP: str = getenv("LLDP_INIT_NODE_IP", "")
 INIT_NODE_PORT: str = getenv("LLDP_INIT_NODE_PORT", "161")
 STOP_NODES_FQDN: Optional[str] = getenv("STOP_NODES_FQDN")
 STOP_NODES_IP: Optional[str] = getenv("STOP_NODES_IP")
-NB_THREADS: str = getenv("AUTOMAP_NB_THREADS", "10")
+# Default interval (seconds) between 2 polls of a device, can be
+# overridden per device by the "poll_interval" field of its node
+POLL_INTERVAL: float = float(getenv("LLDP_POLL_INTERVAL", "300"))
 NODES_PATTERNS: Optional[str] = getenv("NODES_PATTERNS")  # Patterns separated by a coma
 
 
@@ -141,8 +147,20 @@ def dump_results_to_db(device_name: str, lldp_infos: List[Dict[str, str]]) -> No
         links_list.append((query_neigh_link, query_neigh_link))
 
     try:
-        bulk_update_collection(NODES_COLLECTION, nodes_list)
-        bulk_update_collection(LINKS_COLLECTION, links_list)
+        with PHASE_SECONDS.time(phase="db"):
+            with DB_WRITE_SECONDS.time(collection="nodes"):
+                nodes_result = bulk_update_collection(NODES_COLLECTION, nodes_list)
+            with DB_WRITE_SECONDS.time(collection="links"):
+                links_result = (
+                    bulk_update_collection(LINKS_COLLECTION, links_list) if links_list else None
+                )
+            # Nodes & links discovered by this poll bump the topology version
+            changes: List[Dict[str, Any]] = upserted_changes(
+                "node", nodes_list, nodes_result
+            ) + upserted_changes("link", links_list, links_result)
+            if changes:
+                with DB_WRITE_SECONDS.time(collection="topology_changes"):
+                    record_topology_changes(changes)
     except InvalidOperation:
         print("Nothing to dump to db (wasn't able to scrap devices?), passing..")
 
@@ -158,26 +176,29 @@ async def get_device_lldp_infos(
 
     target = target_ip if target_ip else target_name
     target_name = target if not target_name else target_name
+    if not is_device_available(target, port):
+        # Considered down, it will be probed once its backoff delay is over
+        DEVICES_SKIPPED.inc()
+        return
 
     try:
-        res: List[Dict[str, str]] = get_table(target, oids, credentials, port=port)
+        res: List[Dict[str, str]] = await walk_async(target, oids, credentials, port=port)
         dump_results_to_db(target_name, res)
     except (RuntimeError, PySnmpError) as err:
         print(err, f"\n (can't access to device {target_name}?) Passing for now...")
 
 
-def lldp_scrapping(
-    snmp_credentials: Union[hlapi.CommunityData, hlapi.UsmUserData], init_node_fqdn: str = ""
-) -> None:
-    """Main lldp scrapping func that launch threads to scrap
-    devices"""
+def get_devices_to_poll(init_node_fqdn: str = "") -> List[PollTarget]:
+    """Returns the devices to poll (with their polling interval).
+    When none is known yet, the init node is returned"""
 
-    scrapped: List[Dict[str, str]] = []
+    scrapped: List[Dict[str, Any]] = []
     if NODES_PATTERNS:
         scrapped = get_nodes_by_patterns(NODES_PATTERNS.split(","))
     else:
         scrapped = get_all_nodes()
     devices: List[Tuple[str, str, int]] = []
+    intervals: Dict[str, float] = {}
     for dev in scrapped:
         if "fake" in dev["device_name"]:
             continue
@@ -187,6 +208,7 @@ def lldp_scrapping(
         except KeyError:
             pass
         devices.append((dev["device_name"], "", 161))
+        intervals[dev["device_name"]] = float(dev.get("poll_interval", POLL_INTERVAL))
 
     if not devices:
         if INIT_NODE_FQDN:
@@ -214,41 +236,63 @@ def lldp_scrapping(
             if node_tuple in devices:
                 devices.remove(node_tuple)
 
+    return [
+        PollTarget(hostname, ip, port, intervals.get(hostname, POLL_INTERVAL))
+        for hostname, ip, port in devices
+    ]
+
+
+async def poll_device(
+    snmp_credentials: Union[hlapi.CommunityData, hlapi.UsmUserData],
+    hostname: str,
+    ip: str,
+    port: int,
+) -> None:
+    """Polls the lldp neighbors of one device (scheduler callback)"""
+    await get_device_lldp_infos(
+        hostname,
+        NEEDED_MIBS.values(),  # type: ignore
+        snmp_credentials,
+        target_ip=ip,
+        port=port,
+    )
+
+
+def lldp_scrapping(
+    snmp_credentials: Union[hlapi.CommunityData, hlapi.UsmUserData], init_node_fqdn: str = ""
+) -> None:
+    """Scraps the lldp neighbors of all devices once"""
+
+    devices: List[PollTarget] = get_devices_to_poll(init_node_fqdn)
+
     print(devices)
 
-    for devices_to_scrap in split_list(devices, int(NB_THREADS)):
-
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(
-            asyncio.wait(  # type: ignore
-                [
-                    get_device_lldp_infos(
-                        hostname,
-                        NEEDED_MIBS.values(),  # type: ignore
-                        snmp_credentials,
-                        target_ip=ip,
-                        port=port,
-                    )
-                    for hostname, ip, port in devices_to_scrap
-                ]
-            )
+    # All devices are scrapped at once, the number of snmp requests
+    # in flight is bounded by snmp_functions (SNMP_MAX_CONCURRENCY)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        asyncio.wait(
+            [
+                poll_device(snmp_credentials, device.name, device.ip, device.port)
+                for device in devices
+            ]
         )
-
-    # sleep(300)
-    if not init_node_fqdn:
-        sleep(int(60 * (len(devices) / int(NB_THREADS))) + 30)
+    )
 
 
 def main() -> None:
     """Get hlapi credentials, prepare the db & launch the
-    scrapping loop"""
+    scrapping scheduler. Newly discovered neighbors are
+    polled once the scheduler refreshes its devices list"""
 
     creds = get_snmp_creds(SNMP_USR, SNMP_AUTH_PWD, SNMP_PRIV_PWD)
 
     prep_db_if_not_exist()
 
-    while True:
-        lldp_scrapping(creds)
+    scheduler = PollScheduler(partial(poll_device, creds), get_devices_to_poll)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(serve_metrics())
+    loop.run_until_complete(scheduler.run())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+"""Per device tuning of the snmp requests, learnt from the
+answers of the device: sizing of the GETBULKs, timeouts from
+its RTT & circuit breaker skipping it while it is down."""
+#! /usr/bin/env python3
+
+from os import getenv
+from math import ceil, log2
+from time import monotonic
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# Max number of devices whose sessions & tuning are kept
+# (least recently used ones are evicted above it)
+SNMP_MAX_SESSIONS: int = int(getenv("SNMP_MAX_SESSIONS", "10000"))
+# GETBULK responses are sized to stay below this number of bytes (agents that can't
+# send that much answer tooBig or truncate, both are remembered per device)
+SNMP_BULK_MAX_SIZE: int = int(getenv("SNMP_BULK_MAX_SIZE", "8192"))
+SNMP_BULK_MAX_REPETITIONS: int = int(getenv("SNMP_BULK_MAX_REPETITIONS", "200"))
+# Requests timeout is picked (from the device RTT) in this ladder of values, doubled from
+# SNMP_MIN_TIMEOUT to SNMP_MAX_TIMEOUT (a ladder since pysnmp configures a target per timeout)
+SNMP_MIN_TIMEOUT: float = float(getenv("SNMP_MIN_TIMEOUT", "0.25"))
+SNMP_MAX_TIMEOUT: float = float(getenv("SNMP_MAX_TIMEOUT", "4"))
+SNMP_TIMEOUTS: Tuple[float, ...] = tuple(
+    SNMP_MIN_TIMEOUT * 2 ** step
+    for step in range(16)
+    if SNMP_MIN_TIMEOUT * 2 ** step < SNMP_MAX_TIMEOUT
+) + (SNMP_MAX_TIMEOUT,)
+SNMP_TIMEOUT: float = float(getenv("SNMP_TIMEOUT", "1"))  # Before the RTT is known
+SNMP_RETRIES: int = int(getenv("SNMP_RETRIES", "2"))
+# Circuit breaker of unreachable devices (see DeviceHealth)
+SNMP_BREAKER_THRESHOLD: int = int(getenv("SNMP_BREAKER_THRESHOLD", "2"))
+SNMP_BACKOFF_BASE: float = float(getenv("SNMP_BACKOFF_BASE", "60"))
+SNMP_BACKOFF_MAX: float = float(getenv("SNMP_BACKOFF_MAX", "1800"))
+# Doublings of SNMP_BACKOFF_BASE needed to reach SNMP_BACKOFF_MAX (the delay of
+# a device down for long stays at the max instead of overflowing)
+SNMP_BACKOFF_STEPS: int = (
+    ceil(log2(max(SNMP_BACKOFF_MAX / SNMP_BACKOFF_BASE, 1))) if SNMP_BACKOFF_BASE > 0 else 0
+)
+
+
+class BulkSettings:  # pylint: disable=too-few-public-methods
+    """GETBULK sizing learnt for a device (and a number of columns)"""
+
+    def __init__(self, nb_columns: int) -> None:
+        self.group_size: int = nb_columns  # Columns asked in the same request
+        # Before any response, rows are guessed to be ~40 bytes per column
+        self.max_repetitions: int = max_repetitions_for(40 * nb_columns)
+        # The agent answered tooBig or truncated with this max_repetitions
+        self.agent_limit: int = SNMP_BULK_MAX_REPETITIONS
+
+    def learn_row_size(self, row_size: int) -> None:
+        """Sizes max_repetitions so responses fit SNMP_BULK_MAX_SIZE"""
+        self.max_repetitions = min(max_repetitions_for(row_size), self.agent_limit)
+
+    def back_off(self) -> bool:
+        """Asks less rows per request, then less columns per request.
+        Returns False when there is nothing left to reduce"""
+        if self.max_repetitions > 1:
+            self.agent_limit = self.max_repetitions = self.max_repetitions // 2
+            return True
+        if self.group_size > 1:
+            # Smaller rows, the agent may send more of them
+            self.group_size = (self.group_size + 1) // 2
+            self.agent_limit = SNMP_BULK_MAX_REPETITIONS
+            return True
+        return False
+
+
+# Per device (target, port, nb of columns), least recently used first
+_BULK_SETTINGS: "OrderedDict[Tuple[str, int, int], BulkSettings]" = OrderedDict()
+
+
+def max_repetitions_for(row_size: int) -> int:
+    """Number of rows of row_size bytes fitting in a response"""
+    return max(1, min(SNMP_BULK_MAX_SIZE // max(row_size, 1), SNMP_BULK_MAX_REPETITIONS))
+
+
+def get_bulk_settings(target: str, port: int, nb_columns: int) -> BulkSettings:
+    """Returns the GETBULK sizing remembered for a device"""
+    key: Tuple[str, int, int] = (target, port, nb_columns)
+    settings: Optional[BulkSettings] = _BULK_SETTINGS.get(key)
+    if settings is None:
+        settings = _BULK_SETTINGS[key] = BulkSettings(nb_columns)
+        while len(_BULK_SETTINGS) > SNMP_MAX_SESSIONS:
+            _BULK_SETTINGS.popitem(last=False)
+    _BULK_SETTINGS.move_to_end(key)
+    return settings
+
+
+class DeviceHealth:
+    """Reachability of a device: smoothed RTT (to size the timeout of its
+    requests) & circuit breaker. After SNMP_BREAKER_THRESHOLD failures in a row,
+    the device isn't polled for SNMP_BACKOFF_BASE seconds, doubled after each
+    new failure (up to SNMP_BACKOFF_MAX). The poll allowed after this delay is a
+    probe (no retries), the breaker closes as soon as the device answers"""
+
+    def __init__(self) -> None:
+        self.srtt: Optional[float] = None
+        self.rttvar: float = 0.0
+        self.failures: int = 0
+        self.open_until: float = 0.0
+
+    def is_open(self) -> bool:
+        """The device is considered down"""
+        return self.failures >= SNMP_BREAKER_THRESHOLD
+
+    def allow(self, now: float) -> bool:
+        """The device can be polled (closed breaker or time to probe it)"""
+        return not self.is_open() or now >= self.open_until
+
+    def timeout(self) -> float:
+        """Smallest step of the timeouts ladder above the RTT estimate (RFC 6298)"""
+        if self.srtt is None:
+            return SNMP_TIMEOUT
+        wanted: float = self.srtt + 4 * self.rttvar
+        for timeout in SNMP_TIMEOUTS:
+            if timeout >= wanted:
+                return timeout
+        return SNMP_TIMEOUTS[-1]
+
+    def retries(self) -> int:
+        """A probe of a device considered down doesn't retry"""
+        return 0 if self.is_open() else SNMP_RETRIES
+
+    def record_success(self, rtt: float) -> None:
+        """Updates the RTT estimate & closes the breaker"""
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self, now: float) -> Optional[float]:
+        """Counts a request that got no answer. Returns the backoff delay
+        if the breaker (re)opened"""
+        self.failures += 1
+        if not self.is_open():
+            return None
+        step: int = min(self.failures - SNMP_BREAKER_THRESHOLD, SNMP_BACKOFF_STEPS)
+        delay: float = min(SNMP_BACKOFF_BASE * 2 ** step, SNMP_BACKOFF_MAX)
+        self.open_until = now + delay
+        return delay
+
+
+# Per device (target, port), least recently used first
+_DEVICES_HEALTH: "OrderedDict[Tuple[str, int], DeviceHealth]" = OrderedDict()
+
+
+def get_device_health(target: str, port: int = 161) -> DeviceHealth:
+    """Returns the health of a device"""
+    key: Tuple[str, int] = (target, port)
+    health: Optional[DeviceHealth] = _DEVICES_HEALTH.get(key)
+    if health is None:
+        health = _DEVICES_HEALTH[key] = DeviceHealth()
+        while len(_DEVICES_HEALTH) > SNMP_MAX_SESSIONS:
+            _DEVICES_HEALTH.popitem(last=False)
+    _DEVICES_HEALTH.move_to_end(key)
+    return health
+
+
+def is_device_available(target: str, port: int = 161) -> bool:
+    """False while the circuit breaker of the device is open
+    (the pollers skip the device instead of waiting for timeouts)"""
+    return get_device_health(target, port).allow(monotonic())
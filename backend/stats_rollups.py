@@ -0,0 +1,106 @@
+""" Min/avg/max aggregates (5 minutes & 1 hour) of the rates of the
+ifaces, written by the stats scrapper & read by the api """
+
+#! /usr/bin/env python3
+
+from typing import List, Dict, Any, Optional, Tuple
+
+from pymongo import UpdateOne  # type: ignore
+from pymongo.errors import BulkWriteError  # type: ignore
+
+from db_layer import STATS_ROLLUPS_COLLECTION
+
+# Resolutions (seconds) of the min/avg/max rates aggregates of each iface
+ROLLUP_RESOLUTIONS: Tuple[int, ...] = (300, 3600)
+# Timestamps of the samples of an aggregate are only used to write them once
+ROLLUPS_PROJECTION: Dict[str, bool] = {"_id": False, "samples": False}
+# Code of the write errors of a document already in db
+DUPLICATE_KEY_ERROR: int = 11000
+
+
+def rollups_devices_query(
+    devices: List[str], resolution: int, start: int, end: Optional[int] = None
+) -> Dict[str, Any]:
+    """Query of the rates aggregates of devices at a resolution between start & end"""
+    timestamps: Dict[str, int] = {"$gte": start - start % resolution}
+    if end is not None:
+        timestamps["$lte"] = end
+    return {"device_name": {"$in": devices}, "resolution": resolution, "start": timestamps}
+
+
+def average_rollups(rollups: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Computes in_avg & out_avg from the sums & orders the
+    aggregates by device, iface & time"""
+    for rollup in rollups:
+        rollup["in_avg"] = rollup.pop("in_sum") / rollup["count"]
+        rollup["out_avg"] = rollup.pop("out_sum") / rollup["count"]
+    rollups.sort(key=lambda rollup: (rollup["device_name"], rollup["iface_name"], rollup["start"]))
+    return rollups
+
+
+def get_rollups_devices(
+    devices: List[str], resolution: int, start: int, end: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Returns the rates aggregates of the ifaces of the devices at
+    a resolution (seconds) between start & end timestamps, ordered
+    by device, iface & time. in_avg & out_avg are computed from the sums"""
+
+    return average_rollups(
+        list(
+            STATS_ROLLUPS_COLLECTION.find(
+                rollups_devices_query(devices, resolution, start, end), ROLLUPS_PROJECTION
+            )
+        )
+    )
+
+
+def rollup_updates(rate: Dict[str, Any]) -> List[UpdateOne]:
+    """Upserts adding a rate sample (bits/s since the previous poll)
+    to the aggregates of its iface at each resolution. The timestamps of
+    the samples are kept in the aggregate so a sample written again (retried
+    or replayed batch) is a duplicate key error instead of being counted twice"""
+    timestamp: int = int(rate["timestamp"])
+    return [
+        UpdateOne(
+            {
+                "device_name": rate["device_name"],
+                "iface_name": rate["iface_name"],
+                "resolution": resolution,
+                "start": timestamp - timestamp % resolution,
+                "samples": {"$ne": timestamp},
+            },
+            {
+                "$min": {"in_min": rate["in_bps"], "out_min": rate["out_bps"]},
+                "$max": {"in_max": rate["in_bps"], "out_max": rate["out_bps"]},
+                "$inc": {"in_sum": rate["in_bps"], "out_sum": rate["out_bps"], "count": 1},
+                "$push": {"samples": timestamp},
+            },
+            upsert=True,
+        )
+        for resolution in ROLLUP_RESOLUTIONS
+    ]
+
+
+def add_rollups_unordered(rates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Adds rates samples to the aggregates. Returns the write errors
+    (index of the rate sample & errmsg), samples already aggregated aren't errors"""
+
+    if not rates:
+        return []
+    try:
+        STATS_ROLLUPS_COLLECTION.bulk_write(
+            [update for rate in rates for update in rollup_updates(rate)], ordered=False
+        )
+    except BulkWriteError as err:
+        # Errors are reported once per rate sample
+        return list(
+            {
+                error["index"]
+                // len(ROLLUP_RESOLUTIONS): dict(
+                    error, index=error["index"] // len(ROLLUP_RESOLUTIONS)
+                )
+                for error in err.details.get("writeErrors", [])
+                if error.get("code") != DUPLICATE_KEY_ERROR
+            }.values()
+        )
+    return []
@@ -0,0 +1,163 @@
+"""Append-only spool on local disk used by the stats writer while the
+db can't keep up (or is unreachable). Records are json documents
+appended to memory-mapped segments files, each one prefixed by its
+length & crc32 so a torn write (crash) only loses the end of the last
+segment. Segments are replayed (oldest first) then deleted."""
+#! /usr/bin/env python3
+
+import json
+import mmap
+import os
+import struct
+from os import getenv
+from typing import Any, Dict, Iterator, List, Optional
+from zlib import crc32
+
+# Spool directory ("" disables the spool)
+SPOOL_DIR: str = getenv("STATS_SPOOL_DIR", "stats_spool")
+SPOOL_SEGMENT_SIZE: int = int(getenv("STATS_SPOOL_SEGMENT_SIZE", str(16 * 1024 * 1024)))
+# Records are refused (polls wait for the db again) once the spool is this big
+SPOOL_MAX_SIZE: int = int(getenv("STATS_SPOOL_MAX_SIZE", str(1024 * 1024 * 1024)))
+
+# Length & crc32 of the record that follows. A 0 length ends the segment.
+HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX: str = ".spool"
+
+
+def encode_record(document: Dict[str, Any]) -> bytes:
+    """Header & payload of a record"""
+    payload: bytes = json.dumps(document, separators=(",", ":")).encode()
+    return HEADER.pack(len(payload), crc32(payload)) + payload
+
+
+def decode_records(data: bytes) -> Iterator[Dict[str, Any]]:
+    """Records of a segment till its end or a damaged record"""
+    offset: int = 0
+    while offset + HEADER.size <= len(data):
+        length, checksum = HEADER.unpack_from(data, offset)
+        if length == 0:
+            return
+        payload: bytes = data[offset + HEADER.size : offset + HEADER.size + length]
+        if len(payload) != length or crc32(payload) != checksum:
+            print(f"Damaged spool record at offset {offset}, end of segment skipped")
+            return
+        yield json.loads(payload)
+        offset += HEADER.size + length
+
+
+def read_segment(path: str) -> List[Dict[str, Any]]:
+    """Records of a closed segment"""
+    size: int = os.path.getsize(path)
+    if not size:
+        return []
+    with open(path, "rb") as segment:
+        with mmap.mmap(segment.fileno(), size, access=mmap.ACCESS_READ) as data:
+            return list(decode_records(data))  # type: ignore
+
+
+class Segment:
+    """A spool file preallocated to its size & mapped in memory"""
+
+    def __init__(self, path: str, size: int) -> None:
+        self.path: str = path
+        self.size: int = size
+        self.offset: int = 0
+        with open(path, "wb") as segment:
+            segment.truncate(size)
+        self.file = open(path, "r+b")  # pylint: disable=consider-using-with
+        self.map: mmap.mmap = mmap.mmap(self.file.fileno(), size)
+
+    def fits(self, record: bytes) -> bool:
+        """Whether the record (& the end marker) fits in the segment"""
+        return self.offset + len(record) + HEADER.size <= self.size
+
+    def append(self, record: bytes) -> None:
+        """Writes the payload before its header: the header of a
+        record is only set once the record is complete"""
+        self.map[self.offset + HEADER.size : self.offset + len(record)] = record[HEADER.size :]
+        self.map[self.offset : self.offset + HEADER.size] = record[: HEADER.size]
+        self.offset += len(record)
+
+    def close(self) -> None:
+        """Flushes the segment to disk"""
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class StatsSpool:
+    """Segments waiting to be replayed & the one being appended"""
+
+    def __init__(
+        self,
+        directory: str = SPOOL_DIR,
+        segment_size: int = SPOOL_SEGMENT_SIZE,
+        max_size: int = SPOOL_MAX_SIZE,
+    ) -> None:
+        self.directory: str = directory
+        self.segment_size: int = segment_size
+        self.max_size: int = max_size
+        os.makedirs(directory, exist_ok=True)
+        # Segments left by a previous run are replayed too
+        self.segments: List[str] = sorted(
+            os.path.join(directory, name)
+            for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        self.sequence: int = (
+            int(os.path.basename(self.segments[-1])[: -len(SEGMENT_SUFFIX)]) if self.segments else 0
+        )
+        self.closed_size: int = sum(os.path.getsize(path) for path in self.segments)
+        self.active: Optional[Segment] = None
+
+    @property
+    def size(self) -> int:
+        """Bytes used on disk"""
+        return self.closed_size + (self.active.size if self.active else 0)
+
+    def __bool__(self) -> bool:
+        return bool(self.segments) or bool(self.active and self.active.offset)
+
+    def rotate(self, min_size: int = 0) -> None:
+        """Closes the active segment (it can then be replayed) & opens a new one"""
+        self.close()
+        self.sequence += 1
+        path: str = os.path.join(self.directory, f"{self.sequence:012d}{SEGMENT_SUFFIX}")
+        self.active = Segment(path, max(self.segment_size, min_size + HEADER.size))
+
+    def append(self, documents: List[Dict[str, Any]]) -> bool:
+        """Spools documents. Returns False (nothing spooled) when the spool is full"""
+        records: List[bytes] = [encode_record(document) for document in documents]
+        needed: int = sum(len(record) for record in records)
+        if self.size + needed > self.max_size:
+            return False
+        for record in records:
+            if self.active is None or not self.active.fits(record):
+                self.rotate(len(record))
+            self.active.append(record)  # type: ignore
+        return True
+
+    def oldest(self) -> Optional[str]:
+        """Oldest segment to replay (the active one is closed
+        first when it's the only one left)"""
+        if not self.segments and self.active is not None and self.active.offset:
+            self.close()
+        return self.segments[0] if self.segments else None
+
+    def remove(self, path: str) -> None:
+        """Deletes a replayed segment"""
+        self.segments.remove(path)
+        self.closed_size -= os.path.getsize(path)
+        os.remove(path)
+
+    def close(self) -> None:
+        """Closes the active segment (an empty one is deleted)"""
+        if self.active is None:
+            return
+        self.active.close()
+        if self.active.offset:
+            self.segments.append(self.active.path)
+            self.closed_size += self.active.size
+        else:
+            os.remove(self.active.path)
+        self.active = None
@@ -0,0 +1,296 @@
+"""Write-behind stage of the stats scrapper: polls only queue their
+formatted results, a single writer flushes the results of many devices
+at once with unordered bulk writes. The queue is bounded so slow db
+writes throttle the polls instead of piling results up in memory.
+With a spool, results that can't be queued or written (db behind or
+unreachable) go to disk & are replayed once the db is back."""
+#! /usr/bin/env python3
+
+import asyncio
+from os import getenv
+from time import monotonic
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from pymongo.errors import PyMongoError, ConnectionFailure  # type: ignore
+
+from db_layer import (
+    write_iface_stats_unordered,
+    bulk_update_unordered,
+    update_ifaces_unordered,
+    UTILIZATION_COLLECTION,
+)
+from poller_metrics import (
+    DB_WRITE_SECONDS,
+    DB_WRITTEN,
+    DB_WRITE_ERRORS,
+    WRITE_QUEUE_DEPTH,
+    SPOOLED,
+    REPLAYED,
+    SPOOL_BYTES,
+)
+from stats_rollups import add_rollups_unordered
+from stats_spool import StatsSpool, read_segment
+
+# Polls results (one per device) waiting to be written. Polls wait when it is full.
+WRITE_QUEUE_SIZE: int = int(getenv("STATS_WRITE_QUEUE_SIZE", "1000"))
+# A flush is done once this many stats documents are gathered...
+WRITE_BATCH_SIZE: int = int(getenv("STATS_WRITE_BATCH_SIZE", "5000"))
+# ... or this many seconds after the first result of the batch was queued
+WRITE_FLUSH_INTERVAL: float = float(getenv("STATS_WRITE_FLUSH_INTERVAL", "1"))
+
+
+class StatsBatch(NamedTuple):
+    """Formatted results of the poll of a device"""
+
+    device_name: str
+    stats: List[Dict[str, Any]]
+    # (query, data) tuples of the utilization collection
+    utilizations: List[Tuple[Dict[str, str], Dict[str, Any]]]
+    # Rates since the previous poll (bits/s) added to the rollups
+    rates: List[Dict[str, Any]] = []
+    # Ifaces infos (speed, mtu,...) that changed since the previous poll
+    ifaces: List[Dict[str, Any]] = []
+
+    def to_document(self) -> Dict[str, Any]:
+        """Json document of the batch (for the spool)"""
+        return {
+            "device_name": self.device_name,
+            # _id is added by a failed insert
+            "stats": [
+                {key: value for key, value in document.items() if key != "_id"}
+                for document in self.stats
+            ],
+            "utilizations": self.utilizations,
+            "rates": self.rates,
+            "ifaces": self.ifaces,
+        }
+
+    @classmethod
+    def from_document(cls, document: Dict[str, Any]) -> "StatsBatch":
+        """Batch read back from the spool"""
+        return cls(
+            document["device_name"],
+            document["stats"],
+            # Json arrays back to (query, data) tuples
+            [tuple(pair) for pair in document["utilizations"]],
+            document.get("rates", []),
+            document.get("ifaces", []),
+        )
+
+
+def report_write_errors(
+    collection: str, documents: List[Dict[str, Any]], errors: List[Dict[str, Any]]
+) -> None:
+    """Logs each document that couldn't be written & counts them"""
+    for error in errors:
+        document: Dict[str, Any] = documents[error["index"]]
+        print(
+            f"{collection} of {document.get('device_name')} {document.get('iface_name')}"
+            f" not written: {error.get('errmsg')}"
+        )
+    DB_WRITE_ERRORS.inc(len(errors), collection=collection)
+    DB_WRITTEN.inc(len(documents) - len(errors), collection=collection)
+
+
+def write_batches(batches: List[StatsBatch]) -> bool:
+    """Writes the results of several polls with one unordered bulk write per
+    collection: a failing document doesn't prevent the others to be written.
+    Returns False when the db couldn't be reached (batches can be retried)"""
+    stats: List[Dict[str, Any]] = [document for batch in batches for document in batch.stats]
+    # A device polled twice before a flush only keeps its last utilization
+    # (unordered writes could apply them in any order)
+    utilizations: List[Tuple[Dict[str, str], Dict[str, Any]]] = list(
+        {
+            (query["device_name"], query["iface_name"]): (query, data)
+            for batch in batches
+            for query, data in batch.utilizations
+        }.values()
+    )
+    try:
+        with DB_WRITE_SECONDS.time(collection="utilization"):
+            errors: List[Dict[str, Any]] = bulk_update_unordered(
+                UTILIZATION_COLLECTION, utilizations
+            )
+        report_write_errors("utilization", [data for _, data in utilizations], errors)
+        ifaces: List[Dict[str, Any]] = list(
+            {
+                (iface["device_name"], iface["iface_name"]): iface
+                for batch in batches
+                for iface in batch.ifaces
+            }.values()
+        )
+        with DB_WRITE_SECONDS.time(collection="ifaces"):
+            errors = update_ifaces_unordered(ifaces)
+        report_write_errors("ifaces", ifaces, errors)
+        with DB_WRITE_SECONDS.time(collection="stats"):
+            errors = write_iface_stats_unordered(stats)
+        report_write_errors("stats", stats, errors)
+        rates: List[Dict[str, Any]] = [rate for batch in batches for rate in batch.rates]
+        with DB_WRITE_SECONDS.time(collection="rollups"):
+            errors = add_rollups_unordered(rates)
+        report_write_errors("rollups", rates, errors)
+    except ConnectionFailure as err:
+        print(f"Stats of {len(batches)} devices not written (db unreachable): {err}")
+        return False
+    except (PyMongoError, OverflowError) as err:
+        # Whole batch failed (int longer than 64bit,...), retrying wouldn't help
+        print(f"Stats of {len(batches)} devices not written: {err}")
+        DB_WRITE_ERRORS.inc(len(stats), collection="stats")
+    return True
+
+
+def chunk_batches(batches: List[StatsBatch], size: int) -> List[List[StatsBatch]]:
+    """Groups batches by about size stats documents"""
+    chunks: List[List[StatsBatch]] = [[]]
+    documents: int = 0
+    for batch in batches:
+        if documents >= size:
+            chunks.append([])
+            documents = 0
+        chunks[-1].append(batch)
+        documents += len(batch.stats)
+    return chunks
+
+
+class StatsWriter:
+    """Bounded queue of polls results & the task that flushes them"""
+
+    def __init__(
+        self,
+        queue_size: int = WRITE_QUEUE_SIZE,
+        batch_size: int = WRITE_BATCH_SIZE,
+        flush_interval: float = WRITE_FLUSH_INTERVAL,
+        spool: Optional[StatsSpool] = None,
+    ) -> None:
+        self.queue: "asyncio.Queue[StatsBatch]" = asyncio.Queue(queue_size)
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval
+        self.spool: Optional[StatsSpool] = spool
+        # Timestamp of the last utilization written of each (device, iface):
+        # older ones replayed from the spool must not overwrite it
+        self.utilization_timestamps: Dict[Tuple[str, str], int] = {}
+        # Same for the last_seen of the ifaces infos. Those are only sent when they
+        # change, they can be older than the utilizations & still the latest ones
+        self.iface_timestamps: Dict[Tuple[str, str], int] = {}
+
+    def spool_batches(self, batches: List[StatsBatch], reason: str) -> bool:
+        """Appends batches to the spool. False when there's no room"""
+        if self.spool is None or not self.spool.append([batch.to_document() for batch in batches]):
+            return False
+        SPOOLED.inc(len(batches), reason=reason)
+        SPOOL_BYTES.set(self.spool.size)
+        return True
+
+    async def put(self, batch: StatsBatch) -> None:
+        """Queues the results of a poll. When the queue is full, they are
+        spooled. Without room in the spool, waits for the queue (the
+        device isn't rescheduled till its results are queued)"""
+        if not self.queue.full() or not self.spool_batches([batch], "queue_full"):
+            await self.queue.put(batch)
+        WRITE_QUEUE_DEPTH.set(self.queue.qsize())
+
+    async def next_batches(self) -> List[StatsBatch]:
+        """Waits for a result & gathers the next ones till batch_size
+        documents or flush_interval seconds"""
+        batches: List[StatsBatch] = [await self.queue.get()]
+        size: int = len(batches[0].stats)
+        deadline: float = monotonic() + self.flush_interval
+        while size < self.batch_size:
+            if self.queue.empty():
+                timeout: float = deadline - monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batches.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batches.append(self.queue.get_nowait())
+            size += len(batches[-1].stats)
+        return batches
+
+    def written(self, batches: List[StatsBatch]) -> None:
+        """Records the timestamps of the utilizations & ifaces infos written"""
+        for batch in batches:
+            for query, data in batch.utilizations:
+                key: Tuple[str, str] = (query["device_name"], query["iface_name"])
+                self.utilization_timestamps[key] = max(
+                    data["timestamp"], self.utilization_timestamps.get(key, 0)
+                )
+            for iface in batch.ifaces:
+                key = (iface["device_name"], iface["iface_name"])
+                self.iface_timestamps[key] = max(
+                    iface["last_seen"], self.iface_timestamps.get(key, 0)
+                )
+
+    def outdated(self, batch: StatsBatch) -> StatsBatch:
+        """Replayed batch without the utilizations (& ifaces infos) already overwritten"""
+        return batch._replace(
+            utilizations=[
+                (query, data)
+                for query, data in batch.utilizations
+                if data["timestamp"]
+                > self.utilization_timestamps.get((query["device_name"], query["iface_name"]), 0)
+            ],
+            ifaces=[
+                iface
+                for iface in batch.ifaces
+                if iface["last_seen"]
+                > self.iface_timestamps.get((iface["device_name"], iface["iface_name"]), 0)
+            ],
+        )
+
+    async def replay(self) -> None:
+        """Writes the oldest segment of the spool by large chunks. It is
+        deleted once written, kept for later if the db is unreachable again"""
+        if self.spool is None:
+            return
+        path: Optional[str] = self.spool.oldest()
+        if path is None:
+            return
+        loop = asyncio.get_event_loop()
+        batches: List[StatsBatch] = [
+            StatsBatch.from_document(document)
+            for document in await loop.run_in_executor(None, read_segment, path)
+        ]
+        for chunk in chunk_batches(batches, self.batch_size):
+            chunk = [self.outdated(batch) for batch in chunk]
+            if not await loop.run_in_executor(None, write_batches, chunk):
+                return
+            self.written(chunk)
+        REPLAYED.inc(len(batches))
+        self.spool.remove(path)
+        SPOOL_BYTES.set(self.spool.size)
+
+    async def run(self) -> None:
+        """Flushes the queued results, forever. Writes are done in a
+        thread so polls go on meanwhile. The spool is replayed as soon
+        as a flush succeeds"""
+        loop = asyncio.get_event_loop()
+        while True:
+            batches: List[StatsBatch] = await self.next_batches()
+            WRITE_QUEUE_DEPTH.set(self.queue.qsize())
+            try:
+                if await loop.run_in_executor(None, write_batches, batches):
+                    self.written(batches)
+                    if self.spool:
+                        await self.replay()
+                elif not self.spool_batches(batches, "db_error"):
+                    DB_WRITE_ERRORS.inc(
+                        sum(len(batch.stats) for batch in batches), collection="stats"
+                    )
+            finally:
+                for _ in batches:
+                    self.queue.task_done()
+
+    def flush_pending(self) -> None:
+        """Writes (or spools) what is left in the queue (poller stopping)"""
+        batches: List[StatsBatch] = []
+        while not self.queue.empty():
+            batches.append(self.queue.get_nowait())
+            self.queue.task_done()
+        if batches and not write_batches(batches):
+            self.spool_batches(batches, "db_error")
+        WRITE_QUEUE_DEPTH.set(0)
+        if self.spool is not None:
+            self.spool.close()
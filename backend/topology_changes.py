@@ -0,0 +1,94 @@
+""" Topology version & log of the nodes & links added, updated
+or removed by each version (served by the api as /graph/changes) """
+
+#! /usr/bin/env python3
+
+from os import getenv
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError as MDDPK  # type: ignore
+
+from db_client import DB
+
+# Seconds the topology changes are kept (clients that didn't sync
+# since then must get the whole topology again)
+TOPOLOGY_CHANGES_TTL: int = int(getenv("TOPOLOGY_CHANGES_TTL", str(7 * 86400)))
+# Changes recorded per topology version (a version is one document)
+TOPOLOGY_CHANGES_CHUNK: int = 1000
+# Fields identifying a link in the topology changes
+LINK_KEYS: Tuple[str, ...] = ("device_name", "iface_name", "neighbor_name", "neighbor_iface")
+
+# Counters (topology version)
+COUNTERS_COLLECTION = DB.counters
+# Nodes & links added/updated/removed by each topology version
+TOPOLOGY_CHANGES_COLLECTION = DB.topology_changes
+
+
+def current_version(counter: Optional[Dict[str, Any]], newest: Optional[Dict[str, Any]]) -> int:
+    """Version of the topology from its counter & the newest version logged.
+    The counter follows the log (it may lag behind a writer that stopped
+    in between) & keeps the version once its changes expired"""
+    return max(int(counter["value"]) if counter else 0, int(newest["version"]) if newest else 0)
+
+
+def get_topology_version() -> int:
+    """Current version of the topology (0 if it never changed)"""
+    return current_version(
+        COUNTERS_COLLECTION.find_one({"_id": "topology_version"}),
+        TOPOLOGY_CHANGES_COLLECTION.find_one(
+            {}, {"_id": False, "version": True}, sort=[("version", -1)]
+        ),
+    )
+
+
+def node_change(operation: str, node_name: str) -> Dict[str, Any]:
+    """Change of a node in the topology (operation: add, update or remove)"""
+    return {"op": operation, "kind": "node", "device_name": node_name}
+
+
+def link_change(operation: str, link: Dict[str, Any]) -> Dict[str, Any]:
+    """Change of a link in the topology (operation: add, update or remove)"""
+    return {"op": operation, "kind": "link", **{key: link[key] for key in LINK_KEYS}}
+
+
+def record_topology_changes(changes: List[Dict[str, Any]]) -> int:
+    """Bumps the topology version & records its changes (one version per
+    TOPOLOGY_CHANGES_CHUNK changes). Each version is a single document so it is
+    seen with all its changes or not at all. A version is allocated by the
+    insert of its document (unique version), so a writer stopping midway
+    never leaves a version without changes. Returns the last version"""
+    version: int = 0
+    for start in range(0, len(changes), TOPOLOGY_CHANGES_CHUNK):
+        while True:
+            version = get_topology_version() + 1
+            try:
+                TOPOLOGY_CHANGES_COLLECTION.insert_one(
+                    {
+                        "version": version,
+                        "created": datetime.utcnow(),
+                        "changes": changes[start : start + TOPOLOGY_CHANGES_CHUNK],
+                    }
+                )
+            except MDDPK:
+                # Another writer took this version meanwhile
+                continue
+            break
+        COUNTERS_COLLECTION.update_one(
+            {"_id": "topology_version"}, {"$max": {"value": version}}, upsert=True
+        )
+    return version
+
+
+def upserted_changes(
+    kind: str, list_tuple_key_query: List[Tuple[Dict[str, Any], Dict[str, Any]]], result: Any
+) -> List[Dict[str, Any]]:
+    """Topology changes (nodes or links added) of a bulk_update_collection"""
+    if result is None:
+        return []
+    return [
+        node_change("add", list_tuple_key_query[index][1]["device_name"])
+        if kind == "node"
+        else link_change("add", list_tuple_key_query[index][1])
+        for index in sorted(result.upserted_ids)
+    ]
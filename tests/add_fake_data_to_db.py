@@ -18,6 +18,8 @@ spath.append(os.path.realpath(os.path.dirname(__file__) + "/../backend/"))
 from db_layer import (
     prep_db_if_not_exist,
     get_latest_utilization,
+    utilization_rate,
+    UTILIZATION_TTL,
 )
 
 DB_STRING: str = getenv("DB_STRING", "mongodb://localhost:27017/")
@@ -67,6 +69,7 @@ def add_iface_utilization(
     last_utilization: int = iface_bytes * 8
     if previous_timestamp > 0:
         last_utilization = previous_utilization + last_utilization
+    timestamp: int = int(time())
 
     db.utilization.update_one(
         {"device_name": f"{device_name}", "iface_name": f"{iface_name}"},
@@ -76,8 +79,12 @@ def add_iface_utilization(
                 "iface_name": f"{iface_name}",
                 "prev_utilization": previous_utilization,
                 "prev_timestamp": previous_timestamp,
-                "timestamp": int(time()),
+                "timestamp": timestamp,
                 "last_utilization": last_utilization,
+                "rate_bps": utilization_rate(
+                    previous_utilization, last_utilization, previous_timestamp, timestamp
+                ),
+                "expires": timestamp + UTILIZATION_TTL,
             }
         },
         True,
@@ -95,11 +102,7 @@ def add_iface_stats(
         {
             "device_name": f"{device_name}",
             "iface_name": f"{iface_name}",
-            "ifalias": f"{iface_name}",
             "timestamp": int(time()),
-            "mtu": 1500,
-            "mac": "",
-            "speed": 10,
             "in_discards": 0,
             "in_errors": 0,
             "out_discards": 0,
@@ -114,6 +117,19 @@ def add_iface_stats(
             "out_bcast_pkts": 0,
         }
     )
+    db.ifaces.update_one(
+        {"device_name": f"{device_name}", "iface_name": f"{iface_name}"},
+        {
+            "$set": {
+                "ifalias": f"{iface_name}",
+                "mtu": 1500,
+                "mac": "",
+                "speed": 10,
+                "last_seen": int(time()),
+            }
+        },
+        upsert=True,
+    )
 
 
 # pylint: disable=too-many-locals
@@ -200,6 +216,7 @@ def delete_all_collections_datas() -> None:
     db.links.delete_many({})
     db.stats.delete_many({})
     db.utilization.delete_many({})
+    db.ifaces.delete_many({})
 
 
 def main() -> None:
@@ -0,0 +1,122 @@
+"""Microbenchmark of the decoding of IF-MIB bulk rows:
+MIB resolution + cast + dpath searches (previous path) against
+the precompiled TableDecoder on raw rows"""
+# /usr/bin/env python3
+
+from sys import path as spath
+import os.path
+from argparse import ArgumentParser
+from timeit import timeit
+from typing import List, Dict, Any
+
+from pysnmp import hlapi  # type: ignore
+from pysnmp.hlapi.varbinds import CommandGeneratorVarBinds  # type: ignore
+from pysnmp.proto.rfc1902 import (  # type: ignore
+    ObjectName,
+    OctetString,
+    Integer32,
+    Gauge32,
+    Counter32,
+    Counter64,
+)
+from dpath.util import search  # type: ignore
+
+spath.append(os.path.realpath(os.path.dirname(__file__) + "/../backend/"))
+# pylint:disable=import-error, wrong-import-position
+from snmp_functions import (
+    NEEDED_MIBS_FOR_STATS,
+    STATS_DECODER,
+    decode_stats_row,
+    var_binds_to_dict,
+)
+
+VALUES_BY_FIELD: Dict[str, Any] = {
+    "iface_name": OctetString("Ethernet1/1"),
+    "iface_alias": OctetString("to spine1"),
+    "mtu": Integer32(9216),
+    "speed": Gauge32(100000),
+    "mac": OctetString(hexValue="aabbcc000100"),
+    "in_disc": Counter32(12),
+    "in_err": Counter32(1),
+    "out_disc": Counter32(3),
+    "out_err": Counter32(0),
+}
+
+
+def fake_raw_rows(nb_ifaces: int) -> List[List[Any]]:
+    """Builds raw bulk rows (as received with lookupMib=False)
+    for a device with nb_ifaces interfaces"""
+    rows: List[List[Any]] = []
+    for index in range(1, nb_ifaces + 1):
+        rows.append(
+            [
+                (
+                    ObjectName(f"{oid}.{index}"),
+                    VALUES_BY_FIELD.get(field, Counter64(123456789 * index)),
+                )
+                for field, oid in zip(STATS_DECODER.fields, STATS_DECODER.oids)
+            ]
+        )
+    return rows
+
+
+def previous_decoding(engine: hlapi.SnmpEngine, rows: List[List[Any]]) -> List[List[Any]]:
+    """MIB resolution of each var_bind, cast & a dpath search per column"""
+    decoded: List[List[Any]] = []
+    for row in rows:
+        iface: Dict[str, Any] = var_binds_to_dict(
+            CommandGeneratorVarBinds().unmakeVarBinds(engine, row, True)
+        )
+        decoded.append(
+            [
+                next(search(iface, f"{oid}*", yielded=True))[1]
+                for oid in NEEDED_MIBS_FOR_STATS.values()
+            ]
+        )
+    return decoded
+
+
+def decoder_decoding(rows: List[List[Any]]) -> List[Any]:
+    """Precompiled decoder on raw rows"""
+    return [decode_stats_row(row) for row in rows]
+
+
+def main() -> None:
+    """Runs both decodings on the same fake rows & prints timings"""
+    parser = ArgumentParser(
+        prog="bench_stats_decoding",
+        description="Compare IF-MIB rows decodings",
+    )
+    parser.add_argument(
+        "-i",
+        "--ifaces",
+        type=int,
+        help="Number of interfaces of the fake device",
+        default="48",
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        help="Number of decodings of the whole device",
+        default="50",
+    )
+    args = parser.parse_args()
+
+    engine: hlapi.SnmpEngine = hlapi.SnmpEngine()
+    rows: List[List[Any]] = fake_raw_rows(args.ifaces)
+    # Warm up (mibs loading & converters lookup)
+    previous_decoding(engine, rows)
+    decoder_decoding(rows)
+
+    previous: float = timeit(lambda: previous_decoding(engine, rows), number=args.number)
+    decoder: float = timeit(lambda: decoder_decoding(rows), number=args.number)
+
+    print(f"{args.ifaces} ifaces, {args.number} runs")
+    print(f"previous path : {previous / args.number * 1000:.3f} ms per device")
+    print(f"decoder       : {decoder / args.number * 1000:.3f} ms per device")
+    print(f"speedup       : x{previous / decoder:.1f}")
+
+
+if __name__ == "__main__":
+    main()
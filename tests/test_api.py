@@ -2,10 +2,12 @@
 Warning: A mongodb must be up&running"""
 #! /bin/env python3
 
+import asyncio
 import sys
 import os
 from typing import Dict, List, Any
-from time import time
+from functools import partial
+from time import time, monotonic
 import json
 import yaml
 import pytest
@@ -16,8 +18,10 @@ from add_fake_data_to_db import delete_all_collections_datas, add_fake_datas
 
 sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../backend/"))
 # pylint:disable=import-error, wrong-import-position
+import api_for_frontend
 from api_for_frontend import (
     app,
+    current_snapshot,
     get_graph,
     stats,
     neighborships,
@@ -35,7 +39,18 @@ from api_for_frontend import (
     disable_poll_nodes_list,
     healthz,
 )
+from api_formatting import (
+    format_raw_stats,
+    format_links,
+    aggregate_links,
+    utilization_overlay,
+    merge_topology_changes,
+    Topology,
+    GraphSnapshot,
+)
+from api_cache import TTLCache, SingleFlight
 from db_layer import prep_db_if_not_exist, get_node, get_link, add_fake_iface_stats, get_all_nodes
+from topology_changes import get_topology_version
 
 
 TEST_GRAPH_DATA: Dict[str, List[Dict[str, Any]]] = {}
@@ -51,7 +66,8 @@ with open("tests/neighs_datas.json", encoding="UTF-8") as neighs_datas:
     TEST_NEIGHS_DATA = json.load(neighs_datas)
 
 
-def test_graph_nodes() -> None:
+@pytest.mark.asyncio
+async def test_graph_nodes() -> None:
     """Gets graph nodes from api (and thus db) and compares
     it with nodes in json file"""
 
@@ -59,18 +75,19 @@ def test_graph_nodes() -> None:
     prep_db_if_not_exist()
     add_fake_datas(12, 5, False, False)
 
-    graph: Dict[str, List[Dict[str, Any]]] = get_graph()
+    graph: Dict[str, List[Dict[str, Any]]] = await get_graph()
     assert graph["nodes"] == TEST_GRAPH_DATA["nodes"]
 
 
-def test_graph_links() -> None:
+@pytest.mark.asyncio
+async def test_graph_links() -> None:
     """Gets graph links from api (and thus db) and compares
     it with links in json file"""
     delete_all_collections_datas()
     prep_db_if_not_exist()
     add_fake_datas(12, 5, False, False)
 
-    graph: Dict[str, List[Dict[str, Any]]] = get_graph()
+    graph: Dict[str, List[Dict[str, Any]]] = await get_graph()
     sorted_links: List[Dict[str, Any]] = sorted(
         graph["links"], key=lambda d: (d["source"], d["target"])
     )
@@ -80,7 +97,8 @@ def test_graph_links() -> None:
     assert sorted_links == sorted_test_links
 
 
-def test_sub_graph_nodes() -> None:
+@pytest.mark.asyncio
+async def test_sub_graph_nodes() -> None:
     """Gets graph nodes for specific patterns from api
     (and thus db) and compares
     it with nodes in json file"""
@@ -91,13 +109,14 @@ def test_sub_graph_nodes() -> None:
 
     patterns = ["stage1_1", "stage1_2"]
 
-    sub_graph: Dict[str, List[Dict[str, Any]]] = get_graph(dpat=patterns)
+    sub_graph: Dict[str, List[Dict[str, Any]]] = await get_graph(dpat=patterns)
 
     for node in sub_graph["nodes"]:
         assert any(device_pattern in node["id"] for device_pattern in patterns)
 
 
-def test_sub_graph_links() -> None:
+@pytest.mark.asyncio
+async def test_sub_graph_links() -> None:
     """Gets graph links for specific patterns from api
     (and thus db) and compares
     it with links in json file"""
@@ -108,7 +127,7 @@ def test_sub_graph_links() -> None:
 
     patterns = ["stage1_1", "stage1_2"]
 
-    sub_graph: Dict[str, List[Dict[str, Any]]] = get_graph(dpat=patterns)
+    sub_graph: Dict[str, List[Dict[str, Any]]] = await get_graph(dpat=patterns)
 
     for link in sub_graph["links"]:
         assert any(
@@ -117,7 +136,8 @@ def test_sub_graph_links() -> None:
         )
 
 
-def test_stats_of_link_between_2_devices() -> None:
+@pytest.mark.asyncio
+async def test_stats_of_link_between_2_devices() -> None:
     """Tests retrieval & formatting of the stats of a
     specific link between 2 devices"""
     delete_all_collections_datas()
@@ -125,7 +145,7 @@ def test_stats_of_link_between_2_devices() -> None:
     add_fake_datas(12, 5, False, False)
 
     query: List[str] = ["fake_device_stage1_1", "fake_device_stage1_2"]
-    stats_retrieved: Dict[str, Dict[str, Dict[str, Any]]] = stats(query)
+    stats_retrieved: Dict[str, Dict[str, Dict[str, Any]]] = await stats(query)
     # Cant check timestamp since test datas in json are static
     for device_datas in stats_retrieved.values():
         for iface_datas in device_datas.values():
@@ -134,7 +154,8 @@ def test_stats_of_link_between_2_devices() -> None:
     assert stats_retrieved == TEST_STATS_DATA
 
 
-def test_stats_of_1_device() -> None:
+@pytest.mark.asyncio
+async def test_stats_of_1_device() -> None:
     """Tests retrieval & formatting of the stats of a
     uniq devices"""
     delete_all_collections_datas()
@@ -142,7 +163,7 @@ def test_stats_of_1_device() -> None:
     add_fake_datas(12, 5, False, False)
 
     query: List[str] = ["fake_device_stage1_1"]
-    stats_retrieved: Dict[str, Dict[str, Dict[str, Any]]] = stats(query)
+    stats_retrieved: Dict[str, Dict[str, Dict[str, Any]]] = await stats(query)
     # Cant check timestamp since test datas in json are static
     for device_datas in stats_retrieved.values():
         for iface_datas in device_datas.values():
@@ -175,7 +196,8 @@ def test_stats_of_1_device() -> None:
     assert stats_retrieved == test_datas_to_match
 
 
-def test_stats_of_1_device_with_timestamp() -> None:
+@pytest.mark.asyncio
+async def test_stats_of_1_device_with_timestamp() -> None:
     """Tests retrieval & formatting of the stats of a
     uniq devices when timestamps are somewhat ok"""
     delete_all_collections_datas()
@@ -189,13 +211,178 @@ def test_stats_of_1_device_with_timestamp() -> None:
     add_fake_iface_stats(query[0], iface_name, timestamp, 1000, 1000)
     add_fake_iface_stats(query[0], iface_name, timestamp + 10, 2000, 2000)
 
-    stats_retrieved: Dict[str, Dict[str, Dict[str, Any]]] = stats(query)
+    stats_retrieved: Dict[str, Dict[str, Dict[str, Any]]] = await stats(query)
 
     assert stats_retrieved[query[0]][iface_name]["stats"][-1]["InSpeed"] == 800
     assert stats_retrieved[query[0]][iface_name]["stats"][-1]["OutSpeed"] == 800
 
 
-def test_stats_bad_request_not_list() -> None:
+def test_format_raw_stats() -> None:
+    """Ensures that stored rates are served as is & that rates of samples
+    stored without them don't leak from one iface to the next"""
+
+    def stat(iface_name: str, timestamp: int, in_bytes: int, **rates: Any) -> Dict[str, Any]:
+        return {
+            "device_name": "fake_device_stage1_1",
+            "iface_name": iface_name,
+            "timestamp": timestamp,
+            "in_bytes": in_bytes,
+            "out_bytes": in_bytes,
+            **rates,
+        }
+
+    formatted: Dict[str, Dict[str, Any]] = format_raw_stats(
+        [
+            stat("1/1", 1000, 0),
+            stat("1/1", 1010, 1000),
+            stat("1/2", 1020, 5000),
+            stat("1/2", 1030, 6000, in_bps=42, out_bps=24, in_pps=1, out_errors_ps=0.5),
+        ]
+    )
+    first, second = formatted["fake_device_stage1_1"]["1/1"]["stats"]
+    assert (first["InSpeed"], second["InSpeed"], second["OutSpeed"]) == (0, 800, 800)
+    first, second = formatted["fake_device_stage1_1"]["1/2"]["stats"]
+    assert first["InSpeed"] == 0
+    assert (second["InSpeed"], second["OutSpeed"], second["InPps"]) == (42, 24, 1)
+    assert second["OutErrors"] == 0.5 and "InDiscards" not in second
+
+
+def test_format_links() -> None:
+    """Ensures that parallel links between 2 nodes (seen from both sides)
+    are aggregated into one visual link"""
+
+    links: List[Dict[str, Any]] = [
+        {"device_name": "a", "iface_name": "e1", "neighbor_name": "b", "neighbor_iface": "e1"},
+        {"device_name": "a", "iface_name": "e2", "neighbor_name": "b", "neighbor_iface": "e2"},
+        {"device_name": "b", "iface_name": "e1", "neighbor_name": "a", "neighbor_iface": "e1"},
+    ]
+    utilizations: Dict[str, int] = {"ae1": 500000, "ae2": 1500000}
+    speeds: Dict[str, int] = {"ae1": 1, "ae2": 1, "be1": 1}
+
+    formatted_links: Dict[str, Dict[str, Any]] = format_links(links, utilizations, speeds)
+    assert list(formatted_links) == ["ab"]
+    link: Dict[str, Any] = formatted_links["ab"]
+    assert link["source_interfaces"] == ["e1", "e2"] and link["target_interfaces"] == ["e1", "e2"]
+    assert link["speed"] == 2000000 and link["highest_utilization"] == 100
+
+    # Utilization overlay of the same links (ifaces without speed count as 1Mb/s, unused)
+    _, members = aggregate_links(links)
+    assert members == {"ab": ["ae1", "ae2"]}
+    assert utilization_overlay(members, utilizations, {"ae1": 1}) == {
+        "ab": {"highest_utilization": 25, "speed": 2000000}
+    }
+
+
+def test_merge_topology_changes() -> None:
+    """Ensures that topology versions are merged into their net changes"""
+
+    link: Dict[str, str] = {
+        "device_name": "a",
+        "iface_name": "1",
+        "neighbor_name": "b",
+        "neighbor_iface": "2",
+    }
+    versions: List[Dict[str, Any]] = [
+        {
+            "version": 4,
+            "changes": [
+                {"op": "add", "kind": "node", "device_name": "a"},
+                {"op": "add", "kind": "node", "device_name": "c"},
+                {"op": "update", "kind": "node", "device_name": "d"},
+                {"op": "remove", "kind": "node", "device_name": "e"},
+            ],
+        },
+        {
+            "version": 5,
+            "changes": [
+                {"op": "remove", "kind": "node", "device_name": "c"},
+                {"op": "add", "kind": "node", "device_name": "e"},
+                {"op": "add", "kind": "link", **link},
+            ],
+        },
+    ]
+    assert merge_topology_changes(versions) == {
+        "nodes": {"added": ["a"], "updated": ["d", "e"], "removed": []},
+        "links": {"added": [link], "updated": [], "removed": []},
+    }
+
+
+def test_ttl_cache() -> None:
+    """Ensures that the api cache expires entries & evicts
+    the least recently used ones past its bounds"""
+
+    cache: TTLCache = TTLCache(ttl=60, max_entries=2, max_bytes=10000, jitter=0.5)
+    cache.set("a", [1])
+    cache.set("b", [2])
+    assert cache.get("a") == [1]
+    cache.set("c", [3])
+    # "b" was the least recently used
+    assert cache.get("b") is None and cache.get("a") == [1] and cache.get("c") == [3]
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.evictions) == (3, 1, 1)
+    # Expiry is staggered between (1 - jitter) * ttl & ttl
+    assert 30 <= cache.entries["c"].expires - monotonic() <= 60
+
+    cache.set("expired", "x", ttl=0)
+    assert cache.get("expired") is None and cache.stats.expirations == 1
+
+    cache.set("too_big", "x" * 20000)
+    assert "too_big" not in cache
+    cache.set("big", "x" * 9000)
+    assert "big" in cache and cache.bytes <= 10000
+
+
+@pytest.mark.asyncio
+async def test_current_snapshot_max_age(monkeypatch: Any) -> None:
+    """Ensures that the snapshots are rebuilt by the requests
+    once too old (without background refresh)"""
+
+    built: List[int] = []
+
+    async def refresh_topology() -> GraphSnapshot:
+        built.append(1)
+        topology: Topology = Topology(len(built), [], [], {})
+        snapshot: GraphSnapshot = GraphSnapshot(
+            topology, {"version": topology.version}, {"version": topology.version}, monotonic()
+        )
+        monkeypatch.setattr(api_for_frontend, "SNAPSHOT", snapshot)
+        return snapshot
+
+    monkeypatch.setattr(api_for_frontend, "refresh_topology", refresh_topology)
+    monkeypatch.setattr(api_for_frontend, "SNAPSHOT", None)
+    assert (await current_snapshot()).graph["version"] == 1
+    assert (await current_snapshot()).graph["version"] == 1
+
+    snapshot: GraphSnapshot = await current_snapshot()
+    too_old: float = monotonic() - api_for_frontend.GRAPH_MAX_AGE - 1
+    monkeypatch.setattr(api_for_frontend, "SNAPSHOT", snapshot._replace(built=too_old))
+    assert (await current_snapshot()).graph["version"] == 2
+
+
+@pytest.mark.asyncio
+async def test_single_flight() -> None:
+    """Ensures that concurrent loads of the same key
+    are coalesced into one call"""
+
+    calls: List[str] = []
+
+    async def load(key: str) -> str:
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key.upper()
+
+    loading: SingleFlight = SingleFlight()
+    results: List[str] = await asyncio.gather(
+        *(loading.do(key, partial(load, key)) for key in ["a", "a", "b", "a"])
+    )
+    assert results == ["A", "A", "B", "A"]
+    assert sorted(calls) == ["a", "b"] and loading.coalesced == 2 and not loading.calls
+
+    # Done calls are not shared anymore
+    assert await loading.do("a", partial(load, "a")) == "A" and len(calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_stats_bad_request_not_list() -> None:
     """Ensures that wrong request for stats where
     'devices' is not a list will end up in an exception"""
     delete_all_collections_datas()
@@ -205,10 +392,11 @@ def test_stats_bad_request_not_list() -> None:
     # Query should be a list
     query: str = "fake_device_stage1_1"
     with pytest.raises(HTTPException):
-        _ = stats(query)  # type: ignore
+        _ = await stats(query)  # type: ignore
 
 
-def test_stats_bad_request_not_str_list() -> None:
+@pytest.mark.asyncio
+async def test_stats_bad_request_not_str_list() -> None:
     """Ensures that wrong request for stats where
     'devices' is not a list of strings
     will end up in an exception"""
@@ -219,10 +407,11 @@ def test_stats_bad_request_not_str_list() -> None:
     # Query should be a list of str
     query: List[int] = [1]
     with pytest.raises(HTTPException):
-        _ = stats(query)  # type: ignore
+        _ = await stats(query)  # type: ignore
 
 
-def test_neighborships() -> None:
+@pytest.mark.asyncio
+async def test_neighborships() -> None:
     """Tests neighborships route"""
     delete_all_collections_datas()
     prep_db_if_not_exist()
@@ -230,12 +419,13 @@ def test_neighborships() -> None:
 
     query: str = "fake_device_stage1_1"
 
-    neighs: List[Dict[str, str]] = neighborships(query)
+    neighs: List[Dict[str, str]] = await neighborships(query)
 
     assert neighs == TEST_NEIGHS_DATA
 
 
-def test_neighborships_bad_request_with_int() -> None:
+@pytest.mark.asyncio
+async def test_neighborships_bad_request_with_int() -> None:
     """Ensures that neighborships route raises
     an exception when the parameter is an int"""
     delete_all_collections_datas()
@@ -245,10 +435,11 @@ def test_neighborships_bad_request_with_int() -> None:
     # Query should be a str
     query: int = 1
     with pytest.raises(HTTPException):
-        _ = neighborships(query)  # type: ignore
+        _ = await neighborships(query)  # type: ignore
 
 
-def test_neighborships_bad_request_with_list() -> None:
+@pytest.mark.asyncio
+async def test_neighborships_bad_request_with_list() -> None:
     """Ensures that neighborships route raises
     an exception when the parameter is a list of str"""
     delete_all_collections_datas()
@@ -258,7 +449,7 @@ def test_neighborships_bad_request_with_list() -> None:
     # Query should be a str
     query: List[str] = ["test"]
     with pytest.raises(HTTPException):
-        _ = neighborships(query)  # type: ignore
+        _ = await neighborships(query)  # type: ignore
 
 
 def test_add_static_node_no_ifaces() -> None:
@@ -313,14 +504,15 @@ def test_add_static_node() -> None:
     assert get_node(node.name)
 
 
-def test_get_node_by_fqdn() -> None:
+@pytest.mark.asyncio
+async def test_get_node_by_fqdn() -> None:
     """Tests to get all info about a specific node"""
 
     node_name: str = "test_static"
 
     creds: HTTPBasicCredentials = HTTPBasicCredentials(username="user", password="pass")
 
-    assert get_node_infos(node_name, creds) == {
+    assert await get_node_infos(node_name, creds) == {
         "node_details": {
             "device_name": "test_static",
             "device_descr": "",
@@ -452,11 +644,12 @@ def test_delete_links() -> None:
 async def test_add_fabric() -> None:
     """Adds a fabric (yaml file) and
     verify that everything is
-    correctly added to the db"""
+    correctly added to the db (as one topology version)"""
 
     delete_all_collections_datas()
     prep_db_if_not_exist()
 
+    version: int = get_topology_version()
     bfabric: bytes = b"0"
     with open("tests/define_fabric.yaml", "rb") as rbfabric:
         bfabric = rbfabric.read()
@@ -469,6 +662,8 @@ async def test_add_fabric() -> None:
             auth=("user", "pass"),
         )
     assert response.status_code == 200
+    # The whole fabric is one topology version
+    assert get_topology_version() == version + 1
 
     yfabric: Dict[str, List[Dict[str, Any]]] = {}
     with open("tests/define_fabric.yaml", encoding="UTF-8") as yml:
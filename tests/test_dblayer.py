@@ -12,11 +12,13 @@ from add_fake_data_to_db import delete_all_collections_datas, add_fake_datas
 
 sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../backend/"))
 # pylint:disable=import-error, wrong-import-position
+import db_layer
 from db_layer import (
     prep_db_if_not_exist,
     get_all_nodes,
     get_all_links,
     get_latest_utilization,
+    get_latest_utilizations,
     get_all_highest_utilizations,
     add_iface_stats,
     add_fake_iface_utilization,
@@ -27,7 +29,29 @@ from db_layer import (
     add_node,
     add_link,
     NODES_COLLECTION,
+    heartbeat_poller,
+    get_live_pollers,
+    remove_poller,
+    get_ifindexes,
+    save_ifindexes,
+    insert_many_unordered,
+    write_iface_stats_unordered,
+    get_all_speeds,
+    update_ifaces_unordered,
+    get_ifaces_device,
+    STATS_COLLECTION,
+    delete_node,
+    LINKS_COLLECTION,
 )
+from stats_rollups import add_rollups_unordered, get_rollups_devices
+from topology_changes import (
+    get_topology_version,
+    node_change,
+    upserted_changes,
+    record_topology_changes,
+    TOPOLOGY_CHANGES_COLLECTION,
+)
+from migrate_stats import migrate_iface
 
 
 def test_db_prep() -> None:
@@ -111,6 +135,23 @@ def test_get_latest_utilization_not_existing() -> None:
     assert timestamp == 0
 
 
+def test_get_latest_utilizations() -> None:
+    """Ensure that get_latest_utilizations returns the
+    same values as get_latest_utilization for all ifaces
+    of a device, and nothing for an unknown device"""
+
+    delete_all_collections_datas()
+    prep_db_if_not_exist()
+    add_fake_datas(12, 5, False, False)
+
+    utilizations: Dict[str, Tuple[int, int]] = get_latest_utilizations("fake_device_stage1_1")
+    assert utilizations
+    for iface_name, utilization in utilizations.items():
+        assert utilization == get_latest_utilization("fake_device_stage1_1", iface_name)
+
+    assert not get_latest_utilizations("Device_that_not_exist")
+
+
 def test_get_all_highest_utilizations() -> None:
     """Tests getting highest utilization when
     timestamp is near 'now time'."""
@@ -132,6 +173,12 @@ def test_get_all_highest_utilizations() -> None:
 
     assert get_all_highest_utilizations()[device_name + iface_name] == int(1000 / 100)
 
+    # Expired rates are left out
+    add_fake_iface_utilization(
+        device_name, "1/2", prev_utilization, last_utilization, timestamp - 2000, prev_timestamp
+    )
+    assert device_name + "1/2" not in get_all_highest_utilizations()
+
 
 def test_add_iface_stats() -> None:
     """Test add_iface_stats func by
@@ -167,28 +214,28 @@ def test_add_iface_stats() -> None:
 
 
 def test_get_speed_iface() -> None:
-    """Test add_iface_stats func by
-    checking the db after using it"""
+    """Test get_speed_iface func by
+    upserting the infos of an iface"""
 
     delete_all_collections_datas()
     prep_db_if_not_exist()
 
     device: str = "fake_device_stage1_1"
     iface: str = "1/1"
-    timestamp: str = "now"
     speed: int = 1337
 
-    stats_list: List[Dict[str, Any]] = [
-        {
-            "device_name": device,
-            "iface_name": iface,
-            "timestamp": timestamp,
-            "speed": speed,
-        }
-    ]
-    add_iface_stats(stats_list)
+    assert not update_ifaces_unordered(
+        [{"device_name": device, "iface_name": iface, "speed": 1000, "last_seen": 60}]
+    )
+    assert not update_ifaces_unordered(
+        [{"device_name": device, "iface_name": iface, "speed": speed, "last_seen": 120}]
+    )
 
     assert get_speed_iface(device, iface) == speed
+    assert get_all_speeds()[device + iface] == speed
+    assert get_ifaces_device(device) == [
+        {"device_name": device, "iface_name": iface, "speed": speed, "last_seen": 120}
+    ]
 
 
 def test_bulk_update_collection() -> None:
@@ -225,3 +272,229 @@ def test_bulk_update_collection() -> None:
 
     assert last_utilization == last_db_utilization
     assert timestamp == last_db_timestamp
+
+
+def test_pollers_heartbeats() -> None:
+    """Ensures that a poller is live after a heartbeat
+    and not anymore once removed or expired"""
+
+    heartbeat_poller("test-poller")
+    assert "test-poller" in get_live_pollers(60)
+    assert "test-poller" not in get_live_pollers(-1)
+    remove_poller("test-poller")
+    assert "test-poller" not in get_live_pollers(60)
+
+
+def test_ifindexes_registry() -> None:
+    """Ensures that the ifIndexes registry of a device
+    is replaced when saved again"""
+
+    registry: Dict[str, Any] = {
+        "if_number": 1,
+        "last_changed": 10,
+        "ifaces": [{"if_index": 1, "iface_name": "1/1", "ignored": False, "linked": True}],
+    }
+    save_ifindexes("test-device", registry)
+    assert get_ifindexes("test-device") == dict(registry, device_name="test-device")
+    save_ifindexes("test-device", dict(registry, if_number=2, ifaces=[]))
+    assert get_ifindexes("test-device")["if_number"] == 2  # type: ignore
+    assert get_ifindexes("test-device")["ifaces"] == []  # type: ignore
+    assert get_ifindexes("device-never-polled") is None
+
+
+def test_insert_many_unordered() -> None:
+    """Ensures that a duplicate stat doesn't prevent
+    the next ones to be inserted & that it is reported"""
+
+    delete_all_collections_datas()
+    prep_db_if_not_exist()
+
+    stats_list: List[Dict[str, Any]] = [
+        {"device_name": "fake_device_stage1_1", "iface_name": "1/1", "timestamp": timestamp}
+        for timestamp in (1, 1, 2)
+    ]
+    errors: List[Dict[str, Any]] = insert_many_unordered(STATS_COLLECTION, stats_list)
+
+    assert [error["index"] for error in errors] == [1]
+    assert len(get_stats_devices(["fake_device_stage1_1"])) == 2
+
+
+def test_stats_buckets(monkeypatch: Any) -> None:
+    """Ensures that bucketed stats are read back as stats documents
+    & that migrated stats documents are the same once bucketed"""
+
+    delete_all_collections_datas()
+    db_layer.STATS_BUCKETS_COLLECTION.delete_many({})
+    prep_db_if_not_exist()
+
+    device: str = "fake_device_stage1_1"
+    stats_list: List[Dict[str, Any]] = [
+        {
+            "device_name": device,
+            "iface_name": "1/1",
+            "timestamp": timestamp,
+            "ifalias": "to spine",
+            "mtu": 1500,
+            "mac": "",
+            "speed": 1000 if timestamp < 3600 else 2000,
+            **{counter: timestamp * 10 for counter in db_layer.STATS_COUNTERS},
+        }
+        for timestamp in (3500, 3560, 3620)
+    ]
+    # Stats written before the switch to buckets
+    STATS_COLLECTION.insert_many([dict(stat) for stat in stats_list[:2]])
+
+    monkeypatch.setattr(db_layer, "STATS_STORAGE", "buckets")
+    errors: List[Dict[str, Any]] = write_iface_stats_unordered(
+        [dict(stat) for stat in stats_list[1:]]
+    )
+    assert not errors
+    errors = write_iface_stats_unordered([dict(stats_list[2])])
+    assert [error["index"] for error in errors] == [0]
+
+    assert migrate_iface(device, "1/1", db_layer.STATS_BUCKET_SPAN, 1, True) == 1
+    assert not list(STATS_COLLECTION.find({"device_name": device}))
+    assert db_layer.STATS_BUCKETS_COLLECTION.count_documents({"device_name": device}) == 2
+
+    # Ifaces infos aren't stored with the stats anymore, the migration
+    # moves the ones of the latest stats document to the ifaces collection
+    assert get_stats_devices([device]) == [
+        {key: value for key, value in stat.items() if key not in db_layer.STATS_METADATAS}
+        for stat in stats_list
+    ]
+    assert get_speed_iface(device, "1/1") == 1000
+    assert get_all_speeds()[device + "1/1"] == 1000
+    db_layer.STATS_BUCKETS_COLLECTION.delete_many({})
+
+
+def test_stats_rollups() -> None:
+    """Ensures that rates are aggregated per 5 minutes & per hour,
+    each sample only once"""
+
+    delete_all_collections_datas()
+    db_layer.STATS_ROLLUPS_COLLECTION.delete_many({})
+    prep_db_if_not_exist()
+
+    device: str = "fake_device_stage1_1"
+    rates: List[Dict[str, Any]] = [
+        {
+            "device_name": device,
+            "iface_name": "1/1",
+            "timestamp": timestamp,
+            "in_bps": bps,
+            "out_bps": bps * 2,
+        }
+        for timestamp, bps in ((3660, 100), (3720, 300), (3960, 50))
+    ]
+    assert not add_rollups_unordered(rates)
+    # Written again (retried or replayed batch): not counted twice
+    assert not add_rollups_unordered(rates[1:])
+
+    five_minutes: List[Dict[str, Any]] = get_rollups_devices([device], 300, 3600)
+    assert [(rollup["start"], rollup["count"]) for rollup in five_minutes] == [(3600, 2), (3900, 1)]
+    assert five_minutes[0]["in_min"] == 100 and five_minutes[0]["in_max"] == 300
+    assert five_minutes[0]["in_avg"] == 200 and five_minutes[0]["out_avg"] == 400
+
+    hours: List[Dict[str, Any]] = get_rollups_devices([device], 3600, 3700)
+    assert len(hours) == 1 and hours[0]["count"] == 3 and hours[0]["out_min"] == 100
+    db_layer.STATS_ROLLUPS_COLLECTION.delete_many({})
+
+
+def test_stats_partitions(monkeypatch: Any) -> None:
+    """Ensures that stats are written in & read from their day
+    partition and that expired partitions are dropped"""
+
+    delete_all_collections_datas()
+    monkeypatch.setattr(db_layer, "STATS_PARTITIONED", True)
+    db_layer.drop_expired_stats_partitions(1)
+    prep_db_if_not_exist()
+
+    device: str = "fake_device_stage1_1"
+    day: int = 86400
+    stats_list: List[Dict[str, Any]] = [
+        {
+            "device_name": device,
+            "iface_name": "1/1",
+            "timestamp": timestamp,
+            **{counter: timestamp for counter in db_layer.STATS_COUNTERS},
+        }
+        for timestamp in (day + 60, 3 * day + 60, 3 * day + 120)
+    ]
+    assert not write_iface_stats_unordered([dict(stat) for stat in stats_list])
+    errors: List[Dict[str, Any]] = write_iface_stats_unordered(
+        [dict(stats_list[0]), dict(stats_list[2])]
+    )
+    assert [error["index"] for error in errors] == [0, 1]
+    assert db_layer.partition_names("stats") == ["stats_19700102", "stats_19700104"]
+
+    assert get_stats_devices([device]) == stats_list
+    assert get_stats_devices([device], 2 * day, 4 * day) == stats_list[1:]
+    assert [collection.name for collection in db_layer.stats_partitions(2 * day)] == [
+        "stats",
+        "stats_19700104",
+    ]
+
+    assert db_layer.drop_expired_stats_partitions(1) == ["stats_19700102", "stats_19700104"]
+    assert not get_stats_devices([device])
+
+
+def test_topology_changes() -> None:
+    """Ensures that nodes & links changes bump the topology
+    version & are logged with it"""
+    delete_all_collections_datas()
+    prep_db_if_not_exist()
+
+    version: int = get_topology_version()
+    add_node("topo_a")
+    add_node("topo_a")  # Nothing changed, no new version
+    add_link("topo_a", "topo_b", "1/1", "1/2")
+    assert get_topology_version() == version + 2
+
+    links: List[Dict[str, str]] = [
+        {
+            "device_name": "topo_a",
+            "iface_name": "1/1",
+            "neighbor_name": "topo_b",
+            "neighbor_iface": "1/2",
+        },
+        {
+            "device_name": "topo_b",
+            "iface_name": "1/2",
+            "neighbor_name": "topo_a",
+            "neighbor_iface": "1/1",
+        },
+    ]
+    links_list: List[Tuple[Dict[str, str], Dict[str, str]]] = [(link, link) for link in links]
+    # Only the link not known yet is an upsert
+    changes: List[Dict[str, Any]] = upserted_changes(
+        "link", links_list, bulk_update_collection(LINKS_COLLECTION, links_list)
+    )
+    assert [change["device_name"] for change in changes] == ["topo_b"]
+    assert record_topology_changes(changes) == version + 3
+
+    delete_node("topo_a")
+    last_version: Dict[str, Any] = TOPOLOGY_CHANGES_COLLECTION.find_one({"version": version + 4})
+    assert sorted((change["kind"], change["op"]) for change in last_version["changes"]) == [
+        ("link", "remove"),
+        ("link", "remove"),
+        ("node", "remove"),
+    ]
+
+
+def test_topology_version_allocation() -> None:
+    """Ensures that a version is allocated by the insert of its changes:
+    a version logged by a writer that stopped before moving the
+    counter is counted & never reused"""
+    delete_all_collections_datas()
+    prep_db_if_not_exist()
+
+    version: int = record_topology_changes([node_change("add", "alloc_a")])
+    TOPOLOGY_CHANGES_COLLECTION.insert_one({"version": version + 1, "changes": []})
+    assert get_topology_version() == version + 1
+
+    assert record_topology_changes([node_change("add", "alloc_b")]) == version + 2
+    assert get_topology_version() == version + 2
+    logged: List[Dict[str, Any]] = list(
+        TOPOLOGY_CHANGES_COLLECTION.find({"version": {"$gt": version}}).sort("version", 1)
+    )
+    assert [document["version"] for document in logged] == [version + 1, version + 2]
@@ -4,7 +4,15 @@ Warning: A mongodb and a snmpsim node must be up&running"""
 
 import sys
 import os
-from typing import Dict, List, Any
+import asyncio
+import threading
+from time import time
+from typing import Dict, List, Any, Set
+import pytest
+from pymongo.errors import PyMongoError  # type: ignore
+from pysnmp.hlapi import asyncio as ahlapi  # type: ignore
+from pysnmp.proto.rfc1902 import ObjectName, OctetString, Counter64  # type: ignore
+from pysnmp.proto.rfc1905 import endOfMibView  # type: ignore
 from add_fake_data_to_db import delete_all_collections_datas
 
 sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../backend/"))
@@ -12,9 +20,48 @@ sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/../backend/"))
 from db_layer import prep_db_if_not_exist, get_node, get_stats_devices
 from snmp_functions import (
     get_snmp_creds,
+    get_bulk_auto,
+    get_bulk_auto_async,
+    get_table,
+    walk_async,
+    get_async,
+    get_sessions,
+    get_rows_async,
+    FAST_STATS_DECODER,
+    FAST_STATS_FIELDS,
+    decode_stats_row,
+    STATS_DECODER,
+    NEEDED_MIBS_FOR_STATS,
+    NEEDED_MIBS_FOR_LLDP,
+    IFACES_TABLE_TO_COUNT,
+)
+from snmp_tuning import (
+    get_bulk_settings,
+    DeviceHealth,
+    SNMP_TIMEOUTS,
+    SNMP_RETRIES,
+    SNMP_BACKOFF_MAX,
 )
 from snmp_get_lldp_topo import lldp_scrapping
-from snmp_get_ifaces_stats import stats_scrapping
+import snmp_get_ifaces_stats
+from snmp_get_ifaces_stats import (
+    stats_scrapping,
+    queue_results,
+    get_previous_utilization,
+    get_iface_registry,
+    refresh_iface_registry,
+    compute_rate,
+    changed_iface,
+    IFACES_REFRESH_INTERVAL,
+    DeviceTable,
+    IfaceRegistry,
+    short_iface_name,
+)
+from poll_scheduler import PollScheduler, PollTarget, DeviceSchedule
+from poller_sharding import owner_of
+from poller_metrics import Counter, Histogram, REGISTRY, serve_metrics
+from stats_writer import StatsWriter, StatsBatch
+from stats_spool import StatsSpool, read_segment
 
 SNMP_NODE_TO_RETRIEVE: str = os.getenv("SNMP_NODE_TO_RETRIEVE", "127.0.0.1")
 
@@ -45,3 +92,538 @@ def test_getting_iface_stats() -> None:
     stats_from_db: List[Dict[str, Any]] = list(get_stats_devices([SNMP_NODE_TO_RETRIEVE]))
 
     assert len(stats_from_db) == 8
+
+
+@pytest.mark.asyncio
+async def test_async_bulk_same_as_sync() -> None:
+    """Ensures that the asyncio bulk returns exactly
+    the same rows as the sync one"""
+
+    creds = get_snmp_creds(snmp_user="ifmib")
+    oids: List[str] = list(NEEDED_MIBS_FOR_STATS.values())
+
+    sync_res: List[Dict[str, Any]] = get_bulk_auto(
+        SNMP_NODE_TO_RETRIEVE, oids, creds, IFACES_TABLE_TO_COUNT, port=1161
+    )
+    async_res: List[Dict[str, Any]] = await get_bulk_auto_async(
+        SNMP_NODE_TO_RETRIEVE, oids, creds, IFACES_TABLE_TO_COUNT, port=1161
+    )
+
+    assert async_res
+    assert async_res == sync_res
+
+
+@pytest.mark.asyncio
+async def test_async_walk_same_as_sync() -> None:
+    """Ensures that the asyncio walk stops at the end
+    of the table like the sync one"""
+
+    creds = get_snmp_creds(snmp_user="lldp")
+    oids: List[str] = list(NEEDED_MIBS_FOR_LLDP.values())
+
+    sync_res: List[Dict[str, Any]] = get_table(SNMP_NODE_TO_RETRIEVE, oids, creds, port=1161)
+    async_res: List[Dict[str, Any]] = await walk_async(
+        SNMP_NODE_TO_RETRIEVE, oids, creds, port=1161
+    )
+
+    assert async_res
+    assert async_res == sync_res
+
+
+@pytest.mark.asyncio
+async def test_async_session_reused_and_evicted() -> None:
+    """Ensures that a device session is kept between 2 polls
+    and forgotten when the device doesn't answer"""
+
+    creds = get_snmp_creds(snmp_user="ifmib")
+
+    await get_async(SNMP_NODE_TO_RETRIEVE, [IFACES_TABLE_TO_COUNT], creds, port=1161)
+    session = get_sessions()[(SNMP_NODE_TO_RETRIEVE, 1161)]
+    await get_async(SNMP_NODE_TO_RETRIEVE, [IFACES_TABLE_TO_COUNT], creds, port=1161)
+    assert get_sessions()[(SNMP_NODE_TO_RETRIEVE, 1161)] is session
+
+    with pytest.raises(RuntimeError):
+        await get_async(SNMP_NODE_TO_RETRIEVE, [IFACES_TABLE_TO_COUNT], creds, port=1169)
+    assert (SNMP_NODE_TO_RETRIEVE, 1169) not in get_sessions()
+
+
+def test_decode_stats_row() -> None:
+    """Ensures that a raw bulk row is decoded to the right
+    slots and that columns out of the table are left empty"""
+
+    row: List[Any] = []
+    for field, oid in zip(STATS_DECODER.fields, STATS_DECODER.oids):
+        if field == "iface_name":
+            row.append((ObjectName(f"{oid}.7"), OctetString("Ethernet1/7")))
+        elif field == "out_bcast_pkts":
+            # Column already out of the table
+            row.append((ObjectName("1.3.6.1.2.1.31.1.1.1.14.1"), Counter64(1)))
+        elif field == "out_mcast_pkts":
+            row.append((ObjectName(f"{oid}.7"), endOfMibView))
+        else:
+            row.append((ObjectName(f"{oid}.7"), Counter64(42)))
+
+    record = decode_stats_row(row)
+
+    assert record
+    assert record.if_index == 7
+    assert record.iface_name == "Ethernet1/7"
+    assert record.in_octets == 42
+    assert record.out_mcast_pkts is None
+    assert record.out_bcast_pkts is None
+    assert decode_stats_row([(ObjectName("1.3.6.1.2.1.2.3.1"), Counter64(1))]) is None
+
+
+@pytest.mark.asyncio
+async def test_async_bulk_too_big(monkeypatch: Any) -> None:
+    """Ensures that the bulk backs off when the agent answers tooBig,
+    gets the same rows & remembers the sizing for the next poll"""
+
+    creds = get_snmp_creds(snmp_user="ifmib")
+    expected: List[Any] = await get_bulk_auto_async(
+        SNMP_NODE_TO_RETRIEVE,
+        STATS_DECODER.oids,
+        creds,
+        IFACES_TABLE_TO_COUNT,
+        port=1161,
+        row_decoder=decode_stats_row,
+    )
+
+    bulk_cmd = ahlapi.bulkCmd
+    asked: List[int] = []
+
+    async def small_agent_bulk(*args: Any, **kwargs: Any) -> Any:
+        # Agent that can't send more than 20 var_binds
+        max_repetitions, var_binds = args[5], args[6:]
+        asked.append(max_repetitions * len(var_binds))
+        if max_repetitions * len(var_binds) > 20:
+            return None, 1, 0, []
+        return await bulk_cmd(*args, **kwargs)
+
+    monkeypatch.setattr(ahlapi, "bulkCmd", small_agent_bulk)
+    got: List[Any] = await get_bulk_auto_async(
+        SNMP_NODE_TO_RETRIEVE,
+        STATS_DECODER.oids,
+        creds,
+        IFACES_TABLE_TO_COUNT,
+        port=1161,
+        row_decoder=decode_stats_row,
+    )
+    assert got == expected
+    assert get_bulk_settings(SNMP_NODE_TO_RETRIEVE, 1161, len(STATS_DECODER.oids)).agent_limit == 1
+
+    asked.clear()
+    await get_bulk_auto_async(
+        SNMP_NODE_TO_RETRIEVE,
+        STATS_DECODER.oids,
+        creds,
+        IFACES_TABLE_TO_COUNT,
+        port=1161,
+        row_decoder=decode_stats_row,
+    )
+    assert max(asked) <= 20
+
+
+@pytest.mark.asyncio
+async def test_async_rows_same_as_bulk() -> None:
+    """Ensures that the sparse GETs of the counters return the
+    same values as the whole table bulk & that the linked ifaces
+    records get these fresh counters"""
+
+    creds = get_snmp_creds(snmp_user="ifmib")
+    records: List[Any] = await get_bulk_auto_async(
+        SNMP_NODE_TO_RETRIEVE,
+        STATS_DECODER.oids,
+        creds,
+        IFACES_TABLE_TO_COUNT,
+        port=1161,
+        row_decoder=decode_stats_row,
+    )
+    indexes: List[int] = [record.if_index for record in records]
+    counters, scalars = await get_rows_async(
+        SNMP_NODE_TO_RETRIEVE,
+        FAST_STATS_DECODER,
+        indexes + [99999],
+        creds,
+        port=1161,
+        scalar_oids=(IFACES_TABLE_TO_COUNT,),
+    )
+    assert scalars[IFACES_TABLE_TO_COUNT] == len(records)
+    for record in records:
+        assert counters[record.if_index] == [getattr(record, field) for field in FAST_STATS_FIELDS]
+    assert counters[99999] == [None] * len(FAST_STATS_FIELDS)
+
+    registry = IfaceRegistry.from_records(
+        len(records), 0, records, {short_iface_name(records[0].iface_name)}
+    )
+    assert registry.linked_indexes == [records[0].if_index]
+    table = DeviceTable(records)
+    counters[records[0].if_index] = [1] * len(FAST_STATS_FIELDS)
+    updated: List[Any] = table.update_counters(registry.linked_indexes, counters)
+    assert [record.if_index for record in updated] == registry.linked_indexes
+    assert updated[0].in_octets == 1 and updated[0].mtu == records[0].mtu
+    assert updated[0].in_err == 1 and updated[0].out_disc == 1
+
+    table.update_counters(registry.linked_indexes + [99999], counters)
+    assert table.is_full_poll_due(time())
+
+
+def test_iface_registry() -> None:
+    """Ensures that the ifIndexes registry survives a db round trip,
+    only changes with ifNumber/ifTableLastChanged & follows the links"""
+
+    records: List[Any] = [
+        decode_stats_row(
+            [(ObjectName(f"{oid}.{index}"), OctetString(name)) for oid in STATS_DECODER.oids[:1]]
+        )
+        for index, name in ((1, "Ethernet1/1"), (2, "Ethernet1/2"), (3, "Loopback0"))
+    ]
+    registry = IfaceRegistry.from_records(3, 1234, records, {"1/1", "0"})
+    assert registry.ifaces[1].iface_name == "1/1"
+    assert registry.ifaces[3].ignored
+    assert registry.linked_indexes == [1]
+
+    restored = IfaceRegistry.from_db(registry.to_db())
+    assert restored.ifaces == registry.ifaces
+    assert restored.matches(3, 1234)
+    assert not restored.matches(4, 1234) and not restored.matches(3, 1235)
+
+    assert restored.update_links({"1/2"})
+    assert restored.linked_indexes == [2]
+    assert not restored.update_links({"1/2"})
+
+
+@pytest.mark.asyncio
+async def test_iface_registry_db_error(monkeypatch: Any) -> None:
+    """Ensures that the registry is read & saved out of the event loop
+    and that a failed save leaves it usable from memory"""
+
+    threads: List[int] = []
+
+    def get_linked_ifaces(device_name: str) -> Set[str]:
+        threads.append(threading.get_ident())
+        return {"1/1"}
+
+    def save_ifindexes(device_name: str, registry: Dict[str, Any]) -> None:
+        threads.append(threading.get_ident())
+        raise PyMongoError("db unreachable")
+
+    monkeypatch.setattr(snmp_get_ifaces_stats, "get_linked_ifaces", get_linked_ifaces)
+    monkeypatch.setattr(snmp_get_ifaces_stats, "get_ifindexes", lambda device_name: None)
+    monkeypatch.setattr(snmp_get_ifaces_stats, "save_ifindexes", save_ifindexes)
+    records: List[Any] = [
+        decode_stats_row([(ObjectName(f"{STATS_DECODER.oids[0]}.1"), OctetString("Ethernet1/1"))])
+    ]
+    registry = await refresh_iface_registry("registry_device", 1, 1234, records)
+    assert registry.linked_indexes == [1]
+    assert await get_iface_registry("registry_device") is registry
+    assert len(threads) == 2 and threading.get_ident() not in threads
+
+
+def test_device_health() -> None:
+    """Ensures that the timeout follows the RTT of the device and
+    that the breaker opens, backs off exponentially & closes again"""
+
+    health = DeviceHealth()
+    for _ in range(20):
+        health.record_success(0.01)
+    assert health.timeout() == SNMP_TIMEOUTS[0]
+    for _ in range(20):
+        health.record_success(SNMP_TIMEOUTS[-1] * 2)
+    assert health.timeout() == SNMP_TIMEOUTS[-1]
+
+    first_delay = None
+    for _ in range(10):
+        first_delay = health.record_failure(0)
+        if first_delay:
+            break
+    assert first_delay and health.is_open()
+    assert not health.allow(first_delay / 2)
+    assert health.allow(first_delay)
+    assert health.retries() == 0  # Probe
+    second_delay = health.record_failure(first_delay)
+    assert second_delay == 2 * first_delay
+    assert not health.allow(first_delay + second_delay / 2)
+
+    health.record_success(0.01)
+    assert not health.is_open() and health.allow(0)
+    assert health.retries() == SNMP_RETRIES
+
+
+def test_device_health_down_for_long() -> None:
+    """Ensures that the backoff of a device down for weeks
+    stays at SNMP_BACKOFF_MAX (no overflow) & still closes"""
+
+    health = DeviceHealth()
+    now: float = 0.0
+    for _ in range(5000):
+        delay = health.record_failure(now)
+        if delay:
+            now += delay
+    assert delay == SNMP_BACKOFF_MAX and health.allow(now)
+    health.record_success(0.01)
+    assert not health.is_open()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_steady_cadence() -> None:
+    """Ensures that each device is polled on its own interval,
+    never twice at the same time, even when a device is slow"""
+
+    polls: Dict[str, int] = {}
+    running: List[str] = []
+
+    async def fake_poll(hostname: str, _ip: str, _port: int) -> None:
+        assert hostname not in running
+        running.append(hostname)
+        polls[hostname] = polls.get(hostname, 0) + 1
+        if hostname == "slow":
+            await asyncio.sleep(0.5)
+        running.remove(hostname)
+
+    targets: List[PollTarget] = [
+        PollTarget("fast", "", 161, 0.1),
+        PollTarget("medium", "", 161, 0.25),
+        PollTarget("slow", "", 161, 0.1),
+    ]
+    scheduler = PollScheduler(fake_poll, lambda: targets)
+    runner = asyncio.ensure_future(scheduler.run())
+    await asyncio.sleep(1.05)
+    runner.cancel()
+
+    assert 9 <= polls["fast"] <= 11
+    assert 3 <= polls["medium"] <= 5
+    assert polls["slow"] <= 3
+    assert scheduler.schedules[("slow", "", 161)].overruns >= 1
+    assert scheduler.schedules[("slow", "", 161)].missed >= 1
+    assert scheduler.schedules[("fast", "", 161)].overruns == 0
+
+
+def test_scheduler_targets_sync() -> None:
+    """Ensures that new devices are jittered over their interval
+    and that devices not returned anymore are dropped"""
+
+    scheduler = PollScheduler(lambda *_: asyncio.sleep(0), lambda: [])
+    scheduler.sync_targets([PollTarget(f"dev{i}", "", 161, 60) for i in range(100)], now=0)
+    deadlines: List[float] = [schedule.deadline for schedule in scheduler.schedules.values()]
+    assert all(0 <= deadline <= 60 for deadline in deadlines)
+    assert len(set(deadlines)) > 1
+
+    dropped: DeviceSchedule = scheduler.schedules[("dev0", "", 161)]
+    scheduler.sync_targets([PollTarget(f"dev{i}", "", 161, 60) for i in range(1, 100)], now=0)
+    assert dropped.removed
+    assert len(scheduler.schedules) == 99
+
+
+def test_sharding_rebalance() -> None:
+    """Ensures that devices are spread between pollers and that
+    only the devices of a poller that leaves are moved"""
+
+    devices: List[str] = [f"device{i}" for i in range(3000)]
+    workers: List[str] = ["poller-0", "poller-1", "poller-2"]
+    owners: Dict[str, str] = {device: owner_of(device, workers) for device in devices}
+    for worker in workers:
+        assert 800 < list(owners.values()).count(worker) < 1200
+
+    for device in devices:
+        new_owner: str = owner_of(device, ["poller-0", "poller-2"])
+        if owners[device] != "poller-1":
+            assert new_owner == owners[device]
+        else:
+            assert new_owner in ("poller-0", "poller-2")
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint() -> None:
+    """Ensures that metrics are rendered in the Prometheus
+    text format & served on /metrics"""
+
+    requests = Counter("test_requests_total", "Test requests", ["command"])
+    durations = Histogram("test_seconds", "Test durations", buckets=(0.1, 1))
+    try:
+        requests.inc(command="getCmd")
+        requests.inc(2, command="getCmd")
+        durations.observe(0.05)
+        durations.observe(0.5)
+        durations.observe(5)
+
+        server = await serve_metrics(0)
+        assert server is None
+        server = await serve_metrics(19108, "127.0.0.1")
+        assert server is not None
+        reader, writer = await asyncio.open_connection("127.0.0.1", 19108)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response: str = (await reader.read()).decode()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+    finally:
+        REGISTRY.remove(requests)
+        REGISTRY.remove(durations)
+
+    assert response.startswith("HTTP/1.0 200 OK")
+    assert "# TYPE test_requests_total counter" in response
+    assert 'test_requests_total{command="getCmd"} 3' in response
+    assert 'test_seconds_bucket{le="0.1"} 1' in response
+    assert 'test_seconds_bucket{le="1.0"} 2' in response
+    assert 'test_seconds_bucket{le="+Inf"} 3' in response
+    assert "test_seconds_count 3" in response
+    assert "naasgul_snmp_requests_total" in response
+
+
+@pytest.mark.asyncio
+async def test_stats_writer_batching() -> None:
+    """Ensures that results are gathered till the batch size
+    & that polls wait when the queue is full"""
+
+    writer = StatsWriter(queue_size=3, batch_size=4, flush_interval=0.1)
+    for device in ("dev1", "dev2", "dev3"):
+        await writer.put(StatsBatch(device, [{"device_name": device}] * 2, []))
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(writer.put(StatsBatch("dev4", [], [])), 0.1)
+
+    batches: List[StatsBatch] = await writer.next_batches()
+    assert [batch.device_name for batch in batches] == ["dev1", "dev2"]
+    start: float = time()
+    batches = await writer.next_batches()
+    assert [batch.device_name for batch in batches] == ["dev3"]
+    assert time() - start >= 0.09
+
+
+def test_stats_spool(tmp_path: Any) -> None:
+    """Ensures that spooled results are read back in order,
+    across segments & runs, and that a torn record is skipped"""
+
+    spool = StatsSpool(str(tmp_path), segment_size=256, max_size=4096)
+    batches: List[StatsBatch] = [
+        StatsBatch(
+            f"dev{index}",
+            [{"device_name": f"dev{index}", "iface_name": "1/1", "timestamp": index}],
+            [({"device_name": f"dev{index}", "iface_name": "1/1"}, {"timestamp": index})],
+        )
+        for index in range(6)
+    ]
+    assert spool.append([batch.to_document() for batch in batches])
+    assert len(spool.segments) > 1
+    assert not spool.append([{"too": "big" * 4096}])
+    spool.close()
+
+    # Crash in the middle of the last record of the last segment
+    last_segment: str = spool.segments[-1]
+    with open(last_segment, "r+b") as segment:
+        data: bytes = segment.read()
+        segment.seek(data.index(b"dev5") + 1)
+        segment.write(b"X")
+
+    spool = StatsSpool(str(tmp_path))
+    replayed: List[StatsBatch] = []
+    while True:
+        path = spool.oldest()
+        if path is None:
+            break
+        replayed.extend(StatsBatch.from_document(document) for document in read_segment(path))
+        spool.remove(path)
+    assert replayed == batches[:5]
+    assert not spool and spool.size == 0
+
+
+@pytest.mark.asyncio
+async def test_stats_writer_spills_to_spool(tmp_path: Any) -> None:
+    """Ensures that polls don't wait for a full queue when there's a spool"""
+
+    writer = StatsWriter(queue_size=1, spool=StatsSpool(str(tmp_path)))
+    for device in ("dev1", "dev2", "dev3"):
+        await asyncio.wait_for(writer.put(StatsBatch(device, [], [])), 0.1)
+    assert writer.queue.qsize() == 1
+    assert writer.spool
+    path = writer.spool.oldest()
+    assert path is not None
+    assert [document["device_name"] for document in read_segment(path)] == ["dev2", "dev3"]
+
+
+def test_stats_writer_outdated() -> None:
+    """Ensures that replayed results only drop the utilizations & ifaces
+    infos overwritten since, each compared with its own last write"""
+
+    def batch(timestamp: int, last_seen: int) -> StatsBatch:
+        query: Dict[str, str] = {"device_name": "spool_device", "iface_name": "1/1"}
+        return StatsBatch(
+            "spool_device",
+            [],
+            [(query, {"timestamp": timestamp})],
+            ifaces=[dict(query, last_seen=last_seen)],
+        )
+
+    writer = StatsWriter()
+    writer.written([batch(1200, 1000)])
+    # Infos not changed since the spooled poll: only its utilization is outdated
+    replayed: StatsBatch = writer.outdated(batch(1100, 1100))
+    assert not replayed.utilizations and len(replayed.ifaces) == 1
+    replayed = writer.outdated(batch(1300, 900))
+    assert len(replayed.utilizations) == 1 and not replayed.ifaces
+
+
+@pytest.mark.asyncio
+async def test_previous_utilizations_cold_start(monkeypatch: Any) -> None:
+    """Ensures that the previous utilizations of a device not known
+    yet are read once, out of the event loop"""
+
+    threads: List[int] = []
+
+    def get_latest_utilizations(device_name: str) -> Dict[str, Any]:
+        threads.append(threading.get_ident())
+        return {"1/1": (5, 10)} if device_name == "cold_device" else {}
+
+    monkeypatch.setattr(snmp_get_ifaces_stats, "get_latest_utilizations", get_latest_utilizations)
+    monkeypatch.setattr(snmp_get_ifaces_stats, "STATS_WRITER", StatsWriter())
+    await queue_results("cold_device", [])
+    await queue_results("cold_device", [])
+    assert len(threads) == 1 and threads[0] != threading.get_ident()
+    assert get_previous_utilization("cold_device", "1/1") == (5, 10)
+
+
+def test_compute_rate() -> None:
+    """Ensures that rates are computed between 2 polls of an iface
+    and not when its counters are reset"""
+
+    def stat(timestamp: int, in_bytes: int, out_bytes: int) -> Dict[str, Any]:
+        return {
+            "device_name": "rate_device",
+            "iface_name": "1/1",
+            "timestamp": timestamp,
+            "in_bytes": in_bytes,
+            "out_bytes": out_bytes,
+        }
+
+    assert compute_rate(stat(1000, 0, 0)) is None
+    rate = compute_rate(stat(1060, 7500, 750))
+    assert rate is not None and rate["in_bps"] == 1000 and rate["out_bps"] == 100
+    assert compute_rate(stat(1120, 10, 10)) is None
+    assert compute_rate(stat(1120, 20, 20)) is None
+    rate = compute_rate(stat(1180, 30, 80))
+    assert rate is not None and rate["in_bps"] == 1 and rate["out_bps"] == 8
+
+    # Errors & discards are Counter32 that can wrap
+    counters: Dict[str, Any] = stat(1240, 30, 80)
+    counters.update(in_ucast_pkts=600, in_errors=2 ** 32 - 60)
+    compute_rate(counters)
+    counters.update(timestamp=1300, in_ucast_pkts=1200, in_errors=60)
+    rate = compute_rate(counters)
+    assert rate is not None and rate["in_pps"] == 10 and rate["in_errors_ps"] == 2
+
+
+def test_changed_iface() -> None:
+    """Ensures that ifaces infos are only sent when they change
+    or when their last_seen has to be refreshed"""
+
+    infos: Dict[str, Any] = {"ifalias": "to spine", "mtu": 1500, "mac": "", "speed": 1000}
+    iface = changed_iface("infos_device", "1/1", infos, 1000)
+    assert iface is not None and iface["speed"] == 1000 and iface["last_seen"] == 1000
+    assert changed_iface("infos_device", "1/1", dict(infos), 1060) is None
+    iface = changed_iface("infos_device", "1/1", dict(infos, speed=10000), 1120)
+    assert iface is not None and iface["speed"] == 10000
+    assert changed_iface("infos_device", "1/1", dict(infos, speed=10000), 1180) is None
+    iface = changed_iface(
+        "infos_device", "1/1", dict(infos, speed=10000), 1120 + IFACES_REFRESH_INTERVAL
+    )
+    assert iface is not None and iface["last_seen"] == 1120 + IFACES_REFRESH_INTERVAL